@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+管理员路由表
+由配置文件一次性构建：名称 -> ID、ID -> 名称、管理员集合、分配权重和管理员选择键盘。
+路由表构建后不再修改，配置重新加载时构建新表整体替换，处理器读取时无需加锁
+"""
+
+import configparser
+import logging
+from types import MappingProxyType
+from typing import Dict, FrozenSet, Mapping, NamedTuple, Optional
+
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+
+from routing import ROUTING_MODES
+
+logger = logging.getLogger(__name__)
+
+# 管理员选择键盘每行的按钮数
+KEYBOARD_COLUMNS = 3
+
+
+class AdminTable(NamedTuple):
+    """管理员路由表（只读）"""
+    names: Mapping[str, int]
+    by_id: Mapping[int, str]
+    ids: FrozenSet[int]
+    weights: Mapping[int, float]
+    routing_mode: str
+    keyboard: InlineKeyboardMarkup
+
+    def name_of(self, admin_id: int, default: Optional[str] = None) -> Optional[str]:
+        """管理员显示名称"""
+        return self.by_id.get(admin_id, default)
+
+
+def parse_admins(config: configparser.ConfigParser) -> Dict[str, int]:
+    """解析管理员配置"""
+    admins = {}
+    if 'ADMINS' in config:
+        for name, user_id in config['ADMINS'].items():
+            try:
+                admins[name] = int(user_id)
+            except ValueError:
+                logger.error(f"无效的管理员ID: {name} = {user_id}")
+    return admins
+
+
+def parse_admin_weights(config: configparser.ConfigParser, admins: Mapping[str, int]) -> Dict[int, float]:
+    """解析管理员自动分配权重（按显示名称配置，默认 1）"""
+    weights = {}
+    if 'ADMIN_WEIGHTS' in config:
+        for name, weight in config['ADMIN_WEIGHTS'].items():
+            if name not in admins:
+                logger.error(f"权重配置中的管理员不存在: {name}")
+                continue
+            try:
+                weights[admins[name]] = float(weight)
+            except ValueError:
+                logger.error(f"无效的管理员权重: {name} = {weight}")
+    return weights
+
+
+def build_keyboard(admins: Mapping[str, int], automatic: bool) -> InlineKeyboardMarkup:
+    """生成管理员选择键盘"""
+    buttons = [InlineKeyboardButton(text=name, callback_data=f"admin_{user_id}") for name, user_id in admins.items()]
+    keyboard = [buttons[i:i + KEYBOARD_COLUMNS] for i in range(0, len(buttons), KEYBOARD_COLUMNS)]
+    # 自动分配模式下提供“任意管理员”按钮
+    if automatic:
+        keyboard.append([InlineKeyboardButton(text="⚡ 任意空闲管理员", callback_data="admin_auto")])
+    return InlineKeyboardMarkup(keyboard)
+
+
+def build_admin_table(config: configparser.ConfigParser) -> AdminTable:
+    """由配置构建路由表；配置无效时抛出 ValueError"""
+    admins = parse_admins(config)
+    routing_mode = config.get('SETTINGS', 'routing_mode', fallback='manual')
+    if routing_mode not in ROUTING_MODES:
+        raise ValueError(f"未知的分配模式: {routing_mode}")
+    by_id = {user_id: name for name, user_id in admins.items()}
+    return AdminTable(
+        names=MappingProxyType(admins),
+        by_id=MappingProxyType(by_id),
+        ids=frozenset(by_id),
+        weights=MappingProxyType(parse_admin_weights(config, admins)),
+        routing_mode=routing_mode,
+        keyboard=build_keyboard(admins, routing_mode != 'manual'),
+    )
@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+入站限流
+用户消息在访问数据库之前先经过准入检查：每个用户一个令牌桶，全局一个令牌桶，
+出站队列积压过多时拒绝新消息。短时间内多次超限的用户自动拉黑一段时间，到期自动解除。
+全部状态在内存中，检查不涉及任何 I/O
+"""
+
+from typing import Callable, Dict, NamedTuple, Optional, Tuple
+
+from metrics import ADMISSION_RESULTS
+from outbox import TokenBucket
+
+# 准入结果
+ADMITTED = 'admitted'
+THROTTLED = 'throttled'    # 用户超过自己的频率限制
+OVERLOADED = 'overloaded'  # 全局限流或系统积压
+BLOCKED = 'blocked'        # 在黑名单中
+
+
+class Admission(NamedTuple):
+    """一次准入检查的结果；notify 表示需要（低频地）提示用户"""
+    result: str
+    notify: bool = False
+
+    @property
+    def allowed(self) -> bool:
+        return self.result == ADMITTED
+
+
+class AdmissionController:
+    """入站准入控制（仅在事件循环线程中访问）"""
+
+    def __init__(self, user_rate: float = 1.0, user_burst: float = 5, global_rate: float = 100,
+                 global_burst: float = 200, strikes: int = 20, strike_window: float = 60,
+                 block_seconds: float = 1800, notice_interval: float = 10,
+                 is_overloaded: Optional[Callable[[], bool]] = None, sweep_interval: float = 60):
+        self.user_rate = user_rate
+        self.user_burst = user_burst
+        self.global_bucket = TokenBucket(global_rate, global_burst)
+        self.strikes = strikes
+        self.strike_window = strike_window
+        self.block_seconds = block_seconds
+        self.notice_interval = notice_interval
+        self.is_overloaded = is_overloaded
+        self.sweep_interval = sweep_interval
+        self._buckets: Dict[int, TokenBucket] = {}
+        # user_id -> (窗口开始时间, 窗口内超限次数)
+        self._strikes: Dict[int, Tuple[float, int]] = {}
+        # user_id -> 解除时间
+        self._blocked: Dict[int, float] = {}
+        # user_id -> 上次提示时间
+        self._notified: Dict[int, float] = {}
+        self._swept_at: Optional[float] = None
+
+    @property
+    def blocked_count(self) -> int:
+        return len(self._blocked)
+
+    def is_blocked(self, user_id: int, now: float) -> bool:
+        """用户是否在黑名单中（过期的条目顺便移除）"""
+        until = self._blocked.get(user_id)
+        if until is None:
+            return False
+        if now < until:
+            return True
+        del self._blocked[user_id]
+        return False
+
+    def block(self, user_id: int, now: float, seconds: Optional[float] = None):
+        """拉黑用户"""
+        self._blocked[user_id] = now + (self.block_seconds if seconds is None else seconds)
+        self._strikes.pop(user_id, None)
+
+    def unblock(self, user_id: int) -> bool:
+        """解除拉黑，返回用户原来是否在黑名单中"""
+        self._strikes.pop(user_id, None)
+        return self._blocked.pop(user_id, None) is not None
+
+    def check(self, user_id: int, now: float) -> Admission:
+        """检查一条用户消息是否准入"""
+        if self._swept_at is None:
+            self._swept_at = now
+        elif now - self._swept_at >= self.sweep_interval:
+            self._sweep(now)
+
+        if self.is_blocked(user_id, now):
+            return self._reject(user_id, BLOCKED, now)
+
+        bucket = self._buckets.get(user_id)
+        if bucket is None:
+            bucket = self._buckets[user_id] = TokenBucket(self.user_rate, self.user_burst, now)
+        if bucket.consume(now):
+            if self._strike(user_id, now):
+                self.block(user_id, now)
+                # 刚被拉黑时总是提示一次
+                self._notified.pop(user_id, None)
+                return self._reject(user_id, BLOCKED, now)
+            return self._reject(user_id, THROTTLED, now)
+
+        if (self.is_overloaded and self.is_overloaded()) or self.global_bucket.consume(now):
+            return self._reject(user_id, OVERLOADED, now)
+
+        ADMISSION_RESULTS.labels(result=ADMITTED).inc()
+        return Admission(ADMITTED)
+
+    def _strike(self, user_id: int, now: float) -> bool:
+        """记录一次超限，返回是否达到拉黑次数"""
+        started, count = self._strikes.get(user_id, (now, 0))
+        if now - started > self.strike_window:
+            started, count = now, 0
+        count += 1
+        self._strikes[user_id] = (started, count)
+        return self.strikes > 0 and count >= self.strikes
+
+    def _reject(self, user_id: int, result: str, now: float) -> Admission:
+        ADMISSION_RESULTS.labels(result=result).inc()
+        last = self._notified.get(user_id)
+        if last is not None and now - last < self.notice_interval:
+            return Admission(result)
+        self._notified[user_id] = now
+        return Admission(result, notify=True)
+
+    def _sweep(self, now: float):
+        """清理已恢复满额的令牌桶和过期的记录，内存只与近期活跃的用户数有关"""
+        self._swept_at = now
+        for user_id in [u for u, bucket in self._buckets.items() if bucket.is_full(now)]:
+            del self._buckets[user_id]
+        for user_id in [u for u, (started, _) in self._strikes.items() if now - started > self.strike_window]:
+            del self._strikes[user_id]
+        for user_id in [u for u, until in self._blocked.items() if now >= until]:
+            del self._blocked[user_id]
+        for user_id in [u for u, last in self._notified.items() if now - last >= self.notice_interval]:
+            del self._notified[user_id]
@@ -0,0 +1,242 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+管理员服务统计
+admin_stats_hourly 表按 (管理员, 小时) 保存汇总：新会话、结束会话、各类消息条数、
+首次响应耗时和会话处理时长的合计。汇总行在保存消息、创建和关闭会话的同一事务中增量更新，
+统计查询只读取汇总表，耗时与消息总量无关
+
+用法：
+    python3 analytics.py --since 2024-01-01 --until 2024-02-01
+"""
+
+import argparse
+import configparser
+import sqlite3
+from collections import defaultdict
+from datetime import datetime, timedelta
+from typing import Dict, Iterable, List, Mapping, NamedTuple, Optional, Tuple
+
+from admin_table import build_admin_table
+from export import parse_date
+from sharding import configured_db_paths
+
+# 消息类别：只有 USER 和 ADMIN 计入消息条数，ADMIN 还用于计算首次响应
+USER = 'user'      # 用户消息
+ADMIN = 'admin'    # 管理员回复
+AUTO = 'auto'      # 自动回复
+SYSTEM = 'system'  # 系统通知（如新会话通知）
+
+_TIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+# 汇总表中可累加的列
+_COLUMNS = ('opened', 'closed', 'user_messages', 'admin_messages', 'auto_replies',
+            'first_responses', 'first_response_seconds', 'resolution_seconds')
+
+
+class AdminStats(NamedTuple):
+    """一段时间内一个管理员的汇总"""
+    admin_id: int
+    opened: int = 0
+    closed: int = 0
+    user_messages: int = 0
+    admin_messages: int = 0
+    auto_replies: int = 0
+    first_responses: int = 0
+    first_response_seconds: float = 0.0
+    resolution_seconds: float = 0.0
+
+    @property
+    def avg_first_response(self) -> Optional[float]:
+        return self.first_response_seconds / self.first_responses if self.first_responses else None
+
+    @property
+    def avg_resolution(self) -> Optional[float]:
+        return self.resolution_seconds / self.closed if self.closed else None
+
+
+def hour_of(timestamp: str) -> str:
+    """时间所在的小时（与数据库中的时间格式一致）"""
+    return timestamp[:13] + ':00:00'
+
+
+def _seconds_between(start: str, end: str) -> float:
+    delta = datetime.strptime(end, _TIME_FORMAT) - datetime.strptime(start, _TIME_FORMAT)
+    return max(0.0, delta.total_seconds())
+
+
+def _add(conn: sqlite3.Connection, deltas: Mapping[Tuple[int, str], Mapping[str, float]]):
+    """把增量累加到汇总行 {(admin_id, hour): {列: 增量}}"""
+    rows = [
+        (admin_id, hour, *(delta.get(column, 0) for column in _COLUMNS))
+        for (admin_id, hour), delta in deltas.items()
+    ]
+    if not rows:
+        return
+    updates = ', '.join(f'{column} = {column} + excluded.{column}' for column in _COLUMNS)
+    conn.executemany(f'''
+        INSERT INTO admin_stats_hourly (admin_id, hour, {', '.join(_COLUMNS)})
+        VALUES (?, ?, {', '.join('?' for _ in _COLUMNS)})
+        ON CONFLICT (admin_id, hour) DO UPDATE SET {updates}
+    ''', rows)
+
+
+def record_messages(conn: sqlite3.Connection, messages: Iterable[Tuple[int, int, str, str]]):
+    """记录一批消息 (conv_id, admin_id, kind, timestamp)；会话的第一条管理员回复记为首次响应"""
+    deltas: Dict[Tuple[int, str], Dict[str, float]] = defaultdict(lambda: defaultdict(float))
+    for conv_id, admin_id, kind, timestamp in messages:
+        delta = deltas[(admin_id, hour_of(timestamp))]
+        if kind == USER:
+            delta['user_messages'] += 1
+        elif kind == AUTO:
+            delta['auto_replies'] += 1
+        elif kind == ADMIN:
+            delta['admin_messages'] += 1
+            cursor = conn.execute('''
+                UPDATE conversations SET first_response_at = ?
+                WHERE id = ? AND first_response_at IS NULL
+            ''', (timestamp, conv_id))
+            if cursor.rowcount:
+                created_at = conn.execute('SELECT created_at FROM conversations WHERE id = ?',
+                                          (conv_id,)).fetchone()[0]
+                delta['first_responses'] += 1
+                delta['first_response_seconds'] += _seconds_between(created_at, timestamp)
+    _add(conn, deltas)
+
+
+def record_opened(conn: sqlite3.Connection, admin_id: int, timestamp: str):
+    """记录一个新会话"""
+    _add(conn, {(admin_id, hour_of(timestamp)): {'opened': 1}})
+
+
+def record_closed(conn: sqlite3.Connection, conv_ids: Iterable[int], timestamp: str):
+    """记录即将关闭的会话（调用方随后在同一事务中修改状态），已关闭的会话不重复计入；
+    处理时长为创建到最后一条消息的时间，不含等待超时的部分"""
+    deltas: Dict[Tuple[int, str], Dict[str, float]] = defaultdict(lambda: defaultdict(float))
+    for conv_id in conv_ids:
+        row = conn.execute('''
+            SELECT admin_id, created_at, last_active FROM conversations
+            WHERE id = ? AND status = 'active'
+        ''', (conv_id,)).fetchone()
+        if not row:
+            continue
+        admin_id, created_at, last_active = row
+        delta = deltas[(admin_id, hour_of(timestamp))]
+        delta['closed'] += 1
+        delta['resolution_seconds'] += _seconds_between(created_at, last_active)
+    _add(conn, deltas)
+
+
+def query_stats(conn: sqlite3.Connection, since: Optional[str] = None, until: Optional[str] = None,
+                admin_id: Optional[int] = None) -> List[AdminStats]:
+    """按管理员汇总 [since, until) 内的统计（按小时对齐，时间为 UTC）"""
+    conditions = []
+    params: List = []
+    if since:
+        conditions.append('hour >= ?')
+        params.append(hour_of(since))
+    if until:
+        conditions.append('hour < ?')
+        params.append(until)
+    if admin_id is not None:
+        conditions.append('admin_id = ?')
+        params.append(admin_id)
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ''
+    rows = conn.execute(f'''
+        SELECT admin_id, {', '.join(f'SUM({column})' for column in _COLUMNS)}
+        FROM admin_stats_hourly
+        {where}
+        GROUP BY admin_id
+        ORDER BY admin_id
+    ''', params).fetchall()
+    return [AdminStats(*row) for row in rows]
+
+
+def total(stats: Iterable[AdminStats]) -> AdminStats:
+    """所有管理员的合计（admin_id 为 0）"""
+    sums = [0] * len(_COLUMNS)
+    for item in stats:
+        for i, value in enumerate(item[1:]):
+            sums[i] += value
+    return AdminStats(0, *sums)
+
+
+def merge_stats(results: Iterable[List[AdminStats]]) -> List[AdminStats]:
+    """按管理员合并多个数据库（分片）的统计"""
+    by_admin: Dict[int, List[AdminStats]] = defaultdict(list)
+    for stats in results:
+        for item in stats:
+            by_admin[item.admin_id].append(item)
+    return [total(items)._replace(admin_id=admin_id) for admin_id, items in sorted(by_admin.items())]
+
+
+def format_duration(seconds: Optional[float]) -> str:
+    """把秒数显示为“X小时Y分”“X分Y秒”"""
+    if seconds is None:
+        return '-'
+    seconds = int(round(seconds))
+    if seconds >= 3600:
+        return f"{seconds // 3600}小时{seconds % 3600 // 60}分"
+    if seconds >= 60:
+        return f"{seconds // 60}分{seconds % 60}秒"
+    return f"{seconds}秒"
+
+
+def format_report(stats: List[AdminStats], names: Mapping[int, str], title: str) -> str:
+    """统计报告文本（/stats 和命令行共用）"""
+    if not stats:
+        return f"{title}\n\n暂无数据。"
+    lines = [title]
+    rows = list(stats)
+    if len(rows) > 1:
+        rows.append(total(stats))
+    for item in rows:
+        name = '合计' if item.admin_id == 0 else names.get(item.admin_id, str(item.admin_id))
+        lines.append('')
+        lines.append(f"👤 {name}")
+        lines.append(f"  新会话 {item.opened} · 已结束 {item.closed}")
+        lines.append(f"  用户消息 {item.user_messages} · 回复 {item.admin_messages} · 自动回复 {item.auto_replies}")
+        lines.append(f"  平均首次响应 {format_duration(item.avg_first_response)} · "
+                     f"平均处理时长 {format_duration(item.avg_resolution)}")
+    return '\n'.join(lines)
+
+
+def recent_period(days: float, now: Optional[datetime] = None) -> Tuple[str, str]:
+    """最近 days 天的 [since, until)"""
+    now = now or datetime.utcnow()
+    since = now - timedelta(days=days)
+    return since.strftime(_TIME_FORMAT), hour_of((now + timedelta(hours=1)).strftime(_TIME_FORMAT))
+
+
+def main():
+    """命令行入口"""
+    parser = argparse.ArgumentParser(description='管理员服务统计')
+    parser.add_argument('--config', default='config.ini', help='配置文件（读取 db_path 和管理员名称）')
+    parser.add_argument('--db', help='数据库文件（默认取配置文件中的 db_path，分片模式下为所有分片）')
+    parser.add_argument('--since', type=parse_date, help='起始时间（UTC，含），YYYY-MM-DD[ HH:MM:SS]')
+    parser.add_argument('--until', type=parse_date, help='结束时间（UTC，不含），YYYY-MM-DD[ HH:MM:SS]')
+    parser.add_argument('--days', type=float, help='最近 N 天（代替 --since/--until）')
+    parser.add_argument('--admin', type=int, help='只统计该管理员')
+    args = parser.parse_args()
+
+    config = configparser.ConfigParser()
+    config.read(args.config, encoding='utf-8')
+    db_paths = [args.db] if args.db else configured_db_paths(config)
+    # 与机器人的 /stats 使用同一份解析结果
+    names = build_admin_table(config).by_id
+
+    since, until = recent_period(args.days) if args.days else (args.since, args.until)
+    results = []
+    for db_path in db_paths:
+        conn = sqlite3.connect(f'file:{db_path}?mode=ro', uri=True)
+        try:
+            results.append(query_stats(conn, since, until, args.admin))
+        finally:
+            conn.close()
+    stats = merge_stats(results)
+    title = f"📊 管理员服务统计（UTC {since or '最早'} 至 {until or '现在'}）"
+    print(format_report(stats, names, title))
+
+
+if __name__ == '__main__':
+    main()
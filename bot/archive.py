@@ -0,0 +1,169 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+冷数据归档
+已关闭且超过保留期的会话，其消息移出数据库，追加写入按月划分的压缩归档文件
+（archive/messages-YYYY-MM.jsonl.gz，每个会话一个 gzip 成员，可直接 zcat 查看），
+数据库中的 archive_index 记录每个会话在归档文件中的位置。
+每批会话先写归档文件并 fsync，再在一个短事务中写索引、删除消息，不会长时间占用写锁
+
+用法：
+    python3 archive.py run --days 90          # 立即归档一次
+    python3 archive.py show 123               # 查看会话 #123 的完整记录（含已归档部分）
+"""
+
+import argparse
+import asyncio
+import configparser
+import gzip
+import json
+import logging
+import os
+from collections import defaultdict
+from datetime import datetime, timedelta
+from typing import Any, Dict, List, NamedTuple, Tuple
+
+from media import media_label
+from storage import Storage
+
+logger = logging.getLogger(__name__)
+
+
+class ArchiveEntry(NamedTuple):
+    """一个会话在归档文件中的位置"""
+    conv_id: int
+    month: str
+    offset: int
+    length: int
+    count: int
+
+
+class MessageArchive:
+    """按月划分的只追加归档文件"""
+
+    def __init__(self, directory: str):
+        self.directory = directory
+
+    def path(self, month: str) -> str:
+        return os.path.join(self.directory, f"messages-{month}.jsonl.gz")
+
+    def append(self, month: str, conversations: List[Tuple[int, List[Dict[str, Any]]]]) -> List[ArchiveEntry]:
+        """把若干会话的消息追加到该月的归档文件，返回各会话的位置"""
+        os.makedirs(self.directory, exist_ok=True)
+        entries = []
+        with open(self.path(month), 'ab') as f:
+            offset = f.tell()
+            for conv_id, messages in conversations:
+                data = ''.join(json.dumps(m, ensure_ascii=False) + '\n' for m in messages).encode('utf-8')
+                member = gzip.compress(data)
+                f.write(member)
+                entries.append(ArchiveEntry(conv_id, month, offset, len(member), len(messages)))
+                offset += len(member)
+            f.flush()
+            os.fsync(f.fileno())
+        return entries
+
+    def read(self, entry: ArchiveEntry) -> List[Dict[str, Any]]:
+        """读取一个会话的归档消息"""
+        with open(self.path(entry.month), 'rb') as f:
+            f.seek(entry.offset)
+            data = gzip.decompress(f.read(entry.length))
+        return [json.loads(line) for line in data.decode('utf-8').splitlines() if line]
+
+
+def _message_record(row: tuple) -> Dict[str, Any]:
+    """get_messages 的一行转为归档记录（文字消息省略媒体字段）"""
+    message_id, conv_id, sender_id, content, timestamp, media_type, file_unique_id = row
+    record = {
+        'id': message_id, 'conv_id': conv_id, 'sender_id': sender_id,
+        'content': content, 'timestamp': timestamp,
+    }
+    if media_type:
+        record['media_type'] = media_type
+        record['file_unique_id'] = file_unique_id
+    return record
+
+
+def archive_cutoff(days: float) -> str:
+    """保留期的起点（UTC）"""
+    return (datetime.utcnow() - timedelta(days=days)).strftime('%Y-%m-%d %H:%M:%S')
+
+
+async def archive_conversations(storage: Storage, archive: MessageArchive, cutoff: str,
+                                batch_size: int = 200, pause: float = 0.05) -> Tuple[int, int]:
+    """归档 last_active 早于 cutoff 的已关闭会话，返回 (会话数, 消息数)"""
+    total_conversations = total_messages = 0
+    while True:
+        candidates = await storage.get_archive_candidates(cutoff, batch_size)
+        if not candidates:
+            break
+        rows = await storage.get_messages([conv_id for conv_id, _ in candidates])
+        messages: Dict[int, List[Dict[str, Any]]] = defaultdict(list)
+        for row in rows:
+            messages[row[1]].append(_message_record(row))
+
+        # 按会话创建月份分到各归档文件
+        by_month: Dict[str, List[Tuple[int, List[Dict[str, Any]]]]] = defaultdict(list)
+        for conv_id, created_at in candidates:
+            if messages.get(conv_id):
+                by_month[(created_at or '')[:7] or 'unknown'].append((conv_id, messages[conv_id]))
+        entries = []
+        for month, conversations in by_month.items():
+            entries.extend(await asyncio.to_thread(archive.append, month, conversations))
+
+        await storage.finish_archive([conv_id for conv_id, _ in candidates], entries)
+        total_conversations += len(candidates)
+        total_messages += len(rows)
+        # 批次之间让出写线程
+        await asyncio.sleep(pause)
+    return total_conversations, total_messages
+
+
+async def load_history(storage: Storage, archive: MessageArchive, conv_id: int) -> List[Dict[str, Any]]:
+    """会话的完整消息记录：已归档部分从归档文件读取，其余从数据库读取"""
+    entries = await storage.get_archive_entries(conv_id)
+    history = []
+    for entry in entries:
+        history.extend(await asyncio.to_thread(archive.read, ArchiveEntry(*entry)))
+    for row in await storage.get_messages([conv_id]):
+        history.append(_message_record(row))
+    history.sort(key=lambda m: m['id'])
+    return history
+
+
+def main():
+    """命令行入口"""
+    parser = argparse.ArgumentParser(description='消息归档')
+    parser.add_argument('--config', default='config.ini', help='配置文件（读取 db_path 和 archive_dir）')
+    sub = parser.add_subparsers(dest='command', required=True)
+    run_parser = sub.add_parser('run', help='立即归档超过保留期的已关闭会话')
+    run_parser.add_argument('--days', type=float, default=None, help='保留天数（默认取 archive_after_days）')
+    run_parser.add_argument('--vacuum', action='store_true',
+                            help='归档后执行 VACUUM 收缩数据库文件（会锁库一段时间，建议停机时执行）')
+    show_parser = sub.add_parser('show', help='查看会话的完整记录')
+    show_parser.add_argument('conv_id', type=int)
+    args = parser.parse_args()
+
+    logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
+    config = configparser.ConfigParser()
+    config.read(args.config, encoding='utf-8')
+    storage = Storage(config.get('SETTINGS', 'db_path', fallback='database.db'))
+    archive = MessageArchive(config.get('SETTINGS', 'archive_dir', fallback='archive'))
+    storage.init_schema()
+    try:
+        if args.command == 'run':
+            days = args.days if args.days is not None else config.getfloat('SETTINGS', 'archive_after_days', fallback=90)
+            conversations, messages = asyncio.run(archive_conversations(storage, archive, archive_cutoff(days)))
+            print(f"已归档 {conversations} 个会话，{messages} 条消息")
+            if args.vacuum:
+                storage.vacuum()
+        elif args.command == 'show':
+            for message in asyncio.run(load_history(storage, archive, args.conv_id)):
+                content = media_label(message.get('media_type'), message['content'])
+                print(f"[{message['timestamp']}] {message['sender_id']}: {content}")
+    finally:
+        storage.close()
+
+
+if __name__ == '__main__':
+    main()
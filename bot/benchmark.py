@@ -0,0 +1,330 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+性能测试工具
+用本地模拟的 Bot API 驱动 CustomerServiceBot 的处理器，模拟用户和管理员按设定速率发送消息，
+统计各处理器的吞吐量和 p50/p95/p99 延迟，结果保存为 JSON 便于前后对比
+
+用法：
+    python3 benchmark.py --users 200 --messages 10 --user-rate 100 --admin-rate 20 -o result.json
+"""
+
+import argparse
+import asyncio
+import configparser
+import itertools
+import json
+import logging
+import math
+import os
+import random
+import tempfile
+import time
+import types
+from collections import defaultdict
+from typing import Any, Dict, List, Optional
+
+from telegram import Update
+from telegram.request import BaseRequest
+
+from bot import CustomerServiceBot
+
+
+class FakeBot:
+    """模拟的 Bot API：记录所有调用并返回带 message_id 的结果"""
+
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.id = 1
+        self.username = 'benchmark_bot'
+        self.defaults = None
+        self.calls: Dict[str, int] = defaultdict(int)
+        # chat_id -> 带按钮的消息ID（即管理员通知）
+        self.notifications: Dict[int, List[int]] = defaultdict(list)
+        self._message_ids = itertools.count(1000)
+
+    def __getattr__(self, method: str):
+        if method.startswith('_'):
+            raise AttributeError(method)
+
+        async def call(*args, **kwargs):
+            self.calls[method] += 1
+            if self.latency:
+                await asyncio.sleep(self.latency)
+            if method == 'answer_callback_query':
+                return True
+            message_id = kwargs.get('message_id') if method.startswith('edit_') else next(self._message_ids)
+            chat_id = kwargs.get('chat_id')
+            if kwargs.get('reply_markup') is not None and not method.startswith('edit_'):
+                self.notifications[chat_id].append(message_id)
+            return types.SimpleNamespace(message_id=message_id, chat_id=chat_id)
+
+        return call
+
+
+class FakeRequest(BaseRequest):
+    """模拟的 HTTP 层，供真实的 Bot / Application 使用；与 HTTPXRequest 一样，shutdown 之后的请求失败"""
+
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.initialized = False
+        self.calls: Dict[str, int] = defaultdict(int)
+        # 已发送的文本消息
+        self.texts: List[str] = []
+        self._message_ids = itertools.count(1000)
+
+    async def initialize(self):
+        self.initialized = True
+
+    async def shutdown(self):
+        self.initialized = False
+
+    async def do_request(self, url, method, request_data=None, read_timeout=None, write_timeout=None,
+                         connect_timeout=None, pool_timeout=None):
+        if not self.initialized:
+            raise RuntimeError('This HTTPXRequest is not initialized!')
+        endpoint = url.rsplit('/', 1)[-1]
+        params = request_data.parameters if request_data else {}
+        if self.latency and endpoint != 'getMe':
+            await asyncio.sleep(self.latency)
+        self.calls[endpoint] += 1
+        if endpoint == 'getMe':
+            result: Any = {'id': 1, 'is_bot': True, 'first_name': 'benchmark', 'username': 'benchmark_bot'}
+        elif endpoint == 'sendMessage':
+            self.texts.append(params.get('text'))
+            result = {
+                'message_id': next(self._message_ids),
+                'date': int(time.time()),
+                'chat': {'id': params.get('chat_id', 0), 'type': 'private'},
+                'text': params.get('text'),
+            }
+        else:
+            result = True
+        return 200, json.dumps({'ok': True, 'result': result}).encode()
+
+
+class UpdateFactory:
+    """生成 Update 对象"""
+
+    def __init__(self, bot: FakeBot):
+        self.bot = bot
+        self._update_ids = itertools.count(1)
+        self._message_ids = itertools.count(1)
+
+    def _user(self, user_id: int) -> Dict[str, Any]:
+        return {'id': user_id, 'is_bot': False, 'first_name': f'用户{user_id}', 'username': f'user{user_id}'}
+
+    def _message(self, user_id: int, text: str, reply_to: Optional[int] = None) -> Dict[str, Any]:
+        message = {
+            'message_id': next(self._message_ids),
+            'date': int(time.time()),
+            'chat': {'id': user_id, 'type': 'private'},
+            'from': self._user(user_id),
+            'text': text,
+        }
+        if reply_to is not None:
+            message['reply_to_message'] = {
+                'message_id': reply_to,
+                'date': int(time.time()),
+                'chat': {'id': user_id, 'type': 'private'},
+                'text': '',
+            }
+        return message
+
+    def message(self, user_id: int, text: str, reply_to: Optional[int] = None) -> Update:
+        """文本消息（可回复某条消息）"""
+        data = {'update_id': next(self._update_ids), 'message': self._message(user_id, text, reply_to)}
+        return Update.de_json(data, self.bot)
+
+    def callback(self, user_id: int, data: str) -> Update:
+        """按钮回调"""
+        payload = {
+            'update_id': next(self._update_ids),
+            'callback_query': {
+                'id': str(next(self._update_ids)),
+                'from': self._user(user_id),
+                'chat_instance': str(user_id),
+                'data': data,
+                'message': self._message(user_id, ''),
+            },
+        }
+        return Update.de_json(payload, self.bot)
+
+
+def percentile(samples: List[float], q: float) -> float:
+    """最近秩百分位数"""
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    index = max(0, math.ceil(q / 100 * len(ordered)) - 1)
+    return ordered[index]
+
+
+class Benchmark:
+    """性能测试"""
+
+    def __init__(self, config_file: str, workdir: str, users: int, messages: int,
+                 user_rate: float, admin_rate: float, api_latency: float, telegram_limits: bool):
+        self.users = users
+        self.messages = messages
+        self.user_rate = user_rate
+        self.admin_rate = admin_rate
+        self.workdir = workdir
+
+        config = configparser.ConfigParser()
+        config.read(config_file, encoding='utf-8')
+        if 'SETTINGS' not in config:
+            config['SETTINGS'] = {}
+        config['SETTINGS']['db_path'] = os.path.join(workdir, 'benchmark.db')
+        # 模拟用户的发送频率远超真人，不做入站限流
+        if 'RATE_LIMIT' not in config:
+            config['RATE_LIMIT'] = {}
+        config['RATE_LIMIT']['enabled'] = 'false'
+        if not telegram_limits:
+            # 模拟的 API 没有频率限制
+            config['SETTINGS']['send_global_rate'] = '100000'
+            config['SETTINGS']['send_chat_rate'] = '100000'
+        bench_config = os.path.join(workdir, 'config.ini')
+        with open(bench_config, 'w', encoding='utf-8') as f:
+            config.write(f)
+
+        self.fake_bot = FakeBot(api_latency)
+        self.updates = UpdateFactory(self.fake_bot)
+        self.bot = CustomerServiceBot(bench_config)
+        self.context = types.SimpleNamespace(bot=self.fake_bot)
+        self.latencies: Dict[str, List[float]] = defaultdict(list)
+        self.errors: Dict[str, int] = defaultdict(int)
+
+    async def _timed(self, name: str, update: Update):
+        handler = getattr(self.bot, name)
+        start = time.perf_counter()
+        try:
+            await handler(update, self.context)
+        except Exception:
+            self.errors[name] += 1
+        self.latencies[name].append(time.perf_counter() - start)
+
+    async def _user(self, user_id: int, interval: float):
+        admin_ids = list(self.bot.admins.values())
+        await self._timed('start_command', self.updates.message(user_id, '/start'))
+        await self._timed('button_callback', self.updates.callback(user_id, f"admin_{random.choice(admin_ids)}"))
+        for i in range(self.messages):
+            await asyncio.sleep(random.expovariate(1 / interval) if interval else 0)
+            text = f"问题 {i}：订单 {random.randint(1, 10 ** 6)} 的状态"
+            await self._timed('handle_user_message', self.updates.message(user_id, text))
+
+    async def _admin(self, admin_id: int, interval: float, done: asyncio.Event):
+        while not done.is_set():
+            await asyncio.sleep(random.expovariate(1 / interval) if interval else 0)
+            notifications = self.fake_bot.notifications.get(admin_id)
+            if not notifications:
+                continue
+            reply_to = random.choice(notifications[-50:])
+            await self._timed('handle_admin_message', self.updates.message(admin_id, '您好，已为您处理。', reply_to))
+
+    async def run(self) -> Dict[str, Any]:
+        application = types.SimpleNamespace(bot=self.fake_bot)
+        await self.bot._post_init(application)
+
+        # 平均到每个用户/管理员的发送间隔
+        user_interval = self.users / self.user_rate if self.user_rate else 0
+        admin_ids = list(self.bot.admins.values())
+        admin_interval = len(admin_ids) / self.admin_rate if self.admin_rate else 0
+
+        done = asyncio.Event()
+        admins = [asyncio.create_task(self._admin(a, admin_interval, done)) for a in admin_ids] if self.admin_rate else []
+        start = time.perf_counter()
+        users = []
+        for user_id in range(1, self.users + 1):
+            users.append(asyncio.create_task(self._user(10 ** 9 + user_id, user_interval)))
+            if user_interval:
+                await asyncio.sleep(random.expovariate(self.user_rate))
+        await asyncio.gather(*users)
+        done.set()
+        await asyncio.gather(*admins)
+        elapsed = time.perf_counter() - start
+
+        drain_start = time.perf_counter()
+        await self.bot.outbox.stop(timeout=30)
+        await self.bot.write_behind.flush()
+        drain = time.perf_counter() - drain_start
+        await self.bot._post_shutdown(application)
+        return self._report(elapsed, drain)
+
+    def _report(self, elapsed: float, drain: float) -> Dict[str, Any]:
+        handlers = {}
+        total = 0
+        for name, samples in self.latencies.items():
+            total += len(samples)
+            handlers[name] = {
+                'count': len(samples),
+                'errors': self.errors.get(name, 0),
+                'throughput': round(len(samples) / elapsed, 1) if elapsed else 0,
+                'p50_ms': round(percentile(samples, 50) * 1000, 3),
+                'p95_ms': round(percentile(samples, 95) * 1000, 3),
+                'p99_ms': round(percentile(samples, 99) * 1000, 3),
+                'max_ms': round(max(samples) * 1000, 3),
+            }
+
+        db_path = self.bot.db_path
+        db_size = sum(os.path.getsize(path) for path in (db_path, db_path + '-wal') if os.path.exists(path))
+        return {
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'params': {
+                'users': self.users,
+                'messages': self.messages,
+                'user_rate': self.user_rate,
+                'admin_rate': self.admin_rate,
+                'api_latency_ms': self.fake_bot.latency * 1000,
+            },
+            'elapsed_s': round(elapsed, 3),
+            'drain_s': round(drain, 3),
+            'throughput': round(total / elapsed, 1) if elapsed else 0,
+            'handlers': handlers,
+            'api_calls': dict(self.fake_bot.calls),
+            'db_size_bytes': db_size,
+        }
+
+
+def print_report(report: Dict[str, Any]):
+    """打印结果表格"""
+    print(f"总耗时 {report['elapsed_s']}s，吞吐量 {report['throughput']} 更新/秒，"
+          f"出站排空 {report['drain_s']}s，数据库 {report['db_size_bytes'] / 1024:.1f} KB")
+    print(f"{'处理器':<24}{'次数':>8}{'错误':>6}{'p50(ms)':>10}{'p95(ms)':>10}{'p99(ms)':>10}{'max(ms)':>10}")
+    for name, stats in report['handlers'].items():
+        print(f"{name:<24}{stats['count']:>8}{stats['errors']:>6}{stats['p50_ms']:>10}"
+              f"{stats['p95_ms']:>10}{stats['p99_ms']:>10}{stats['max_ms']:>10}")
+
+
+def main():
+    """命令行入口"""
+    parser = argparse.ArgumentParser(description='客服机器人性能测试')
+    parser.add_argument('--config', default='config.ini', help='配置文件（使用其中的管理员配置）')
+    parser.add_argument('--users', type=int, default=200, help='模拟用户数')
+    parser.add_argument('--messages', type=int, default=10, help='每个用户发送的消息数')
+    parser.add_argument('--user-rate', type=float, default=100, help='所有用户合计每秒消息数（0 为不限速）')
+    parser.add_argument('--admin-rate', type=float, default=20, help='所有管理员合计每秒回复数（0 为不回复）')
+    parser.add_argument('--api-latency-ms', type=float, default=0, help='模拟 Bot API 的调用延迟')
+    parser.add_argument('--telegram-limits', action='store_true', help='保留出站发送的频率限制')
+    parser.add_argument('--seed', type=int, default=None, help='随机种子')
+    parser.add_argument('-o', '--output', help='结果 JSON 文件')
+    args = parser.parse_args()
+
+    logging.getLogger().setLevel(logging.WARNING)
+    if args.seed is not None:
+        random.seed(args.seed)
+
+    with tempfile.TemporaryDirectory() as workdir:
+        benchmark = Benchmark(args.config, workdir, args.users, args.messages, args.user_rate,
+                              args.admin_rate, args.api_latency_ms / 1000, args.telegram_limits)
+        report = asyncio.run(benchmark.run())
+
+    print_report(report)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"结果已保存到 {args.output}")
+
+
+if __name__ == '__main__':
+    main()
@@ -7,13 +7,43 @@
 
 import asyncio
 import logging
-import sqlite3
+import os
+import signal
+import time
 import configparser
-from datetime import datetime, timedelta
-from typing import Dict, Optional, Tuple
+import functools
+import tempfile
+from pathlib import Path
+from typing import Awaitable, Callable, Dict, List, Mapping, Optional, Set, Tuple, Union
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import Application, CommandHandler, MessageHandler, CallbackQueryHandler, filters, ContextTypes
 
+from admin_table import build_admin_table
+from analytics import ADMIN, AUTO, SYSTEM, USER, format_report, merge_stats, recent_period
+from admission import BLOCKED, OVERLOADED, Admission, AdmissionController
+from archive import MessageArchive, archive_conversations, archive_cutoff, load_history
+from burst import Burst, BurstCoalescer
+from conversation_index import ConversationIndex
+from dedup import STATE_KEY, UpdateDeduplicator
+from expiry import ExpiryScheduler
+from export import export, parse_command_args
+from faq import FaqResponder, FaqRule
+from inbox import AdminInbox, InboxRelay
+from journal import Journal, decode_kwargs
+from locks import KeyedLock
+from media import CAPTIONLESS_TYPES, MediaCache, MediaDescriptor, describe, fit_caption, media_label
+from metrics import (
+    CALL_SECONDS, EXPIRED_CONVERSATIONS, FAQ_REPLIES, HANDLER_ERRORS, HANDLER_SECONDS, REGISTRY, MetricsServer, timed
+)
+from notification_map import NotificationMap
+from outbox import OutboundDispatcher
+from routing import AdminRouter
+from search import SearchHit, SearchSession, like_pattern, merge_hits, snippet, split_terms
+from sharding import SHARD_STRIDE, Shard, apply_shard, shard_db_paths
+from storage import Storage
+from webhook import WebhookServer
+from write_behind import WriteBehindQueue
+
 # 配置日志
 logging.basicConfig(
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
@@ -21,86 +51,282 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# 以 copy_message 转发的媒体消息
+MEDIA_FILTER = (
+    filters.PHOTO | filters.VIDEO | filters.ANIMATION | filters.Document.ALL | filters.AUDIO
+    | filters.VOICE | filters.VIDEO_NOTE | filters.Sticker.ALL
+)
+
+def deduplicated(handler: Callable[..., Awaitable]) -> Callable[..., Awaitable]:
+    """重复投递的更新（崩溃重启或 webhook 重试）直接丢弃，处理完成后记下 update_id；
+    处理失败的更新不记下，重新投递时再次处理"""
+    @functools.wraps(handler)
+    async def wrapper(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        if not self.dedup.begin(update.update_id):
+            logger.info(f"丢弃重复投递的更新 {update.update_id}")
+            return None
+        try:
+            result = await handler(self, update, context)
+        except Exception:
+            self.dedup.failed(update.update_id)
+            raise
+        self.dedup.done(update.update_id)
+        return result
+    return wrapper
+
+def admitted(handler: Callable[..., Awaitable]) -> Callable[..., Awaitable]:
+    """用户的更新先经过入站限流（管理员不受限），被拒绝的更新不加锁、不访问数据库"""
+    @functools.wraps(handler)
+    async def wrapper(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        user = update.effective_user
+        if self.admission and user is not None and user.id not in self.admin_table.ids:
+            admission = self.admission.check(user.id, time.monotonic())
+            if not admission.allowed:
+                self._reject_update(update, admission)
+                return None
+        return await handler(self, update, context)
+    return wrapper
+
+def per_user(handler: Callable[..., Awaitable]) -> Callable[..., Awaitable]:
+    """同一用户的更新按到达顺序依次处理，不同用户的更新并发处理"""
+    @functools.wraps(handler)
+    async def wrapper(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        user = update.effective_user
+        if user is None:
+            return await handler(self, update, context)
+        async with self.user_locks.hold(user.id):
+            return await handler(self, update, context)
+    return wrapper
+
 class CustomerServiceBot:
-    def __init__(self, config_file: str = 'config.ini'):
-        """初始化机器人"""
+    def __init__(self, config_file: str = 'config.ini', shard: Optional[Shard] = None, inbox_events=None):
+        """初始化机器人；shard 为多进程分片模式下本进程负责的分片，inbox_events 为发往主进程收件箱的事件队列"""
+        self.config_file = config_file
+        self.shard = shard
         self.config = self._load_config(config_file)
         self.bot_token = self.config.get('BOT', 'token')
-        self.admins = self._parse_admins()
-        self.db_path = 'database.db'
+        # 管理员路由表，配置重新加载时整体替换
+        self.admin_table = build_admin_table(self.config)
+        # 所有管理员命令和管理员消息处理器共用的过滤器，重新加载时更新其中的ID
+        self.admin_filter = filters.User(user_id=self.admin_table.ids)
+        self.router = AdminRouter(
+            self.admin_table.names.values(),
+            weights=self.admin_table.weights,
+            mode=self.admin_table.routing_mode
+        )
+        # 分片模式下每个分片一个数据库文件；其他分片的数据库只读，用于汇总搜索、统计和导出
+        self.db_paths = shard_db_paths(
+            self.config.get('SETTINGS', 'db_path', fallback='database.db'), shard.count if shard else 1
+        )
+        self.db_path = self.db_paths[shard.index if shard else 0]
+        self.storage = Storage(self.db_path, readers=self.config.getint('SETTINGS', 'db_readers', fallback=2))
+        self.peers = [Storage(path, readers=1, read_only=True) for path in self.db_paths if path != self.db_path]
+        self.write_behind = WriteBehindQueue(
+            self.storage,
+            flush_interval=self.config.getint('SETTINGS', 'write_batch_interval_ms', fallback=50) / 1000,
+            batch_size=self.config.getint('SETTINGS', 'write_batch_size', fallback=500),
+            max_pending=self.config.getint('SETTINGS', 'write_queue_size', fallback=10000)
+        )
+        self.conversations = ConversationIndex()
+        self.notifications = NotificationMap(
+            self.storage, self.write_behind,
+            capacity=self.config.getint('SETTINGS', 'notification_cache_size', fallback=10000)
+        )
+        self.media_cache = MediaCache(
+            self.write_behind,
+            capacity=self.config.getint('SETTINGS', 'media_cache_size', fallback=10000)
+        )
+        # 用户连续发送的文字消息合并到同一条管理员通知
+        self.bursts = BurstCoalescer(
+            self.config.getfloat('SETTINGS', 'burst_window_seconds', fallback=3),
+            on_edit=self._edit_burst,
+            edit_delay=self.config.getfloat('SETTINGS', 'burst_edit_delay_seconds', fallback=1)
+        )
+        # 并发处理更新：同一用户的更新依次处理，同一会话的修改（转发、回复、超时关闭）互斥
+        self.user_locks = KeyedLock()
+        self.conversation_locks = KeyedLock()
+        self.admission = self._build_admission()
+        self._config_mtime = self._stat_config()
+        self._config_task: Optional[asyncio.Task] = None
+        self._reload_requested = asyncio.Event()
+        # 管理员通过“回复用户”按钮选定的会话: admin_id -> conv_id
+        self.reply_targets: Dict[int, int] = {}
+        self.session_timeout = self.config.getint('SETTINGS', 'session_timeout', fallback=30)
+        self.expiry = ExpiryScheduler(
+            self.session_timeout * 60,
+            get_last_active=self._get_last_active,
+            on_expire=self._expire_conversations
+        )
+        self.outbox = OutboundDispatcher(
+            self.storage,
+            workers=self.config.getint('SETTINGS', 'send_workers', fallback=8),
+            global_rate=self.config.getfloat('SETTINGS', 'send_global_rate', fallback=30),
+            chat_rate=self.config.getfloat('SETTINGS', 'send_chat_rate', fallback=1),
+            max_retries=self.config.getint('SETTINGS', 'send_max_retries', fallback=5),
+            # 分片模式下各分片都向管理员发送，只使用分到的那份每聊天速率（见 sharding.apply_shard）
+            shared_chat_rate=self.config.getfloat('SETTINGS', 'send_admin_chat_rate', fallback=0) or None,
+            is_shared_chat=lambda chat_id: chat_id in self.admin_table.ids
+        )
+        # 停机时未发出的调用写入日志，下次启动时重放
+        self.journal = Journal(
+            self.config.get('SETTINGS', 'journal_path', fallback='')
+            or os.path.join(os.path.dirname(os.path.abspath(self.db_path)), 'outbox.journal')
+        )
+        # 停机时排空出站队列等工作的总期限（秒）
+        self.shutdown_timeout = self.config.getfloat('SETTINGS', 'shutdown_timeout', fallback=30)
+        # 摘要模式：每个管理员一条定时刷新的收件箱消息代替逐条通知
+        self.inbox: Optional[Union[AdminInbox, InboxRelay]] = None
+        if self.config.getboolean('SETTINGS', 'admin_inbox', fallback=False):
+            if inbox_events is not None:
+                # 分片模式：收件箱由主进程统一维护，每个管理员只有一条收件箱消息
+                self.inbox = InboxRelay(inbox_events)
+            else:
+                self.inbox = AdminInbox(
+                    self.outbox,
+                    interval=self.config.getfloat('SETTINGS', 'inbox_refresh_seconds', fallback=3)
+                )
+        self.application: Optional[Application] = None
+        self.metrics_server: Optional[MetricsServer] = None
+        # 管理员最近一次搜索（关键词和各页起点，用于翻页）: admin_id -> SearchSession
+        self.search_queries: Dict[int, SearchSession] = {}
+        self.search_page_size = self.config.getint('SETTINGS', 'search_page_size', fallback=10)
+        # 关键词都太短、无法使用全文索引时，只扫描每个数据库最近的这么多条消息
+        self.search_scan_messages = self.config.getint('SETTINGS', 'search_scan_messages', fallback=100000)
+        self._backfill_task: Optional[asyncio.Task] = None
+        self.archive = MessageArchive(self.config.get('SETTINGS', 'archive_dir', fallback='archive'))
+        # 已关闭会话保留在数据库中的天数，0 为不归档
+        self.archive_after_days = self.config.getfloat('SETTINGS', 'archive_after_days', fallback=0)
+        self._archive_task: Optional[asyncio.Task] = None
+        # 常见问题自动回复（[FAQ] enabled = true 时启用）
+        self.faq: Optional[FaqResponder] = None
+        if self.config.getboolean('FAQ', 'enabled', fallback=False):
+            self.faq = FaqResponder(self.config.get('FAQ', 'rules_file', fallback='faq.ini'), self.admins)
+            self.faq.load()
+        # 自动回复的问答是否记入会话
+        self.faq_log = self.config.getboolean('FAQ', 'log_replies', fallback=True)
+        self._faq_task: Optional[asyncio.Task] = None
+        # 已处理的 update_id，重启后恢复
+        self.dedup = UpdateDeduplicator(self.config.getint('SETTINGS', 'update_dedup_capacity', fallback=10000))
+        self._dedup_task: Optional[asyncio.Task] = None
+        # webhook 模式下处理失败的更新（由错误处理器记录），用于返回非 2xx 让 Telegram 重新投递
+        self._failed_updates: Optional[Set[int]] = None
+        self._drained = False
+        self._register_metrics()
         self._init_database()
         
     def _load_config(self, config_file: str) -> configparser.ConfigParser:
         """加载配置文件"""
         config = configparser.ConfigParser()
         config.read(config_file, encoding='utf-8')
+        if self.shard:
+            apply_shard(config, self.shard)
         return config
     
-    def _parse_admins(self) -> Dict[str, int]:
-        """解析管理员配置"""
-        admins = {}
-        if 'ADMINS' in self.config:
-            for name, user_id in self.config['ADMINS'].items():
+    @property
+    def admins(self) -> Mapping[str, int]:
+        """管理员显示名称 -> 用户ID"""
+        return self.admin_table.names
+    
+    async def reload_config(self) -> bool:
+        """重新加载配置文件，重建管理员路由表后整体替换，不暂停更新处理；失败时保留原配置
+
+        管理员、分配权重、分配模式和 FAQ 规则立即生效；数据库、发送、限流等参数在启动时使用，修改后需重启
+        """
+        try:
+            config = await asyncio.to_thread(self._load_config, self.config_file)
+            table = build_admin_table(config)
+        except (configparser.Error, ValueError) as e:
+            logger.error(f"重新加载配置失败，继续使用原配置: {e}")
+            return False
+        if not table.ids:
+            logger.error("新配置中没有有效的管理员，继续使用原配置")
+            return False
+        
+        removed = self.admin_table.ids - table.ids
+        self.config = config
+        self.admin_table = table
+        self.admin_filter.user_ids = table.ids
+        self.router.reconfigure(table.names.values(), table.weights, table.routing_mode)
+        for admin_id in removed:
+            self.reply_targets.pop(admin_id, None)
+        if self.faq:
+            await self.faq.set_admins(table.names)
+        self._config_mtime = self._stat_config()
+        logger.info(f"配置已重新加载，管理员 {len(table.ids)} 个")
+        return True
+    
+    def _stat_config(self) -> Optional[float]:
+        try:
+            return os.path.getmtime(self.config_file)
+        except OSError:
+            return None
+    
+    async def _watch_config(self):
+        """配置文件修改或收到 SIGHUP 时重新加载"""
+        interval = self.config.getfloat('SETTINGS', 'config_reload_interval', fallback=5)
+        while True:
+            try:
+                await asyncio.wait_for(self._reload_requested.wait(), interval)
+            except asyncio.TimeoutError:
+                pass
+            requested = self._reload_requested.is_set()
+            self._reload_requested.clear()
+            mtime = self._stat_config()
+            if requested or (mtime is not None and mtime != self._config_mtime):
+                self._config_mtime = mtime
                 try:
-                    admins[name] = int(user_id)
-                except ValueError:
-                    logger.error(f"无效的管理员ID: {name} = {user_id}")
-        return admins
+                    await self.reload_config()
+                except Exception as e:
+                    logger.error(f"重新加载配置失败: {e}")
+    
+    def _build_admission(self) -> Optional[AdmissionController]:
+        """入站限流（[RATE_LIMIT] enabled = false 时关闭）"""
+        if not self.config.getboolean('RATE_LIMIT', 'enabled', fallback=True):
+            return None
+        section = 'RATE_LIMIT'
+        max_outbox_pending = self.config.getint(section, 'max_outbox_pending', fallback=5000)
+        return AdmissionController(
+            user_rate=self.config.getfloat(section, 'user_rate', fallback=1),
+            user_burst=self.config.getfloat(section, 'user_burst', fallback=5),
+            global_rate=self.config.getfloat(section, 'global_rate', fallback=100),
+            global_burst=self.config.getfloat(section, 'global_burst', fallback=200),
+            strikes=self.config.getint(section, 'strikes', fallback=20),
+            strike_window=self.config.getfloat(section, 'strike_window', fallback=60),
+            block_seconds=self.config.getfloat(section, 'block_minutes', fallback=30) * 60,
+            notice_interval=self.config.getfloat(section, 'notice_interval', fallback=10),
+            # 出站队列积压说明管理员通知已经发不过来，继续接收只会让积压更严重
+            is_overloaded=(lambda: self.outbox.pending > max_outbox_pending) if max_outbox_pending > 0 else None
+        )
+    
+    def _register_metrics(self):
+        """注册抓取时读取的仪表"""
+        def active_conversations():
+            names = self.admin_table.by_id
+            counts = self.conversations.admin_counts()
+            return {(names.get(admin_id, str(admin_id)),): counts.get(admin_id, 0)
+                    for admin_id in set(names) | set(counts)}
+        
+        REGISTRY.gauge('bot_active_conversations', '各管理员的活跃会话数', active_conversations, ('admin',))
+        REGISTRY.gauge('bot_write_queue_pending', '等待批量写入的记录数', lambda: self.write_behind.pending)
+        REGISTRY.gauge('bot_outbox_pending', '等待发送的出站调用数', lambda: self.outbox.pending)
+        REGISTRY.gauge('bot_expiry_scheduled', '超时调度堆中的条目数', lambda: len(self.expiry))
+        if self.admission:
+            REGISTRY.gauge('bot_blocked_users', '被自动拉黑的用户数', lambda: self.admission.blocked_count)
     
     def _init_database(self):
         """初始化数据库"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
-        # 创建会话表
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS conversations (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER NOT NULL,
-                admin_id INTEGER NOT NULL,
-                status TEXT DEFAULT 'active',
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                last_active TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
-        
-        # 创建消息表
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS messages (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                conv_id INTEGER NOT NULL,
-                sender_id INTEGER NOT NULL,
-                content TEXT NOT NULL,
-                timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY (conv_id) REFERENCES conversations (id)
-            )
-        ''')
-        
-        conn.commit()
-        conn.close()
-        logger.info("数据库初始化完成")
+        self.storage.init_schema()
+        if self.shard and self.shard.index:
+            self.storage.reserve_conversation_ids(self.shard.index * SHARD_STRIDE)
+        self.conversations.load(self.storage.load_active_conversations())
+        for _, entry in self.conversations.items():
+            self.expiry.schedule(entry.conv_id, entry.last_active)
+        self.dedup.load(self.storage.get_state(STATE_KEY))
+        logger.info(f"数据库初始化完成，活跃会话 {len(self.conversations)} 个")
     
     def _get_admin_keyboard(self) -> InlineKeyboardMarkup:
-        """生成管理员选择键盘"""
-        keyboard = []
-        row = []
-        
-        for i, (name, user_id) in enumerate(self.admins.items()):
-            row.append(InlineKeyboardButton(
-                text=name,
-                callback_data=f"admin_{user_id}"
-            ))
-            
-            # 每3个按钮换一行
-            if (i + 1) % 3 == 0:
-                keyboard.append(row)
-                row = []
-        
-        # 处理最后一行
-        if row:
-            keyboard.append(row)
-        
-        return InlineKeyboardMarkup(keyboard)
+        """管理员选择键盘（随路由表预先生成）"""
+        return self.admin_table.keyboard
     
     def _mask_phone(self, phone: str) -> str:
         """脱敏处理电话号码"""
@@ -126,114 +352,178 @@ class CustomerServiceBot:
             info += f"\n联系方式: {self._mask_phone(phone)}"
         return info
     
+    def _user_label(self, user_id: int, username: Optional[str]) -> str:
+        """收件箱中显示的用户名称"""
+        return f"@{username}" if username else f"用户 {user_id}"
+    
+    @timed(CALL_SECONDS, call='get_active_conversation')
     def _get_active_conversation(self, user_id: int) -> Optional[Tuple[int, int]]:
-        """获取用户活跃会话"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-            SELECT id, admin_id FROM conversations 
-            WHERE user_id = ? AND status = 'active'
-            ORDER BY last_active DESC LIMIT 1
-        ''', (user_id,))
-        
-        result = cursor.fetchone()
-        conn.close()
-        
-        return result if result else None
-    
-    def _create_conversation(self, user_id: int, admin_id: int) -> int:
-        """创建新会话"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-            INSERT INTO conversations (user_id, admin_id, status, created_at, last_active)
-            VALUES (?, ?, 'active', CURRENT_TIMESTAMP, CURRENT_TIMESTAMP)
-        ''', (user_id, admin_id))
-        
-        conv_id = cursor.lastrowid
-        conn.commit()
-        conn.close()
-        
-        return conv_id
-    
-    def _save_message(self, conv_id: int, sender_id: int, content: str):
-        """保存消息到数据库"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-            INSERT INTO messages (conv_id, sender_id, content, timestamp)
-            VALUES (?, ?, ?, CURRENT_TIMESTAMP)
-        ''', (conv_id, sender_id, content))
-        
-        # 更新会话最后活跃时间
-        cursor.execute('''
-            UPDATE conversations 
-            SET last_active = CURRENT_TIMESTAMP 
-            WHERE id = ?
-        ''', (conv_id,))
-        
-        conn.commit()
-        conn.close()
-    
-    def _close_conversation(self, conv_id: int):
-        """关闭会话"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-            UPDATE conversations 
-            SET status = 'closed' 
-            WHERE id = ?
-        ''', (conv_id,))
-        
-        conn.commit()
-        conn.close()
-    
-    def _check_timeout_conversations(self):
-        """检查并关闭超时会话"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
-        # 查找30分钟未活跃的会话
-        timeout_time = datetime.now() - timedelta(minutes=30)
-        cursor.execute('''
-            SELECT id, user_id, admin_id FROM conversations 
-            WHERE status = 'active' AND last_active < ?
-        ''', (timeout_time,))
-        
-        timeout_convs = cursor.fetchall()
-        
-        for conv_id, user_id, admin_id in timeout_convs:
-            # 关闭会话
-            cursor.execute('''
-                UPDATE conversations 
-                SET status = 'closed' 
-                WHERE id = ?
-            ''', (conv_id,))
-            
-            # 通知用户和管理员
-            try:
-                asyncio.create_task(self._notify_timeout(user_id, admin_id))
-            except Exception as e:
-                logger.error(f"通知超时会话失败: {e}")
+        """获取用户活跃会话（内存索引）"""
+        entry = self.conversations.get(user_id)
+        return (entry.conv_id, entry.admin_id) if entry else None
+    
+    @timed(CALL_SECONDS, call='create_conversation')
+    async def _create_conversation(self, user_id: int, admin_id: int) -> Tuple[int, bool]:
+        """创建新会话（幂等），返回 (conv_id, 是否新建)
+
+        用户已有与该管理员的活跃会话时直接返回该会话；与其他管理员的会话由存储层关闭
+        """
+        current = self.conversations.get(user_id)
+        if current:
+            # 等待正在进行的超时关闭完成：关闭提交前数据库中的会话仍是活跃的，不能被当作已有会话返回
+            async with self.conversation_locks.hold(current.conv_id):
+                current = self.conversations.get(user_id)
+        if current and current.admin_id == admin_id:
+            return current.conv_id, False
+        conv_id = await self.storage.create_conversation(user_id, admin_id)
+        if self.conversations.get_by_conv(conv_id):
+            return conv_id, False
+        if current:
+            self._forget_conversation(current.conv_id)
+        now = time.time()
+        self.conversations.add(user_id, conv_id, admin_id, now)
+        self.expiry.schedule(conv_id, now)
+        return conv_id, True
+    
+    @timed(CALL_SECONDS, call='faq_match')
+    def _match_faq(self, text: Optional[str], admin_id: Optional[int]) -> Optional[FaqRule]:
+        """匹配自动回复规则（媒体消息不匹配）"""
+        if not self.faq or not text:
+            return None
+        return self.faq.match(text, admin_id)
+    
+    @timed(CALL_SECONDS, call='save_message')
+    async def _save_message(self, conv_id: int, sender_id: int, content: str,
+                            media: Optional[MediaDescriptor] = None, *, admin_id: int, kind: str,
+                            source: Optional[Tuple[int, int]] = None):
+        """保存消息到数据库（批量写回）并计入会话管理员的统计；媒体消息只保存描述，content 为说明文字。
+        source 为消息在 Telegram 中的 (chat_id, message_id)，重复投递的同一条消息只保存一次"""
+        self.conversations.touch(conv_id, time.time())
+        if media:
+            await self.media_cache.remember(media)
+            await self.write_behind.put_message(conv_id, sender_id, content, media.media_type, media.file_unique_id,
+                                                admin_id=admin_id, kind=kind, source=source)
+        else:
+            await self.write_behind.put_message(conv_id, sender_id, content, admin_id=admin_id, kind=kind,
+                                                source=source)
+    
+    @timed(CALL_SECONDS, call='close_conversation')
+    def _forget_conversation(self, conv_id: int):
+        """从内存状态中移除会话"""
+        self.conversations.remove(conv_id)
+        self.router.forget(conv_id)
+        self.bursts.forget(conv_id)
+        if self.inbox:
+            self.inbox.remove(conv_id)
+        for admin_id, target in list(self.reply_targets.items()):
+            if target == conv_id:
+                del self.reply_targets[admin_id]
+    
+    def _reply_keyboard(self, conv_id: int) -> InlineKeyboardMarkup:
+        """管理员通知上的“回复用户”按钮"""
+        return InlineKeyboardMarkup([[
+            InlineKeyboardButton("💬 回复用户", callback_data=f"reply_{conv_id}")
+        ]])
+    
+    def _notify_admin(self, admin_id: int, conv_id: int, text: str,
+                      on_failed: Optional[Callable[[Exception], Awaitable[None]]] = None,
+                      media: Optional[MediaDescriptor] = None, source: Optional[Tuple[int, int]] = None,
+                      burst: Optional[Burst] = None):
+        """加入管理员通知，发送成功后记录其 message_id 与会话的对应关系
         
-        conn.commit()
-        conn.close()
+        媒体消息从 source (chat_id, message_id) 复制，text 作为说明文字；
+        burst 为该通知对应的消息合并窗口
+        """
+        keyboard = self._reply_keyboard(conv_id)
         
-        if timeout_convs:
-            logger.info(f"关闭了 {len(timeout_convs)} 个超时会话")
+        async def record(sent):
+            await self.notifications.record(admin_id, sent.message_id, conv_id)
+            if burst:
+                self.bursts.sent(burst, sent.message_id)
+        
+        if media:
+            self._copy_media(admin_id, media, source, text, reply_markup=keyboard, on_sent=record, on_failed=on_failed)
+        else:
+            self.outbox.send_message(admin_id, text, reply_markup=keyboard, on_sent=record, on_failed=on_failed)
     
-    async def _notify_timeout(self, user_id: int, admin_id: int):
+    def _edit_burst(self, burst: Burst):
+        """把合并窗口内的新消息编辑进原通知"""
+        self.outbox.enqueue(
+            'edit_message_text', burst.admin_id,
+            message_id=burst.message_id,
+            text=burst.render(),
+            reply_markup=self._reply_keyboard(burst.conv_id)
+        )
+    
+    def _copy_media(self, chat_id: int, media: MediaDescriptor, source: Tuple[int, int], caption: str, **kwargs):
+        """按 file_id 复制媒体消息（不下载、不重新上传）
+        
+        贴纸和视频消息不能带说明文字，先单独发送文字再复制
+        """
+        from_chat_id, message_id = source
+        if media.media_type in CAPTIONLESS_TYPES:
+            self.outbox.send_message(chat_id, caption)
+            self.outbox.enqueue('copy_message', chat_id, from_chat_id=from_chat_id, message_id=message_id, **kwargs)
+        else:
+            self.outbox.enqueue(
+                'copy_message', chat_id, from_chat_id=from_chat_id, message_id=message_id,
+                caption=fit_caption(caption), **kwargs
+            )
+    
+    def _get_last_active(self, conv_id: int) -> Optional[float]:
+        """会话最后活跃时间，会话已关闭时返回 None"""
+        conv = self.conversations.get_by_conv(conv_id)
+        return conv[1].last_active if conv else None
+    
+    async def _expire_conversations(self, conv_ids: List[int]):
+        """关闭到期的会话并通知双方"""
+        expired = []
+        last_seen = {}
+        for conv_id in conv_ids:
+            conv = self.conversations.get_by_conv(conv_id)
+            if conv:
+                expired.append((conv_id, conv[0], conv[1].admin_id))
+                last_seen[conv_id] = conv[1].last_active
+        
+        # 先等待正在处理的转发和回复完成，在数据库中关闭后再从索引中移除；
+        # 期间到达的消息和新建会话等待同一把锁，拿到锁时会话已在数据库和索引中都关闭
+        async with self.conversation_locks.hold(*(conv_id for conv_id, _, _ in expired)):
+            closing = []
+            for item in expired:
+                last_active = self._get_last_active(item[0])
+                if last_active is None:
+                    continue
+                if last_active > last_seen[item[0]]:
+                    # 等锁期间有新消息，重新计时
+                    self.expiry.schedule(item[0], last_active)
+                    continue
+                closing.append(item)
+            expired = closing
+            if not expired:
+                return
+            await self.storage.close_conversations([conv_id for conv_id, _, _ in expired])
+            for conv_id, _, _ in expired:
+                self._forget_conversation(conv_id)
+        EXPIRED_CONVERSATIONS.inc(len(expired))
+        logger.info(f"关闭了 {len(expired)} 个超时会话")
+        
+        # 通知用户和管理员
+        for conv_id, user_id, admin_id in expired:
+            self._notify_timeout(conv_id, user_id, admin_id)
+    
+    def _notify_timeout(self, conv_id: int, user_id: int, admin_id: int):
         """通知会话超时"""
-        try:
-            # 这里需要bot实例来发送消息，暂时跳过
-            pass
-        except Exception as e:
-            logger.error(f"发送超时通知失败: {e}")
+        self.outbox.send_message(
+            user_id,
+            f"⏰ 由于 {self.session_timeout} 分钟无互动，本次会话已自动结束。\n"
+            "如需继续咨询，请发送 /start 重新选择管理员。"
+        )
+        self.outbox.send_message(admin_id, f"⏰ 与用户 {user_id} 的会话（#{conv_id}）已超时关闭。")
     
+    @timed(HANDLER_SECONDS, HANDLER_ERRORS, handler='start_command')
+    @deduplicated
+    @admitted
+    @per_user
     async def start_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """处理 /start 命令"""
         user = update.effective_user
@@ -245,36 +535,241 @@ class CustomerServiceBot:
         
         keyboard = self._get_admin_keyboard()
         
-        await update.message.reply_text(
-            welcome_text,
-            reply_markup=keyboard
+        self.outbox.send_message(update.effective_chat.id, welcome_text, reply_markup=keyboard)
+    
+    async def _fan_out(self, query: Callable[[Storage], Awaitable]) -> List:
+        """在本分片和其他分片的数据库上执行同一查询；其他分片的数据库尚未创建或读取失败时跳过"""
+        storages = [self.storage, *(peer for peer in self.peers if os.path.exists(peer.db_path))]
+        results = await asyncio.gather(*(query(storage) for storage in storages), return_exceptions=True)
+        merged = []
+        for storage, result in zip(storages, results):
+            if isinstance(result, BaseException):
+                if storage is self.storage:
+                    raise result
+                logger.warning(f"读取分片数据库 {storage.db_path} 失败: {result}")
+                continue
+            merged.append(result)
+        return merged
+    
+    async def _search_page(self, session: SearchSession,
+                           page: int) -> Optional[Tuple[str, Optional[InlineKeyboardMarkup]]]:
+        """搜索一页结果，返回消息文本和翻页按钮（尚未翻到的页返回 None）；分片模式下合并所有分片的结果"""
+        cursor = session.cursor(page)
+        if cursor is None:
+            return None
+        terms = session.terms
+        match, short_terms = split_terms(terms)
+        patterns = [like_pattern(term) for term in short_terms]
+        
+        async def search(storage: Storage) -> Tuple[str, List[SearchHit]]:
+            # 每个数据库从自己上一页的最后一条之后取一页多一条，合并后截取本页
+            rows = await storage.search_messages(
+                match, patterns, self.search_page_size + 1, cursor.get(storage.db_path), self.search_scan_messages
+            )
+            return storage.db_path, [SearchHit(*row) for row in rows]
+        
+        merged = merge_hits(await self._fan_out(search), match is not None)
+        query_text = ' '.join(terms)
+        if not merged:
+            return f"🔍 没有找到与「{query_text}」相关的消息。", None
+        
+        admin_names = self.admin_table.by_id
+        title = f"🔍 「{query_text}」第 {page + 1} 页"
+        if match is None:
+            title += f"（关键词较短，仅搜索最近 {self.search_scan_messages} 条消息）"
+        lines = [f"{title}\n"]
+        next_cursor = dict(cursor)
+        for db_path, hit in merged[:self.search_page_size]:
+            sender = admin_names.get(hit.sender_id, '用户')
+            lines.append(f"#{hit.conv_id} 用户 {hit.user_id} · {hit.timestamp} · {sender}")
+            lines.append(f"    {snippet(hit.content, terms)}")
+            next_cursor[db_path] = hit.key
+        
+        buttons = []
+        if page > 0:
+            buttons.append(InlineKeyboardButton("⬅️ 上一页", callback_data=f"search_{page - 1}"))
+        if len(merged) > self.search_page_size:
+            session.set_next(page, next_cursor)
+            buttons.append(InlineKeyboardButton("➡️ 下一页", callback_data=f"search_{page + 1}"))
+        return '\n'.join(lines), InlineKeyboardMarkup([buttons]) if buttons else None
+    
+    @timed(HANDLER_SECONDS, HANDLER_ERRORS, handler='search_command')
+    @deduplicated
+    @per_user
+    async def search_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """处理 /search 命令（仅管理员）"""
+        chat_id = update.effective_chat.id
+        terms = list(context.args or [])
+        if not terms:
+            self.outbox.send_message(chat_id, "用法：/search 关键词 [关键词...]\n多个关键词需同时出现。")
+            return
+        
+        session = self.search_queries[update.effective_user.id] = SearchSession(terms)
+        text, keyboard = await self._search_page(session, 0)
+        self.outbox.send_message(chat_id, text, reply_markup=keyboard)
+    
+    @timed(HANDLER_SECONDS, HANDLER_ERRORS, handler='export_command')
+    @deduplicated
+    async def export_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """处理 /export 命令（仅管理员），以 gzip 压缩文件发送会话记录"""
+        chat_id = update.effective_chat.id
+        try:
+            fmt, export_filter = parse_command_args(list(context.args or []))
+        except ValueError as e:
+            self.outbox.send_message(
+                chat_id,
+                f"❌ {e}\n用法：/export [jsonl|csv] [起始日期] [结束日期] [admin=ID] [user=ID]\n"
+                "日期格式 YYYY-MM-DD（UTC），结束日期包含当天。"
+            )
+            return
+        
+        self.outbox.send_message(chat_id, "⏳ 正在导出，请稍候...")
+        # 先写入尚在批量写回队列中的消息
+        await self.write_behind.flush()
+        fd, path = tempfile.mkstemp(prefix='export_', suffix=f'.{fmt}.gz')
+        os.close(fd)
+        try:
+            # 尚未创建的分片跳过
+            db_paths = [db_path for db_path in self.db_paths if db_path == self.db_path or os.path.exists(db_path)]
+            count = await asyncio.to_thread(export, db_paths, path, fmt, True, export_filter)
+        except Exception as e:
+            os.remove(path)
+            logger.error(f"导出失败: {e}")
+            self.outbox.send_message(chat_id, "❌ 导出失败，请查看日志。")
+            return
+        
+        async def cleanup(_):
+            os.remove(path)
+        
+        self.outbox.enqueue(
+            'send_document', chat_id,
+            document=Path(path),
+            filename=f"conversations.{fmt}.gz",
+            caption=f"📦 共导出 {count} 条消息",
+            on_sent=cleanup, on_failed=cleanup
         )
     
+    @timed(HANDLER_SECONDS, HANDLER_ERRORS, handler='history_command')
+    @deduplicated
+    async def history_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """处理 /history 命令（仅管理员），显示会话最近的消息（含已归档的会话）"""
+        chat_id = update.effective_chat.id
+        args = list(context.args or [])
+        if len(args) != 1 or not args[0].lstrip('#').isdigit():
+            self.outbox.send_message(chat_id, "用法：/history 会话编号")
+            return
+        
+        conv_id = int(args[0].lstrip('#'))
+        await self.write_behind.flush()
+        history = await load_history(self.storage, self.archive, conv_id)
+        if not history:
+            self.outbox.send_message(chat_id, f"❌ 会话 #{conv_id} 没有消息记录。")
+            return
+        
+        admin_names = self.admin_table.by_id
+        limit = self.config.getint('SETTINGS', 'history_limit', fallback=20)
+        lines = [f"📜 会话 #{conv_id}（共 {len(history)} 条，显示最近 {min(limit, len(history))} 条）\n"]
+        for message in history[-limit:]:
+            sender = admin_names.get(message['sender_id'], f"用户 {message['sender_id']}")
+            content = media_label(message.get('media_type'), message['content'])
+            lines.append(f"[{message['timestamp']}] {sender}：{content}")
+        # Telegram 单条消息最长 4096 字符
+        self.outbox.send_message(chat_id, '\n'.join(lines)[-4096:])
+    
+    def _reject_update(self, update: Update, admission: Admission):
+        """被限流的更新直接丢弃，按最小间隔提示用户；按钮回调总是应答（否则客户端一直显示加载中），提示放在应答中"""
+        if admission.result == BLOCKED:
+            text = "🚫 由于发送过于频繁，您已被暂时限制使用，请稍后再试。"
+        elif admission.result == OVERLOADED:
+            text = "⏳ 当前咨询人数较多，消息未能送达，请稍后重试。"
+        else:
+            text = "⚠️ 消息发送过快，部分消息未能送达，请放慢速度。"
+        query = update.callback_query
+        if query:
+            self.outbox.enqueue(
+                'answer_callback_query', query.from_user.id,
+                callback_query_id=query.id, text=text if admission.notify else None
+            )
+            return
+        if not admission.notify or update.effective_chat is None:
+            return
+        self.outbox.send_message(update.effective_chat.id, text)
+    
+    @timed(HANDLER_SECONDS, HANDLER_ERRORS, handler='unblock_command')
+    @deduplicated
+    async def unblock_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """处理 /unblock 命令（仅管理员），解除自动拉黑"""
+        chat_id = update.effective_chat.id
+        args = list(context.args or [])
+        if len(args) != 1 or not args[0].isdigit():
+            self.outbox.send_message(chat_id, "用法：/unblock 用户ID")
+            return
+        user_id = int(args[0])
+        if self.admission and self.admission.unblock(user_id):
+            self.outbox.send_message(chat_id, f"✅ 已解除用户 {user_id} 的限制。")
+        else:
+            self.outbox.send_message(chat_id, f"用户 {user_id} 不在黑名单中。")
+    
+    @timed(HANDLER_SECONDS, HANDLER_ERRORS, handler='stats_command')
+    @deduplicated
+    async def stats_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """处理 /stats 命令（仅管理员），显示最近几天各管理员的服务统计（只读取汇总表）"""
+        chat_id = update.effective_chat.id
+        args = list(context.args or [])
+        if len(args) > 1 or (args and not (args[0].isdigit() and 0 < int(args[0]) <= 366)):
+            self.outbox.send_message(chat_id, "用法：/stats [天数]，默认最近 7 天，最多 366 天")
+            return
+        days = int(args[0]) if args else 7
+        since, until = recent_period(days)
+        stats = merge_stats(await self._fan_out(lambda storage: storage.get_admin_stats(since, until)))
+        self.outbox.send_message(
+            chat_id,
+            format_report(stats, self.admin_table.by_id, f"📊 最近 {days} 天服务统计（UTC {since[:16]} 起）")
+        )
+    
+    @timed(HANDLER_SECONDS, HANDLER_ERRORS, handler='button_callback')
+    @deduplicated
+    @admitted
+    @per_user
     async def button_callback(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """处理按钮回调"""
         query = update.callback_query
         await query.answer()
         
         if query.data.startswith("admin_"):
-            admin_id = int(query.data.split("_")[1])
             user = update.effective_user
+            if query.data == "admin_auto":
+                admin_id = self.router.pick(self.conversations.admin_counts())
+                if admin_id is None:
+                    self.outbox.send_message(query.message.chat_id, "❌ 暂无可分配的管理员，请手动选择。")
+                    return
+            else:
+                admin_id = int(query.data.split("_")[1])
+                if admin_id not in self.admin_table.ids:
+                    # 配置重新加载前发出的旧键盘
+                    self.outbox.send_message(
+                        query.message.chat_id, "❌ 该管理员已不可用，请重新选择。",
+                        reply_markup=self._get_admin_keyboard()
+                    )
+                    return
             
-            # 创建新会话
-            conv_id = self._create_conversation(user.id, admin_id)
-            
-            # 获取管理员名称
-            admin_name = "未知管理员"
-            for name, uid in self.admins.items():
-                if uid == admin_id:
-                    admin_name = name
-                    break
+            # 创建新会话（重复点击时返回已有会话）
+            conv_id, created = await self._create_conversation(user.id, admin_id)
+            admin_name = self.admin_table.name_of(admin_id, "未知管理员")
             
             # 通知用户
-            await query.edit_message_text(
-                f"✅ 已为您连接到 {admin_name}\n"
-                f"请直接发送您的问题，我会为您转达。"
+            self.outbox.enqueue(
+                'edit_message_text', query.message.chat_id,
+                message_id=query.message.message_id,
+                text=(
+                    f"✅ 已为您连接到 {admin_name}\n"
+                    f"请直接发送您的问题，我会为您转达。"
+                )
             )
             
+            if not created:
+                return
+            
             # 通知管理员
             admin_info = self._get_user_info(user.id, user.username)
             admin_message = (
@@ -284,158 +779,520 @@ class CustomerServiceBot:
             )
             
             # 保存管理员通知消息
-            self._save_message(conv_id, admin_id, admin_message)
+            await self._save_message(conv_id, admin_id, admin_message, admin_id=admin_id, kind=SYSTEM)
             
-            # 发送回复按钮给管理员
-            keyboard = InlineKeyboardMarkup([[
-                InlineKeyboardButton("💬 回复用户", callback_data=f"reply_{conv_id}")
-            ]])
+            if self.inbox:
+                self.inbox.track(admin_id, conv_id, self._user_label(user.id, user.username))
+            else:
+                # 发送回复按钮给管理员
+                self._notify_admin(admin_id, conv_id, admin_message)
+        
+        elif query.data.startswith("search_"):
+            session = self.search_queries.get(update.effective_user.id)
+            page = await self._search_page(session, int(query.data.split("_")[1])) if session else None
+            if page is None:
+                return
+            text, keyboard = page
+            self.outbox.enqueue(
+                'edit_message_text', query.message.chat_id,
+                message_id=query.message.message_id, text=text, reply_markup=keyboard
+            )
+        
+        elif query.data.startswith("reply_"):
+            admin = update.effective_user
+            if admin.id not in self.admin_table.ids:
+                return
             
-            try:
-                await context.bot.send_message(
-                    chat_id=admin_id,
-                    text=admin_message,
-                    reply_markup=keyboard
-                )
-            except Exception as e:
-                logger.error(f"发送管理员通知失败: {e}")
+            conv_id = int(query.data.split("_")[1])
+            conv = self.conversations.get_by_conv(conv_id)
+            if not conv or conv[1].admin_id != admin.id:
+                self.outbox.send_message(query.message.chat_id, "❌ 该会话已结束或不属于您。")
+                return
+            
+            # 之后的消息（非回复消息）都发送给该用户
+            self.reply_targets[admin.id] = conv_id
+            prompt = f"✏️ 请直接发送回复内容，将转发给用户 {conv[0]}。"
+            if self.inbox:
+                self.inbox.show_unread(query.message.chat_id, conv_id, prompt)
+            else:
+                self.outbox.send_message(query.message.chat_id, prompt)
     
+    @timed(HANDLER_SECONDS, HANDLER_ERRORS, handler='handle_user_message')
+    @deduplicated
+    @admitted
+    @per_user
     async def handle_user_message(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
-        """处理用户消息"""
+        """处理用户消息（文字或媒体）"""
         user = update.effective_user
-        message_text = update.message.text
         
         # 检查是否有活跃会话
         conv_info = self._get_active_conversation(user.id)
+        if conv_info:
+            async with self.conversation_locks.hold(conv_info[0]):
+                # 等锁期间会话可能已超时关闭
+                if self._get_active_conversation(user.id) == conv_info:
+                    await self._forward_user_message(update, *conv_info)
+                    return
         
-        if not conv_info:
-            # 没有活跃会话，提示选择管理员
-            await update.message.reply_text(
-                "请先选择管理员开始咨询。",
-                reply_markup=self._get_admin_keyboard()
-            )
-            return
+        # 没有活跃会话时只匹配通用的自动回复规则
+        rule = self._match_faq(update.message.text, None)
+        if rule:
+            FAQ_REPLIES.inc()
+            self.outbox.send_message(update.effective_chat.id, rule.answer)
+            if not rule.forward:
+                return
+        
+        # 没有活跃会话，提示选择管理员
+        self.outbox.send_message(
+            update.effective_chat.id,
+            "请先选择管理员开始咨询。",
+            reply_markup=self._get_admin_keyboard()
+        )
+    
+    async def _forward_user_message(self, update: Update, conv_id: int, admin_id: int):
+        """保存用户消息并转发给管理员（调用方持有会话锁）"""
+        user = update.effective_user
+        media = describe(update.message)
+        message_text = media.caption if media else update.message.text
+        chat_id = update.effective_chat.id
         
-        conv_id, admin_id = conv_info
+        # 常见问题直接自动回复，不打扰管理员
+        rule = None if media else self._match_faq(message_text, admin_id)
+        if rule:
+            FAQ_REPLIES.inc()
+            self.outbox.send_message(chat_id, rule.answer)
+            if not rule.forward:
+                if self.faq_log:
+                    await self._save_message(conv_id, user.id, message_text, admin_id=admin_id, kind=USER,
+                                             source=(chat_id, update.message.message_id))
+                    await self._save_message(conv_id, admin_id, f"[自动回复] {rule.answer}", admin_id=admin_id, kind=AUTO)
+                return
         
         # 保存用户消息
-        self._save_message(conv_id, user.id, message_text)
+        await self._save_message(conv_id, user.id, message_text, media, admin_id=admin_id, kind=USER,
+                                 source=(chat_id, update.message.message_id))
+        if rule and self.faq_log:
+            await self._save_message(conv_id, admin_id, f"[自动回复] {rule.answer}", admin_id=admin_id, kind=AUTO)
+        now = time.time()
+        self.router.user_message(conv_id, now)
+        
+        if self.inbox:
+            # 摘要模式只更新管理员收件箱，由收件箱定时刷新
+            source = (chat_id, update.message.message_id) if media else None
+            text = media_label(media.media_type, message_text) if media else message_text
+            self.inbox.user_message(admin_id, conv_id, self._user_label(user.id, user.username), text, source, now)
+            self.outbox.send_message(chat_id, "✅ 消息已发送给管理员，请稍候回复。")
+            return
+        
+        # 窗口内的连续文字消息并入已发送的通知，不再单独通知管理员和回执用户
+        if not media and self.bursts.enabled and self.bursts.merge(conv_id, admin_id, message_text, now):
+            return
         
         # 转发给管理员
         user_info = self._get_user_info(user.id, user.username)
-        admin_message = (
+        header = (
             f"📨 用户消息\n\n"
-            f"{user_info}\n\n"
-            f"💬 {message_text}"
+            f"{user_info}"
         )
         
-        # 发送回复按钮给管理员
-        keyboard = InlineKeyboardMarkup([[
-            InlineKeyboardButton("💬 回复用户", callback_data=f"reply_{conv_id}")
-        ]])
+        burst = None
         
-        try:
-            await context.bot.send_message(
-                chat_id=admin_id,
-                text=admin_message,
-                reply_markup=keyboard
-            )
-            
-            # 确认用户消息已收到
-            await update.message.reply_text("✅ 消息已发送给管理员，请稍候回复。")
-            
-        except Exception as e:
-            logger.error(f"转发用户消息失败: {e}")
-            await update.message.reply_text("❌ 消息发送失败，请稍后重试。")
+        async def on_failed(error: Exception):
+            logger.error(f"转发用户消息失败: {error}")
+            if burst:
+                # 通知没有发出，之后的消息重新发送通知
+                self.bursts.forget(conv_id, burst)
+            self.outbox.send_message(chat_id, "❌ 消息发送失败，请稍后重试。")
+        
+        if media:
+            # 媒体单独通知，之后的文字消息开始新的合并窗口
+            self.bursts.forget(conv_id)
+            self._notify_admin(admin_id, conv_id, f"{header}\n\n💬 {media_label(media.media_type, message_text)}",
+                               on_failed=on_failed, media=media, source=(chat_id, update.message.message_id))
+        elif self.bursts.enabled:
+            burst = self.bursts.start(conv_id, admin_id, header, message_text, now)
+            self._notify_admin(admin_id, conv_id, burst.render(), on_failed=on_failed, burst=burst)
+        else:
+            self._notify_admin(admin_id, conv_id, f"{header}\n\n💬 {message_text}", on_failed=on_failed)
+        
+        # 确认用户消息已收到
+        self.outbox.send_message(chat_id, "✅ 消息已发送给管理员，请稍候回复。")
     
+    @timed(HANDLER_SECONDS, HANDLER_ERRORS, handler='handle_admin_message')
+    @deduplicated
+    @per_user
     async def handle_admin_message(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
-        """处理管理员消息"""
+        """处理管理员消息（文字或媒体）"""
         admin = update.effective_user
-        message_text = update.message.text
         
         # 检查是否是配置的管理员
-        if admin.id not in self.admins.values():
+        if admin.id not in self.admin_table.ids:
             return
         
-        # 检查是否是回复消息
-        if not update.message.reply_to_message:
-            return
+        # 查找对应的会话：优先使用被回复的通知消息，其次使用“回复用户”按钮选定的会话
+        reply_to = update.message.reply_to_message
+        if reply_to:
+            conv_id = await self.notifications.resolve(update.effective_chat.id, reply_to.message_id)
+        else:
+            conv_id = self.reply_targets.get(admin.id)
+            if conv_id is None:
+                return
         
-        # 获取回复的消息内容
-        replied_message = update.message.reply_to_message.text
+        if conv_id is not None:
+            async with self.conversation_locks.hold(conv_id):
+                # 加锁后再查询，等锁期间会话可能已关闭
+                conv = self.conversations.get_by_conv(conv_id)
+                if conv:
+                    await self._send_admin_reply(update, conv_id, conv[0], conv[1].admin_id)
+                    return
+        self.outbox.send_message(update.effective_chat.id, "❌ 无法找到对应的会话，请检查回复的消息。")
+    
+    async def _send_admin_reply(self, update: Update, conv_id: int, user_id: int, admin_id: int):
+        """保存管理员回复并发送给用户（调用方持有会话锁）"""
+        media = describe(update.message)
+        message_text = media.caption if media else update.message.text
         
-        # 查找对应的会话
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
+        # 保存管理员回复
+        await self._save_message(conv_id, admin_id, message_text, media, admin_id=admin_id, kind=ADMIN,
+                                 source=(update.effective_chat.id, update.message.message_id))
+        self.router.admin_reply(conv_id, admin_id, time.time())
+        # 管理员已回复，用户之后的消息发送新通知
+        self.bursts.forget(conv_id)
+        if self.inbox:
+            self.inbox.mark_read(conv_id)
         
-        # 从消息内容中提取会话ID（这里简化处理）
-        # 实际应用中可能需要更复杂的逻辑来关联消息和会话
+        # 发送给用户
+        admin_name = self.admin_table.name_of(admin_id, "管理员")
         
-        cursor.execute('''
-            SELECT c.id, c.user_id, c.admin_id 
-            FROM conversations c
-            JOIN messages m ON c.id = m.conv_id
-            WHERE m.content LIKE ? AND c.status = 'active'
-            ORDER BY m.timestamp DESC LIMIT 1
-        ''', (f"%{replied_message[:50]}%",))
+        user_message = (
+            f"[客服回复] 来自{admin_name}：\n\n"
+            f"{message_text}"
+        )
+        chat_id = update.effective_chat.id
         
-        result = cursor.fetchone()
-        conn.close()
+        async def on_failed(error: Exception):
+            logger.error(f"发送管理员回复失败: {error}")
+            self.outbox.send_message(chat_id, "❌ 回复发送失败，请稍后重试。")
         
-        if result:
-            conv_id, user_id, admin_id = result
-            
-            # 保存管理员回复
-            self._save_message(conv_id, admin_id, message_text)
-            
-            # 发送给用户
-            admin_name = "管理员"
-            for name, uid in self.admins.items():
-                if uid == admin_id:
-                    admin_name = name
+        if media:
+            self._copy_media(user_id, media, (chat_id, update.message.message_id), user_message,
+                             on_failed=on_failed)
+        else:
+            self.outbox.send_message(user_id, user_message, on_failed=on_failed)
+        
+        # 确认管理员回复已发送
+        self.outbox.send_message(chat_id, "✅ 回复已发送给用户。")
+    
+    async def _backfill_search_index(self):
+        """后台分批为已有消息补建全文索引，批次之间让出写线程"""
+        total = 0
+        try:
+            while True:
+                count = await self.storage.backfill_search_index()
+                if not count:
                     break
-            
-            user_message = (
-                f"[客服回复] 来自{admin_name}：\n\n"
-                f"{message_text}"
-            )
-            
+                total += count
+                await asyncio.sleep(0.1)
+        except Exception as e:
+            logger.error(f"补建全文索引失败: {e}")
+            return
+        if total:
+            logger.info(f"全文索引补建完成，共 {total} 条消息")
+    
+    async def _watch_faq(self):
+        """定期检查规则文件，修改后重新编译"""
+        interval = self.config.getfloat('FAQ', 'reload_interval', fallback=5)
+        while True:
+            await asyncio.sleep(interval)
             try:
-                await context.bot.send_message(
-                    chat_id=user_id,
-                    text=user_message
+                await self.faq.reload_if_changed()
+            except Exception as e:
+                logger.error(f"检查 FAQ 规则失败: {e}")
+    
+    async def _save_update_state(self):
+        """保存已处理的 update_id（经写回队列，排在此前已保存的消息之后）"""
+        state = self.dedup.dump()
+        if state:
+            await self.write_behind.put_state(STATE_KEY, state)
+    
+    async def _watch_updates(self):
+        """定期保存已处理的 update_id"""
+        interval = self.config.getfloat('SETTINGS', 'update_state_interval', fallback=1)
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self._save_update_state()
+            except Exception as e:
+                logger.error(f"保存更新处理状态失败: {e}")
+    
+    async def _archive_periodically(self):
+        """定期把超过保留期的已关闭会话移到归档文件"""
+        interval = self.config.getfloat('SETTINGS', 'archive_interval_hours', fallback=24) * 3600
+        batch_size = self.config.getint('SETTINGS', 'archive_batch_size', fallback=200)
+        if self._backfill_task:
+            # 全文索引补建完成后才能删除消息
+            await asyncio.wait([self._backfill_task])
+        while True:
+            try:
+                conversations, messages = await archive_conversations(
+                    self.storage, self.archive, archive_cutoff(self.archive_after_days), batch_size
                 )
-                
-                # 确认管理员回复已发送
-                await update.message.reply_text("✅ 回复已发送给用户。")
-                
+                if conversations:
+                    await self.storage.release_free_pages()
+                    logger.info(f"归档了 {conversations} 个会话，{messages} 条消息")
             except Exception as e:
-                logger.error(f"发送管理员回复失败: {e}")
-                await update.message.reply_text("❌ 回复发送失败，请稍后重试。")
-        else:
-            await update.message.reply_text("❌ 无法找到对应的会话，请检查回复的消息。")
+                logger.error(f"归档失败: {e}")
+            await asyncio.sleep(interval)
     
-    async def timeout_checker(self, context: ContextTypes.DEFAULT_TYPE):
-        """定期检查超时会话"""
-        self._check_timeout_conversations()
+    def _replay_journal(self, bot):
+        """重新发送上次停机时未发出的调用；全部发送成功或记为死信后才删除日志，
+        在此之前停机时由 _drain 以剩余的调用重写日志"""
+        records = self.journal.read()
+        if not records:
+            return
+        unsettled = len(records)
+        
+        async def settled(_):
+            nonlocal unsettled
+            unsettled -= 1
+            if unsettled == 0 and not self._drained:
+                self.journal.clear()
+                logger.info("上次停机时未发送的出站调用已全部处理")
+        
+        for record in records:
+            self.outbox.enqueue(record['method'], record['chat_id'], on_sent=settled, on_failed=settled,
+                                **decode_kwargs(record['kwargs'], bot))
+        logger.info(f"已重放 {len(records)} 条上次停机时未发送的出站调用")
     
-    def run(self):
-        """运行机器人"""
-        # 创建应用
-        application = Application.builder().token(self.bot_token).build()
+    async def _post_init(self, application: Application):
+        """应用启动后开启后台任务"""
+        self.application = application
+        self._drained = False
+        await self.write_behind.start()
+        await self.outbox.start(application.bot)
+        self._replay_journal(application.bot)
+        await self.expiry.start()
+        self._backfill_task = asyncio.create_task(self._backfill_search_index())
+        if self.archive_after_days > 0:
+            self._archive_task = asyncio.create_task(self._archive_periodically())
+        if self.faq:
+            self._faq_task = asyncio.create_task(self._watch_faq())
+        self._config_task = asyncio.create_task(self._watch_config())
+        self._dedup_task = asyncio.create_task(self._watch_updates())
+        if self.inbox:
+            for user_id, entry in self.conversations.items():
+                self.inbox.track(entry.admin_id, entry.conv_id, self._user_label(user_id, None), entry.last_active)
+        if hasattr(signal, 'SIGHUP'):
+            try:
+                asyncio.get_running_loop().add_signal_handler(signal.SIGHUP, self._reload_requested.set)
+            except (NotImplementedError, RuntimeError):
+                pass
+        if self.config.getboolean('METRICS', 'enabled', fallback=False):
+            self.metrics_server = MetricsServer(
+                host=self.config.get('METRICS', 'listen', fallback='127.0.0.1'),
+                port=self.config.getint('METRICS', 'port', fallback=9100),
+                path=self.config.get('METRICS', 'path', fallback='/metrics')
+            )
+            await self.metrics_server.start()
+    
+    async def _drain(self):
+        """停止处理更新后、关闭 Bot API 连接（application.shutdown）前按期限排空剩余工作：
+        停止后台任务 -> 完成正在关闭的超时会话 -> 发送出站队列 -> 未发出的写入日志"""
+        if self._drained:
+            return
+        self._drained = True
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.shutdown_timeout
+        if self.metrics_server:
+            await self.metrics_server.close()
+            self.metrics_server = None
+        if hasattr(signal, 'SIGHUP'):
+            try:
+                asyncio.get_running_loop().remove_signal_handler(signal.SIGHUP)
+            except (NotImplementedError, RuntimeError):
+                pass
+        for task in (self._backfill_task, self._archive_task, self._faq_task, self._config_task, self._dedup_task):
+            if task:
+                task.cancel()
+                await asyncio.gather(task, return_exceptions=True)
+        self._backfill_task = self._archive_task = self._faq_task = self._config_task = self._dedup_task = None
+        await self.expiry.stop(timeout=max(0.0, deadline - loop.time()))
+        if self.inbox:
+            self.inbox.close()
+        remaining = await self.outbox.stop(timeout=max(0.0, deadline - loop.time()))
+        # 日志中可能还有尚未完成的重放调用（它们也在 remaining 中），以剩余调用整体替换
+        try:
+            skipped = self.journal.write(remaining)
+        except OSError as e:
+            logger.error(f"写入出站调用日志失败: {e}")
+            skipped = remaining
+        # 无法重放的调用记为死信
+        for job in skipped:
+            try:
+                await self.storage.add_dead_letter(job.chat_id, job.method, job.payload(), '停机时未发送',
+                                                   job.attempts)
+            except Exception as e:
+                logger.error(f"写入死信记录失败: {e}")
+    
+    async def _post_shutdown(self, application: Application):
+        """应用关闭后提交剩余消息并关闭数据库（尚未排空时先排空）"""
+        await self._drain()
+        await self._save_update_state()
+        await self.write_behind.close()
+        self.storage.close()
+        for peer in self.peers:
+            peer.close()
+    
+    async def _on_error(self, update: object, context: ContextTypes.DEFAULT_TYPE):
+        """处理器抛出的异常：记录日志，webhook 模式下标记该更新处理失败"""
+        update_id = update.update_id if isinstance(update, Update) else None
+        logger.error(f"处理更新 {update_id} 失败: {context.error}", exc_info=context.error)
+        if update_id is not None and self._failed_updates is not None:
+            self._failed_updates.add(update_id)
+    
+    def _build_application(self) -> Application:
+        """创建应用并注册处理器"""
+        application = (
+            Application.builder()
+            .token(self.bot_token)
+            # 不同用户的更新并发处理，同一用户由 per_user 保证顺序
+            .concurrent_updates(self.config.getint('BOT', 'concurrent_updates', fallback=64))
+            .build()
+        )
         
         # 添加处理器
+        application.add_error_handler(self._on_error)
         application.add_handler(CommandHandler("start", self.start_command))
+        application.add_handler(CommandHandler(
+            "search", self.search_command, filters=self.admin_filter
+        ))
+        application.add_handler(CommandHandler(
+            "export", self.export_command, filters=self.admin_filter
+        ))
+        application.add_handler(CommandHandler(
+            "history", self.history_command, filters=self.admin_filter
+        ))
+        application.add_handler(CommandHandler(
+            "unblock", self.unblock_command, filters=self.admin_filter
+        ))
+        application.add_handler(CommandHandler(
+            "stats", self.stats_command, filters=self.admin_filter
+        ))
         application.add_handler(CallbackQueryHandler(self.button_callback))
-        application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, self.handle_user_message))
+        application.add_handler(MessageHandler(
+            (filters.TEXT & ~filters.COMMAND | MEDIA_FILTER) & self.admin_filter,
+            self.handle_admin_message
+        ))
+        application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND | MEDIA_FILTER, self.handle_user_message))
+        return application
+    
+    def _stop_signal(self) -> asyncio.Event:
+        """收到 SIGINT / SIGTERM 时置位的事件"""
+        stop = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            try:
+                loop.add_signal_handler(sig, stop.set)
+            except NotImplementedError:
+                pass
+        return stop
+    
+    async def _stop_application(self, application: Application):
+        """停止顺序：停止接收和处理更新 -> 排空出站队列等（Bot API 连接仍可用）-> 关闭连接 -> 关闭数据库"""
+        if application.updater and application.updater.running:
+            await application.updater.stop()
+        if application.running:
+            await application.stop()
+        await self._drain()
+        await application.shutdown()
+        await self._post_shutdown(application)
+    
+    async def _run_polling(self, application: Application):
+        """以长轮询模式运行，直到收到停止信号"""
+        stop = self._stop_signal()
+        await application.initialize()
+        await self._post_init(application)
+        try:
+            await application.updater.start_polling(allowed_updates=Update.ALL_TYPES)
+            await application.start()
+            await stop.wait()
+            logger.info("收到停止信号，等待处理中的更新完成...")
+        finally:
+            await self._stop_application(application)
+    
+    async def _run_webhook(self, application: Application):
+        """以 webhook 模式运行，直到收到停止信号"""
+        url = self.config.get('WEBHOOK', 'url')
+        secret_token = self.config.get('WEBHOOK', 'secret_token', fallback='') or None
+        
+        self._failed_updates = set()
         
-        # 添加定时任务检查超时会话
-        job_queue = application.job_queue
-        job_queue.run_repeating(self.timeout_checker, interval=300)  # 每5分钟检查一次
+        async def process_update(data: dict):
+            update = Update.de_json(data, application.bot)
+            await application.process_update(update)
+            # PTB 把处理器的异常交给错误处理器而不抛出，由其记录的结果决定是否确认
+            if update.update_id in self._failed_updates:
+                self._failed_updates.discard(update.update_id)
+                raise RuntimeError("处理器执行失败")
+        
+        server = WebhookServer(
+            process_update,
+            host=self.config.get('WEBHOOK', 'listen', fallback='0.0.0.0'),
+            port=self.config.getint('WEBHOOK', 'port', fallback=8443),
+            path=self.config.get('WEBHOOK', 'path', fallback='/webhook'),
+            secret_token=secret_token,
+            max_concurrent=self.config.getint('WEBHOOK', 'max_concurrent_updates', fallback=64)
+        )
+        REGISTRY.gauge('bot_webhook_in_flight', '正在处理的 webhook 更新数', lambda: server.in_flight)
+        
+        stop = self._stop_signal()
+        await application.initialize()
+        await self._post_init(application)
+        await application.start()
+        try:
+            await server.start()
+            await application.bot.set_webhook(
+                url=url,
+                secret_token=secret_token,
+                max_connections=self.config.getint('WEBHOOK', 'max_connections', fallback=40),
+                allowed_updates=Update.ALL_TYPES
+            )
+            logger.info(f"Webhook 已设置: {url}")
+            await stop.wait()
+            logger.info("收到停止信号，等待处理中的更新完成...")
+            await server.drain(self.config.getfloat('WEBHOOK', 'drain_timeout', fallback=30))
+        finally:
+            await self._stop_application(application)
+    
+    async def run_shard(self, updates):
+        """分片模式的工作进程：处理主进程经队列分配来的更新（JSON），收到 None 时停止"""
+        application = self._build_application()
+        await application.initialize()
+        await self._post_init(application)
+        await application.start()
+        logger.info(f"分片 {self.shard.index}/{self.shard.count} 已启动")
+        try:
+            while True:
+                data = await asyncio.to_thread(updates.get)
+                if data is None:
+                    break
+                await application.update_queue.put(Update.de_json(data, application.bot))
+            logger.info("收到停止通知，等待处理中的更新完成...")
+        finally:
+            await self._stop_application(application)
+    
+    def run(self):
+        """运行机器人"""
+        # 创建应用
+        application = self._build_application()
         
         # 启动机器人
-        logger.info("机器人启动中...")
-        application.run_polling(allowed_updates=Update.ALL_TYPES)
+        mode = self.config.get('BOT', 'mode', fallback='polling')
+        logger.info(f"机器人启动中（{mode} 模式）...")
+        if mode == 'webhook':
+            asyncio.run(self._run_webhook(application))
+        else:
+            asyncio.run(self._run_polling(application))
 
 def main():
     """主函数"""
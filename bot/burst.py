@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+连续消息合并
+用户在短时间内连续发送的多条文字消息合并到同一条管理员通知中：第一条立即发送通知，
+通知发送成功后，窗口内的后续消息不再发送新通知，而是（去抖后）编辑原通知追加内容。
+通知尚未发出（或发送失败）时不合并，避免消息随失败的通知一起丢失
+"""
+
+import asyncio
+from typing import Callable, Dict, List, Optional
+
+# Telegram 单条消息最长 4096 字符
+MAX_MESSAGE_LENGTH = 4096
+
+
+class Burst:
+    """一个会话当前的消息合并窗口"""
+
+    __slots__ = ('conv_id', 'admin_id', 'header', 'lines', 'last_at', 'message_id', 'dirty', 'timer')
+
+    def __init__(self, conv_id: int, admin_id: int, header: str, line: str, now: float):
+        self.conv_id = conv_id
+        self.admin_id = admin_id
+        self.header = header
+        self.lines: List[str] = [line]
+        self.last_at = now
+        # 通知发送成功后才知道 message_id，在此之前不合并
+        self.message_id: Optional[int] = None
+        self.dirty = False
+        self.timer: Optional[asyncio.TimerHandle] = None
+
+    def render(self, lines: Optional[List[str]] = None) -> str:
+        """通知全文"""
+        body = '\n'.join(f"💬 {line}" for line in (self.lines if lines is None else lines))
+        return f"{self.header}\n\n{body}"
+
+
+class BurstCoalescer:
+    """按会话合并连续消息"""
+
+    def __init__(self, window: float, on_edit: Callable[[Burst], None], edit_delay: float = 1.0,
+                 max_length: int = MAX_MESSAGE_LENGTH):
+        self.window = window
+        self.on_edit = on_edit
+        self.edit_delay = edit_delay
+        self.max_length = max_length
+        self._bursts: Dict[int, Burst] = {}
+
+    @property
+    def enabled(self) -> bool:
+        return self.window > 0
+
+    def merge(self, conv_id: int, admin_id: int, line: str, now: float) -> bool:
+        """窗口未结束时把消息并入当前通知，返回是否已合并"""
+        burst = self._bursts.get(conv_id)
+        if burst is None or burst.message_id is None or burst.admin_id != admin_id or now - burst.last_at > self.window:
+            return False
+        if len(burst.render(burst.lines + [line])) > self.max_length:
+            return False
+        burst.lines.append(line)
+        burst.last_at = now
+        burst.dirty = True
+        self._schedule(burst)
+        return True
+
+    def start(self, conv_id: int, admin_id: int, header: str, line: str, now: float) -> Burst:
+        """开始新的合并窗口（调用方负责发送通知并在成功后调用 sent）"""
+        self._finish(conv_id)
+        burst = self._bursts[conv_id] = Burst(conv_id, admin_id, header, line, now)
+        return burst
+
+    def sent(self, burst: Burst, message_id: int):
+        """通知已发送"""
+        burst.message_id = message_id
+        if burst.dirty:
+            self._schedule(burst)
+
+    def forget(self, conv_id: int, burst: Optional[Burst] = None):
+        """会话结束；指定 burst 时只在它仍是当前窗口时结束（如该窗口的通知发送失败）"""
+        if burst is not None and self._bursts.get(conv_id) is not burst:
+            return
+        self._finish(conv_id)
+
+    def _finish(self, conv_id: int):
+        """结束旧窗口：尚未编辑的追加内容立即编辑"""
+        burst = self._bursts.pop(conv_id, None)
+        if burst is None:
+            return
+        if burst.timer:
+            burst.timer.cancel()
+            burst.timer = None
+        if burst.dirty and burst.message_id is not None:
+            burst.dirty = False
+            self.on_edit(burst)
+
+    def _schedule(self, burst: Burst):
+        if burst.timer or burst.message_id is None:
+            return
+        burst.timer = asyncio.get_running_loop().call_later(self.edit_delay, self._flush, burst)
+
+    def _flush(self, burst: Burst):
+        burst.timer = None
+        if burst.dirty and burst.message_id is not None:
+            burst.dirty = False
+            self.on_edit(burst)
@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+活跃会话内存索引
+user_id -> (conv_id, admin_id, last_active)，启动时从数据库重建，
+之后由创建/关闭/超时流程维护，消息路由无需访问磁盘
+"""
+
+from collections import Counter
+from datetime import datetime, timezone
+from typing import Dict, Iterable, List, NamedTuple, Optional, Tuple
+
+
+class ActiveConversation(NamedTuple):
+    """活跃会话"""
+    conv_id: int
+    admin_id: int
+    last_active: float  # UNIX 时间戳
+
+
+def parse_timestamp(value: str) -> float:
+    """把数据库中的 UTC 时间字符串转换为 UNIX 时间戳"""
+    return datetime.strptime(value[:19], '%Y-%m-%d %H:%M:%S').replace(tzinfo=timezone.utc).timestamp()
+
+
+class ConversationIndex:
+    """活跃会话索引（仅在事件循环线程中访问）"""
+
+    def __init__(self):
+        self._by_user: Dict[int, ActiveConversation] = {}
+        self._user_by_conv: Dict[int, int] = {}
+        self._admin_counts: Counter = Counter()
+
+    def __len__(self) -> int:
+        return len(self._by_user)
+
+    def load(self, rows: Iterable[Tuple[int, int, int, str]]):
+        """从数据库行 (conv_id, user_id, admin_id, last_active) 重建索引"""
+        self._by_user.clear()
+        self._user_by_conv.clear()
+        self._admin_counts.clear()
+        for conv_id, user_id, admin_id, last_active in rows:
+            timestamp = parse_timestamp(last_active)
+            current = self._by_user.get(user_id)
+            # 同一用户存在多个活跃会话时，与原查询一致取最近活跃的一个
+            if current is None or timestamp >= current.last_active:
+                self.add(user_id, conv_id, admin_id, timestamp)
+
+    def get(self, user_id: int) -> Optional[ActiveConversation]:
+        """查询用户的活跃会话"""
+        return self._by_user.get(user_id)
+
+    def items(self) -> List[Tuple[int, ActiveConversation]]:
+        """全部 (user_id, 会话)"""
+        return list(self._by_user.items())
+
+    def get_by_conv(self, conv_id: int) -> Optional[Tuple[int, ActiveConversation]]:
+        """按会话ID查询，返回 (user_id, 会话)"""
+        user_id = self._user_by_conv.get(conv_id)
+        if user_id is None:
+            return None
+        return user_id, self._by_user[user_id]
+
+    def add(self, user_id: int, conv_id: int, admin_id: int, last_active: float):
+        """登记新的活跃会话（替换该用户原有的索引项）"""
+        previous = self._by_user.get(user_id)
+        if previous is not None:
+            self._forget(user_id, previous)
+        self._by_user[user_id] = ActiveConversation(conv_id, admin_id, last_active)
+        self._user_by_conv[conv_id] = user_id
+        self._admin_counts[admin_id] += 1
+
+    def touch(self, conv_id: int, last_active: float):
+        """更新会话最后活跃时间"""
+        user_id = self._user_by_conv.get(conv_id)
+        if user_id is None:
+            return
+        entry = self._by_user[user_id]
+        if last_active > entry.last_active:
+            self._by_user[user_id] = entry._replace(last_active=last_active)
+
+    def remove(self, conv_id: int) -> Optional[Tuple[int, ActiveConversation]]:
+        """移除会话，返回 (user_id, 会话)"""
+        user_id = self._user_by_conv.get(conv_id)
+        if user_id is None:
+            return None
+        entry = self._by_user[user_id]
+        self._forget(user_id, entry)
+        return user_id, entry
+
+    def _forget(self, user_id: int, entry: ActiveConversation):
+        del self._by_user[user_id]
+        self._user_by_conv.pop(entry.conv_id, None)
+        self._admin_counts[entry.admin_id] -= 1
+        if self._admin_counts[entry.admin_id] <= 0:
+            del self._admin_counts[entry.admin_id]
+
+    def active_count(self, admin_id: int) -> int:
+        """管理员当前的活跃会话数"""
+        return self._admin_counts.get(admin_id, 0)
+
+    def admin_counts(self) -> Dict[int, int]:
+        """各管理员的活跃会话数"""
+        return dict(self._admin_counts)
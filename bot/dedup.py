@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+更新去重
+进程崩溃或重启后，Telegram 会重新投递尚未确认的更新；webhook 超时后也会重试。
+处理过的 update_id 记在一个有界的环形缓冲区里，重复投递的更新直接丢弃。
+状态（低水位 + 低水位以上已处理的ID）定期经写回队列保存，与此前的消息在同一或之后的事务中提交，
+重启时恢复：不超过低水位的更新都已处理完毕，其余按已处理ID判断
+"""
+
+import json
+from collections import deque
+from typing import Deque, List, Optional, Set
+
+from metrics import DUPLICATE_UPDATES
+
+# bot_state 表中的键
+STATE_KEY = 'updates'
+
+
+class UpdateDeduplicator:
+    """最近处理过的 update_id（仅在事件循环线程中访问）"""
+
+    def __init__(self, capacity: int = 10000):
+        self.capacity = capacity
+        self._recent: Deque[int] = deque()
+        self._recent_set: Set[int] = set()
+        self._in_flight: Set[int] = set()
+        # 处理失败、等待重新投递的更新
+        self._failed: Set[int] = set()
+        # 重启前已全部处理完的最大 update_id
+        self._floor = 0
+        self._max_seen = 0
+        self._dirty = False
+
+    def __len__(self) -> int:
+        return len(self._recent)
+
+    def begin(self, update_id: int) -> bool:
+        """开始处理更新；重复投递（已处理或正在处理）时返回 False"""
+        if update_id <= self._floor or update_id in self._recent_set or update_id in self._in_flight:
+            DUPLICATE_UPDATES.inc()
+            return False
+        self._in_flight.add(update_id)
+        self._failed.discard(update_id)
+        self._max_seen = max(self._max_seen, update_id)
+        return True
+
+    def done(self, update_id: int):
+        """更新处理完成"""
+        self._in_flight.discard(update_id)
+        self._remember(update_id)
+        self._dirty = True
+
+    def failed(self, update_id: int):
+        """更新处理失败：不记为已处理，重新投递时再次处理（低水位也不越过它）"""
+        self._in_flight.discard(update_id)
+        self._failed.add(update_id)
+        if len(self._failed) > self.capacity:
+            self._failed.discard(min(self._failed))
+        self._dirty = True
+
+    def _remember(self, update_id: int):
+        if update_id in self._recent_set:
+            return
+        self._recent.append(update_id)
+        self._recent_set.add(update_id)
+        if len(self._recent) > self.capacity:
+            self._recent_set.discard(self._recent.popleft())
+
+    @property
+    def low_water(self) -> int:
+        """不超过该值的更新都已处理完毕"""
+        pending = self._in_flight | self._failed
+        if pending:
+            return max(self._floor, min(pending) - 1)
+        return max(self._floor, self._max_seen)
+
+    def dump(self) -> Optional[str]:
+        """有变化时返回要保存的状态，否则返回 None"""
+        if not self._dirty:
+            return None
+        self._dirty = False
+        low_water = self.low_water
+        return json.dumps({
+            'low_water': low_water,
+            'recent': sorted(i for i in self._recent_set if i > low_water),
+        })
+
+    def load(self, state: Optional[str]):
+        """恢复上次保存的状态"""
+        if not state:
+            return
+        data = json.loads(state)
+        self._floor = self._max_seen = int(data.get('low_water', 0))
+        recent: List[int] = data.get('recent', [])
+        for update_id in recent[-self.capacity:]:
+            self._remember(int(update_id))
@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+会话超时调度
+按 last_active + 超时时间建立最小堆，在每个会话到期时立即关闭，取代定期全表扫描
+"""
+
+import asyncio
+import heapq
+import logging
+import time
+from typing import Awaitable, Callable, List, Optional, Tuple
+
+from metrics import EXPIRY_SWEEP_SECONDS
+
+logger = logging.getLogger(__name__)
+
+
+class ExpiryScheduler:
+    """会话到期调度器
+
+    堆中的到期时间只在会话创建时写入；会话活跃时不修改堆，而是在到期弹出时
+    通过 get_last_active 重新核对，仍然活跃的会话按新的到期时间重新入堆。
+    """
+
+    def __init__(self, timeout: float,
+                 get_last_active: Callable[[int], Optional[float]],
+                 on_expire: Callable[[List[int]], Awaitable[None]],
+                 slack: float = 1.0, max_batch: int = 500, retry_delay: float = 5.0):
+        self.timeout = timeout
+        self.get_last_active = get_last_active
+        self.on_expire = on_expire
+        # 在 slack 秒内到期的会话合并为同一批关闭
+        self.slack = slack
+        self.max_batch = max_batch
+        self.retry_delay = retry_delay
+        self._heap: List[Tuple[float, int]] = []
+        self._wakeup: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+        # 正在关闭的一批会话
+        self._expiring: Optional[asyncio.Future] = None
+
+    def __len__(self) -> int:
+        return len(self._heap)
+
+    def schedule(self, conv_id: int, last_active: float):
+        """登记会话的到期时间"""
+        deadline = last_active + self.timeout
+        earliest = self._heap[0][0] if self._heap else None
+        heapq.heappush(self._heap, (deadline, conv_id))
+        if self._wakeup and (earliest is None or deadline < earliest):
+            self._wakeup.set()
+
+    async def start(self):
+        """启动后台调度任务"""
+        if self._task:
+            return
+        self._wakeup = asyncio.Event()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self, timeout: float = 10.0):
+        """停止后台调度任务；正在关闭的一批会话不打断，等待其完成（最多 timeout 秒）"""
+        if not self._task:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+        if self._expiring:
+            try:
+                await asyncio.wait_for(asyncio.shield(self._expiring), timeout)
+            except asyncio.TimeoutError:
+                logger.warning(f"关闭超时会话未能在 {timeout:.1f} 秒内完成")
+            except Exception as e:
+                logger.error(f"关闭超时会话失败: {e}")
+            self._expiring = None
+
+    def _pop_expired(self, now: float) -> List[int]:
+        """弹出已到期的会话，仍活跃的重新入堆"""
+        expired: List[int] = []
+        while self._heap and self._heap[0][0] <= now + self.slack and len(expired) < self.max_batch:
+            _, conv_id = heapq.heappop(self._heap)
+            last_active = self.get_last_active(conv_id)
+            if last_active is None:
+                # 会话已被关闭
+                continue
+            deadline = last_active + self.timeout
+            if deadline <= now + self.slack:
+                expired.append(conv_id)
+            else:
+                heapq.heappush(self._heap, (deadline, conv_id))
+        return expired
+
+    async def _run(self):
+        while True:
+            self._wakeup.clear()
+            if self._heap:
+                delay = self._heap[0][0] - time.time()
+            else:
+                delay = None
+
+            if delay is None or delay > 0:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            expired = self._pop_expired(time.time())
+            if not expired:
+                continue
+            self._expiring = asyncio.ensure_future(self.on_expire(expired))
+            try:
+                with EXPIRY_SWEEP_SECONDS.time():
+                    await asyncio.shield(self._expiring)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"关闭超时会话失败: {e}")
+                # 稍后重试
+                retry_at = time.time() + self.retry_delay
+                for conv_id in expired:
+                    heapq.heappush(self._heap, (retry_at, conv_id))
+            self._expiring = None
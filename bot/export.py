@@ -0,0 +1,224 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+会话记录导出
+按 (conv_id, id) 键集分页逐批读取消息，经生成器流式写出 JSONL 或 CSV（可 gzip 压缩），
+内存占用与数据量无关。每批是一个独立的短读事务，导出期间不影响机器人写入
+
+用法：
+    python3 export.py --format csv --since 2024-01-01 --until 2024-02-01 --gzip -o 2024-01.csv.gz
+"""
+
+import argparse
+import configparser
+import csv
+import gzip
+import itertools
+import json
+import re
+import sqlite3
+import sys
+from datetime import datetime, timedelta
+from typing import Any, Dict, Iterable, Iterator, List, NamedTuple, Optional, Sequence, TextIO, Tuple, Union
+
+from sharding import configured_db_paths
+
+# 每条记录的字段（一条消息一行，附带所属会话的信息）
+FIELDS = ('conv_id', 'message_id', 'user_id', 'admin_id', 'sender_id', 'sender',
+          'content', 'media_type', 'file_unique_id', 'timestamp', 'status', 'created_at')
+
+_DATE_RE = re.compile(r'^\d{4}-\d{2}-\d{2}$')
+
+
+class ExportFilter(NamedTuple):
+    """导出条件（时间为 UTC，since 含、until 不含）"""
+    since: Optional[str] = None
+    until: Optional[str] = None
+    admin_id: Optional[int] = None
+    user_id: Optional[int] = None
+
+
+def parse_date(value: str) -> str:
+    """把 YYYY-MM-DD 或 YYYY-MM-DD HH:MM:SS 转为数据库中的时间格式"""
+    for fmt in ('%Y-%m-%d %H:%M:%S', '%Y-%m-%d'):
+        try:
+            return datetime.strptime(value, fmt).strftime('%Y-%m-%d %H:%M:%S')
+        except ValueError:
+            continue
+    raise ValueError(f"无效的日期: {value}")
+
+
+def iter_messages(conn: sqlite3.Connection, filters: ExportFilter = ExportFilter(),
+                  batch_size: int = 1000) -> Iterator[Dict[str, Any]]:
+    """按 (conv_id, id) 顺序逐批读取消息"""
+    conditions = []
+    params: List[Any] = []
+    if filters.since:
+        conditions.append('m.timestamp >= ?')
+        params.append(filters.since)
+    if filters.until:
+        conditions.append('m.timestamp < ?')
+        params.append(filters.until)
+    if filters.admin_id is not None:
+        conditions.append('c.admin_id = ?')
+        params.append(filters.admin_id)
+    if filters.user_id is not None:
+        conditions.append('c.user_id = ?')
+        params.append(filters.user_id)
+    where = ''.join(f' AND {condition}' for condition in conditions)
+    # CROSS JOIN 固定以消息表为外层，沿 (conv_id, id) 索引顺序读取，LIMIT 可以提前结束，
+    # 避免按管理员/用户过滤时先收集全部结果再排序
+    sql = f'''
+        SELECT m.conv_id, m.id, c.user_id, c.admin_id, m.sender_id, m.content, m.media_type,
+               m.file_unique_id, m.timestamp, c.status, c.created_at
+        FROM messages m
+        CROSS JOIN conversations c ON c.id = m.conv_id
+        WHERE (m.conv_id, m.id) > (?, ?){where}
+        ORDER BY m.conv_id, m.id
+        LIMIT ?
+    '''
+
+    last: Tuple[int, int] = (-1, -1)
+    while True:
+        rows = conn.execute(sql, (*last, *params, batch_size)).fetchall()
+        for (conv_id, message_id, user_id, admin_id, sender_id, content, media_type, file_unique_id,
+             timestamp, status, created_at) in rows:
+            yield {
+                'conv_id': conv_id,
+                'message_id': message_id,
+                'user_id': user_id,
+                'admin_id': admin_id,
+                'sender_id': sender_id,
+                'sender': 'admin' if sender_id == admin_id else 'user',
+                'content': content,
+                'media_type': media_type,
+                'file_unique_id': file_unique_id,
+                'timestamp': timestamp,
+                'status': status,
+                'created_at': created_at,
+            }
+        if len(rows) < batch_size:
+            return
+        last = (rows[-1][0], rows[-1][1])
+
+
+def write_jsonl(records: Iterable[Dict[str, Any]], fp: TextIO) -> int:
+    """每行一个 JSON 对象，返回条数"""
+    count = 0
+    for record in records:
+        fp.write(json.dumps(record, ensure_ascii=False))
+        fp.write('\n')
+        count += 1
+    return count
+
+
+def write_csv(records: Iterable[Dict[str, Any]], fp: TextIO) -> int:
+    """带表头的 CSV，返回条数"""
+    writer = csv.DictWriter(fp, fieldnames=FIELDS)
+    writer.writeheader()
+    count = 0
+    for record in records:
+        writer.writerow(record)
+        count += 1
+    return count
+
+
+FORMATS = {
+    'jsonl': write_jsonl,
+    'csv': write_csv,
+}
+
+
+def export(db_path: Union[str, Sequence[str]], output: str, fmt: str = 'jsonl', compress: bool = False,
+           filters: ExportFilter = ExportFilter(), batch_size: int = 1000) -> int:
+    """导出到文件（output 为 '-' 时写到标准输出），返回导出的消息条数；
+    db_path 为多个数据库（分片）时依次导出"""
+    if fmt not in FORMATS:
+        raise ValueError(f"未知的导出格式: {fmt}")
+    db_paths = [db_path] if isinstance(db_path, str) else list(db_path)
+    conns = []
+    try:
+        for path in db_paths:
+            conns.append(sqlite3.connect(f'file:{path}?mode=ro', uri=True))
+        records = itertools.chain.from_iterable(iter_messages(conn, filters, batch_size) for conn in conns)
+        if output == '-':
+            if compress:
+                with gzip.open(sys.stdout.buffer, 'wt', encoding='utf-8', newline='') as fp:
+                    return FORMATS[fmt](records, fp)
+            return FORMATS[fmt](records, sys.stdout)
+        if compress:
+            with gzip.open(output, 'wt', encoding='utf-8', newline='') as fp:
+                return FORMATS[fmt](records, fp)
+        with open(output, 'w', encoding='utf-8', newline='') as fp:
+            return FORMATS[fmt](records, fp)
+    finally:
+        for conn in conns:
+            conn.close()
+
+
+def parse_command_args(args: List[str]) -> Tuple[str, ExportFilter]:
+    """解析 /export 的参数：[jsonl|csv] [起始日期] [结束日期] [admin=ID] [user=ID]"""
+    fmt = 'jsonl'
+    dates = []
+    admin_id = user_id = None
+    for arg in args:
+        key, _, value = arg.partition('=')
+        if arg in FORMATS:
+            fmt = arg
+        elif _DATE_RE.match(arg):
+            dates.append(parse_date(arg))
+        elif key == 'admin' and value.isdigit():
+            admin_id = int(value)
+        elif key == 'user' and value.isdigit():
+            user_id = int(value)
+        else:
+            raise ValueError(f"无法识别的参数: {arg}")
+    if len(dates) > 2:
+        raise ValueError("最多指定起始和结束两个日期")
+    since = dates[0] if dates else None
+    # 结束日期包含当天
+    until = None
+    if len(dates) == 2:
+        end = datetime.strptime(dates[1], '%Y-%m-%d %H:%M:%S') + timedelta(days=1)
+        until = end.strftime('%Y-%m-%d %H:%M:%S')
+    return fmt, ExportFilter(since, until, admin_id, user_id)
+
+
+def main():
+    """命令行入口"""
+    parser = argparse.ArgumentParser(description='导出会话记录')
+    parser.add_argument('--config', default='config.ini', help='配置文件（读取其中的 db_path）')
+    parser.add_argument('--db', help='数据库文件（默认取配置文件中的 db_path，分片模式下为所有分片）')
+    parser.add_argument('--format', choices=sorted(FORMATS), default='jsonl')
+    parser.add_argument('--since', type=parse_date, help='起始时间（UTC，含），YYYY-MM-DD[ HH:MM:SS]')
+    parser.add_argument('--until', type=parse_date, help='结束时间（UTC，不含），YYYY-MM-DD[ HH:MM:SS]')
+    parser.add_argument('--admin', type=int, help='只导出该管理员的会话')
+    parser.add_argument('--user', type=int, help='只导出该用户的会话')
+    parser.add_argument('--gzip', action='store_true', help='gzip 压缩（输出文件名以 .gz 结尾时自动启用）')
+    parser.add_argument('--batch-size', type=int, default=1000, help='每批读取的消息数')
+    parser.add_argument('-o', '--output', default='-', help='输出文件（默认标准输出）')
+    args = parser.parse_args()
+
+    if args.db:
+        db_paths = [args.db]
+    else:
+        config = configparser.ConfigParser()
+        config.read(args.config, encoding='utf-8')
+        db_paths = configured_db_paths(config)
+
+    try:
+        count = export(
+            db_paths, args.output, args.format,
+            compress=args.gzip or args.output.endswith('.gz'),
+            filters=ExportFilter(args.since, args.until, args.admin, args.user),
+            batch_size=args.batch_size
+        )
+    except BrokenPipeError:
+        # 输出被 head 等命令提前关闭
+        sys.stderr.close()
+        return
+    print(f"已导出 {count} 条消息", file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,212 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+常见问题自动回复
+规则文件（INI，每节一条规则）启动时编译成一个 Aho-Corasick 自动机：
+所有关键词一次扫描完成匹配，耗时只与消息长度有关，与规则数量无关。
+正则规则逐条匹配（只检查比关键词结果靠前的规则），适合少量关键词无法表达的规则；
+正则按原样编译（不区分大小写），匹配的是统一全角/半角和大小写后的消息。
+规则文件修改后自动重新编译，编译在后台线程中完成，完成后整体替换，匹配不加锁
+
+规则格式：
+    [退款]
+    keywords = 退款, 退钱, refund
+    regex = 订单.*(取消|撤销)
+    # 只对与这些管理员的会话生效（可选）
+    admins = 财务咨询
+    # 自动回复后是否仍转发给管理员（可选）
+    forward = false
+    answer = 退款将在 3 个工作日内原路退回。
+"""
+
+import asyncio
+import configparser
+import logging
+import os
+import re
+import unicodedata
+from typing import Dict, FrozenSet, List, NamedTuple, Optional, Pattern, Tuple
+
+logger = logging.getLogger(__name__)
+
+_SPLIT_RE = re.compile(r'[,，\n]')
+
+
+class FaqRule(NamedTuple):
+    """一条自动回复规则；admins 为空表示对所有会话生效"""
+    name: str
+    answer: str
+    keywords: Tuple[str, ...] = ()
+    patterns: Tuple[Pattern, ...] = ()
+    admins: FrozenSet[int] = frozenset()
+    forward: bool = False
+
+
+def normalize(text: str) -> str:
+    """统一全角/半角和大小写"""
+    return unicodedata.normalize('NFKC', text).casefold()
+
+
+def load_rules(path: str, admins: Dict[str, int]) -> List[FaqRule]:
+    """读取规则文件，admins 为管理员显示名称到ID的映射；有问题的规则记录日志后跳过"""
+    parser = configparser.ConfigParser(interpolation=None)
+    with open(path, encoding='utf-8') as f:
+        parser.read_file(f)
+    rules = []
+    for name in parser.sections():
+        section = parser[name]
+        answer = section.get('answer', '').strip()
+        keywords = tuple(dict.fromkeys(
+            normalize(k.strip()) for k in _SPLIT_RE.split(section.get('keywords', '')) if k.strip()
+        ))
+        try:
+            patterns = tuple(
+                # 不能对正则本身做 normalize：\D、\S 等会被转成小写，含义相反
+                re.compile(line.strip(), re.IGNORECASE)
+                for line in section.get('regex', '').splitlines() if line.strip()
+            )
+        except re.error as e:
+            logger.error(f"FAQ 规则 [{name}] 的正则表达式无效: {e}")
+            continue
+        admin_ids = set()
+        for admin_name in _SPLIT_RE.split(section.get('admins', '')):
+            admin_name = admin_name.strip()
+            if not admin_name:
+                continue
+            if admin_name not in admins:
+                logger.error(f"FAQ 规则 [{name}] 中的管理员不存在: {admin_name}")
+                continue
+            admin_ids.add(admins[admin_name])
+        if not answer or not (keywords or patterns):
+            logger.error(f"FAQ 规则 [{name}] 缺少 answer 或 keywords/regex，已跳过")
+            continue
+        rules.append(FaqRule(name, answer, keywords, patterns, frozenset(admin_ids),
+                             section.getboolean('forward', fallback=False)))
+    return rules
+
+
+class FaqMatcher:
+    """编译后的规则集（不可变）；多条规则同时匹配时取文件中靠前的一条"""
+
+    def __init__(self, rules: List[FaqRule]):
+        self.rules = rules
+        # Aho-Corasick 自动机：goto[节点][字符] -> 节点，fail 为失配指针，
+        # out 为到达该节点时命中的规则（已并入失配链上的输出，升序）
+        goto: List[Dict[str, int]] = [{}]
+        out: List[List[int]] = [[]]
+        for index, rule in enumerate(rules):
+            for keyword in rule.keywords:
+                node = 0
+                for ch in keyword:
+                    nxt = goto[node].get(ch)
+                    if nxt is None:
+                        nxt = goto[node][ch] = len(goto)
+                        goto.append({})
+                        out.append([])
+                    node = nxt
+                out[node].append(index)
+
+        fail = [0] * len(goto)
+        queue = list(goto[0].values())
+        for node in queue:
+            for ch, nxt in goto[node].items():
+                f = fail[node]
+                while f and ch not in goto[f]:
+                    f = fail[f]
+                fail[nxt] = goto[f].get(ch, 0)
+                out[nxt].extend(out[fail[nxt]])
+                queue.append(nxt)
+
+        self._goto = goto
+        self._fail = fail
+        self._out: List[Tuple[int, ...]] = [tuple(sorted(set(o))) for o in out]
+        self._regex_rules = [(index, rule) for index, rule in enumerate(rules) if rule.patterns]
+
+    def __len__(self) -> int:
+        return len(self.rules)
+
+    def match(self, text: str, admin_id: Optional[int] = None) -> Optional[FaqRule]:
+        """匹配消息；admin_id 为会话的管理员（没有会话时为 None，只匹配通用规则）"""
+        if not self.rules or not text:
+            return None
+        text = normalize(text)
+        rules = self.rules
+
+        def applies(index: int) -> bool:
+            admins = rules[index].admins
+            return not admins or admin_id in admins
+
+        best = len(rules)
+        goto, fail, out = self._goto, self._fail, self._out
+        node = 0
+        for ch in text:
+            while node and ch not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(ch, 0)
+            for index in out[node]:
+                if index >= best:
+                    break
+                if applies(index):
+                    best = index
+                    break
+
+        # 只需检查比当前结果靠前的正则规则
+        for index, rule in self._regex_rules:
+            if index >= best:
+                break
+            if applies(index) and any(p.search(text) for p in rule.patterns):
+                best = index
+                break
+        return rules[best] if best < len(rules) else None
+
+
+class FaqResponder:
+    """从规则文件加载匹配器，文件修改后自动重新编译"""
+
+    def __init__(self, path: str, admins: Dict[str, int]):
+        self.path = path
+        self.admins = admins
+        self.matcher = FaqMatcher([])
+        self._mtime: Optional[float] = None
+
+    def match(self, text: str, admin_id: Optional[int] = None) -> Optional[FaqRule]:
+        return self.matcher.match(text, admin_id)
+
+    def _compile(self) -> FaqMatcher:
+        return FaqMatcher(load_rules(self.path, self.admins))
+
+    def load(self) -> bool:
+        """同步加载（用于启动阶段），返回是否成功"""
+        try:
+            self._mtime = os.path.getmtime(self.path)
+            self.matcher = self._compile()
+        except (OSError, configparser.Error) as e:
+            logger.error(f"加载 FAQ 规则失败: {e}")
+            return False
+        logger.info(f"已加载 {len(self.matcher)} 条 FAQ 规则")
+        return True
+
+    async def set_admins(self, admins: Dict[str, int]):
+        """管理员配置变化后按新的名称重新编译规则"""
+        self.admins = admins
+        self._mtime = None
+        await self.reload_if_changed()
+
+    async def reload_if_changed(self) -> bool:
+        """规则文件修改过时在后台线程重新编译并替换，返回是否重新加载；失败时保留原规则"""
+        try:
+            mtime = os.path.getmtime(self.path)
+        except OSError:
+            return False
+        if mtime == self._mtime:
+            return False
+        try:
+            matcher = await asyncio.to_thread(self._compile)
+        except (OSError, configparser.Error) as e:
+            logger.error(f"重新加载 FAQ 规则失败，继续使用原规则: {e}")
+            self._mtime = mtime
+            return False
+        self._mtime = mtime
+        self.matcher = matcher
+        logger.info(f"FAQ 规则已重新加载，共 {len(matcher)} 条")
+        return True
@@ -0,0 +1,159 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+内嵌 HTTP 服务器
+基于 asyncio.start_server 的最小 HTTP/1.1 实现（支持 keep-alive），
+供 webhook 接收和指标接口使用，不引入额外依赖
+"""
+
+import asyncio
+import logging
+from typing import Awaitable, Callable, Dict, NamedTuple, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+STATUS_TEXT = {
+    200: 'OK',
+    400: 'Bad Request',
+    403: 'Forbidden',
+    404: 'Not Found',
+    405: 'Method Not Allowed',
+    413: 'Payload Too Large',
+    503: 'Service Unavailable',
+}
+
+
+class HttpRequest(NamedTuple):
+    """HTTP 请求"""
+    method: str
+    path: str
+    headers: Dict[str, str]  # 键为小写
+    body: bytes
+
+
+class HttpResponse(NamedTuple):
+    """HTTP 响应"""
+    status: int
+    body: bytes = b''
+    content_type: str = 'text/plain; charset=utf-8'
+
+
+Handler = Callable[[HttpRequest], Awaitable[HttpResponse]]
+
+
+class BadHttpRequest(Exception):
+    """无法解析的请求"""
+
+    def __init__(self, status: int = 400):
+        super().__init__(status)
+        self.status = status
+
+
+async def read_request(reader: asyncio.StreamReader, max_body: int) -> Optional[HttpRequest]:
+    """读取一个请求，连接关闭时返回 None"""
+    try:
+        head = await reader.readuntil(b'\r\n\r\n')
+    except asyncio.IncompleteReadError:
+        return None
+    except asyncio.LimitOverrunError:
+        raise BadHttpRequest(400)
+
+    lines = head.decode('latin-1').split('\r\n')
+    try:
+        method, target, _ = lines[0].split(' ', 2)
+    except ValueError:
+        raise BadHttpRequest(400)
+    headers = {}
+    for line in lines[1:]:
+        if ':' in line:
+            name, value = line.split(':', 1)
+            headers[name.strip().lower()] = value.strip()
+
+    try:
+        length = int(headers.get('content-length', '0'))
+    except ValueError:
+        raise BadHttpRequest(400)
+    if length > max_body:
+        raise BadHttpRequest(413)
+    body = await reader.readexactly(length) if length else b''
+    return HttpRequest(method.upper(), target.split('?', 1)[0], headers, body)
+
+
+def encode_response(response: HttpResponse, keep_alive: bool) -> bytes:
+    """序列化响应"""
+    head = (
+        f"HTTP/1.1 {response.status} {STATUS_TEXT.get(response.status, '')}\r\n"
+        f"Content-Type: {response.content_type}\r\n"
+        f"Content-Length: {len(response.body)}\r\n"
+        f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n"
+        "\r\n"
+    )
+    return head.encode('latin-1') + response.body
+
+
+class HttpServer:
+    """最小 HTTP 服务器"""
+
+    def __init__(self, handler: Handler, host: str = '127.0.0.1', port: int = 0,
+                 max_body: int = 1 << 20):
+        self.handler = handler
+        self.host = host
+        self.port = port
+        self.max_body = max_body
+        self._server: Optional[asyncio.AbstractServer] = None
+        self._connections: set = set()
+
+    @property
+    def address(self) -> Tuple[str, int]:
+        """实际监听的地址（port=0 时由系统分配）"""
+        return self._server.sockets[0].getsockname()[:2]
+
+    async def start(self):
+        """开始监听"""
+        self._server = await asyncio.start_server(self._handle_connection, self.host, self.port)
+        logger.info(f"HTTP 服务监听于 {self.address[0]}:{self.address[1]}")
+
+    async def close(self):
+        """停止监听并关闭所有连接"""
+        if not self._server:
+            return
+        self._server.close()
+        for writer in list(self._connections):
+            writer.close()
+        await self._server.wait_closed()
+        self._server = None
+
+    def stop_accepting(self):
+        """停止接受新连接（已建立的连接不受影响）"""
+        if self._server:
+            self._server.close()
+
+    async def _handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self._connections.add(writer)
+        try:
+            while True:
+                try:
+                    request = await read_request(reader, self.max_body)
+                except BadHttpRequest as e:
+                    writer.write(encode_response(HttpResponse(e.status), keep_alive=False))
+                    await writer.drain()
+                    break
+                if request is None:
+                    break
+
+                try:
+                    response = await self.handler(request)
+                except Exception as e:
+                    logger.error(f"处理 HTTP 请求失败: {e}")
+                    response = HttpResponse(503)
+
+                keep_alive = request.headers.get('connection', '').lower() != 'close'
+                writer.write(encode_response(response, keep_alive))
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            self._connections.discard(writer)
+            writer.close()
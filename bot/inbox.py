@@ -0,0 +1,297 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+管理员收件箱（摘要模式）
+每个管理员一条置顶的“收件箱”消息，列出其活跃会话、未读条数和回复按钮。
+新会话和用户消息只更新内存中的状态，收件箱按固定间隔合并刷新（edit_message_text），
+内容没有变化时不发送，每个管理员的出站调用次数与消息量无关。
+管理员点击会话按钮时再一次性发送该会话的未读消息。
+分片模式下收件箱只在主进程中维护（每个管理员仍只有一条收件箱消息），工作进程经 InboxRelay 把事件发给主进程
+"""
+
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+
+from burst import MAX_MESSAGE_LENGTH
+from outbox import OutboundDispatcher
+
+logger = logging.getLogger(__name__)
+
+# 预览文字的最大长度
+PREVIEW_LENGTH = 40
+
+# 工作进程可以转发给主进程收件箱的事件
+RELAYED_EVENTS = frozenset({'track', 'user_message', 'show_unread', 'mark_read', 'remove'})
+
+
+class UnreadItem:
+    """一条未读消息；媒体消息带有原消息位置 (chat_id, message_id)，打开会话时复制给管理员"""
+
+    __slots__ = ('text', 'source', 'at')
+
+    def __init__(self, text: str, source: Optional[Tuple[int, int]], at: float):
+        self.text = text
+        self.source = source
+        self.at = at
+
+
+class InboxEntry:
+    """收件箱中的一个会话"""
+
+    __slots__ = ('conv_id', 'label', 'unread', 'last_at')
+
+    def __init__(self, conv_id: int, label: str, now: float):
+        self.conv_id = conv_id
+        self.label = label
+        self.unread: List[UnreadItem] = []
+        self.last_at = now
+
+
+class AdminInboxState:
+    """一个管理员的收件箱"""
+
+    __slots__ = ('admin_id', 'entries', 'message_id', 'rendered', 'refreshed_at', 'timer', 'in_flight', 'dirty')
+
+    def __init__(self, admin_id: int):
+        self.admin_id = admin_id
+        self.entries: 'OrderedDict[int, InboxEntry]' = OrderedDict()
+        self.message_id: Optional[int] = None
+        # 上次发出的内容（文字 + 按钮），相同则不再编辑
+        self.rendered: Optional[Tuple[str, Any]] = None
+        self.refreshed_at = float('-inf')
+        self.timer: Optional[asyncio.TimerHandle] = None
+        self.in_flight = False
+        self.dirty = False
+
+
+class AdminInbox:
+    """所有管理员的收件箱（仅在事件循环线程中访问）"""
+
+    def __init__(self, outbox: OutboundDispatcher, interval: float = 3.0, max_unread: int = 50,
+                 max_buttons: int = 20):
+        self.outbox = outbox
+        self.interval = interval
+        self.max_unread = max_unread
+        self.max_buttons = max_buttons
+        self._admins: Dict[int, AdminInboxState] = {}
+        self._admin_of: Dict[int, int] = {}
+
+    def _state(self, admin_id: int) -> AdminInboxState:
+        state = self._admins.get(admin_id)
+        if state is None:
+            state = self._admins[admin_id] = AdminInboxState(admin_id)
+        return state
+
+    def unread_count(self, conv_id: int) -> int:
+        """会话的未读条数"""
+        admin_id = self._admin_of.get(conv_id)
+        entry = self._admins[admin_id].entries.get(conv_id) if admin_id is not None else None
+        return len(entry.unread) if entry else 0
+
+    # ---- 事件 ----
+
+    def track(self, admin_id: int, conv_id: int, label: str, now: Optional[float] = None):
+        """登记会话（新会话或启动时已有的活跃会话）"""
+        now = time.time() if now is None else now
+        state = self._state(admin_id)
+        if conv_id not in state.entries:
+            state.entries[conv_id] = InboxEntry(conv_id, label, now)
+            self._admin_of[conv_id] = admin_id
+        self._touch(state)
+
+    def user_message(self, admin_id: int, conv_id: int, label: str, text: str,
+                     source: Optional[Tuple[int, int]] = None, now: Optional[float] = None):
+        """记录一条未读的用户消息"""
+        now = time.time() if now is None else now
+        state = self._state(admin_id)
+        entry = state.entries.get(conv_id)
+        if entry is None:
+            entry = state.entries[conv_id] = InboxEntry(conv_id, label, now)
+            self._admin_of[conv_id] = admin_id
+        entry.unread.append(UnreadItem(text, source, now))
+        if len(entry.unread) > self.max_unread:
+            # 只保留最近的未读消息，其余可通过 /history 查看
+            del entry.unread[0]
+        entry.last_at = now
+        self._touch(state)
+
+    def open(self, conv_id: int) -> List[UnreadItem]:
+        """管理员打开会话：取出并清空未读消息"""
+        admin_id = self._admin_of.get(conv_id)
+        if admin_id is None:
+            return []
+        state = self._admins[admin_id]
+        entry = state.entries[conv_id]
+        items, entry.unread = entry.unread, []
+        if items:
+            self._touch(state)
+        return items
+
+    def show_unread(self, chat_id: int, conv_id: int, prompt: str):
+        """管理员打开会话：一次发送全部未读文字，媒体逐条复制"""
+        items = self.open(conv_id)
+        lines = [f"📨 会话 #{conv_id} 的 {len(items)} 条未读消息：", ""] if items else []
+        lines.extend(f"💬 {item.text}" for item in items)
+        lines.append(prompt if not items else f"\n{prompt}")
+        text = '\n'.join(lines)
+        if len(text) > MAX_MESSAGE_LENGTH:
+            # 保留最近的消息
+            text = '…' + text[-(MAX_MESSAGE_LENGTH - 1):]
+        self.outbox.send_message(chat_id, text)
+        for item in items:
+            if item.source:
+                from_chat_id, message_id = item.source
+                self.outbox.enqueue('copy_message', chat_id, from_chat_id=from_chat_id, message_id=message_id)
+
+    def mark_read(self, conv_id: int):
+        """管理员已回复"""
+        self.open(conv_id)
+
+    def remove(self, conv_id: int):
+        """会话结束"""
+        admin_id = self._admin_of.pop(conv_id, None)
+        if admin_id is None:
+            return
+        state = self._admins[admin_id]
+        del state.entries[conv_id]
+        self._touch(state)
+
+    def close(self):
+        """停止所有待执行的刷新"""
+        for state in self._admins.values():
+            if state.timer:
+                state.timer.cancel()
+                state.timer = None
+
+    # ---- 刷新 ----
+
+    def _touch(self, state: AdminInboxState):
+        """标记需要刷新，按间隔合并"""
+        state.dirty = True
+        if state.timer or state.in_flight:
+            return
+        loop = asyncio.get_running_loop()
+        delay = max(0.0, state.refreshed_at + self.interval - loop.time())
+        state.timer = loop.call_later(delay, self._flush, state)
+
+    def _flush(self, state: AdminInboxState):
+        state.timer = None
+        if not state.dirty:
+            return
+        state.dirty = False
+        text, keyboard = self.render(state)
+        rendered = (text, keyboard.to_dict() if keyboard else None)
+        if rendered == state.rendered and state.message_id is not None:
+            return
+        state.refreshed_at = asyncio.get_running_loop().time()
+        state.in_flight = True
+
+        async def sent(message):
+            new = state.message_id is None
+            state.message_id = message.message_id
+            state.rendered = rendered
+            if new:
+                self.outbox.enqueue('pin_chat_message', state.admin_id, message_id=message.message_id,
+                                    disable_notification=True)
+            self._done(state)
+
+        async def failed(error: Exception):
+            if state.message_id is not None and 'not found' in str(error).lower():
+                # 收件箱消息被删除，重新发送一条
+                state.message_id = None
+                state.dirty = True
+            # 其他失败等下一次变化时再刷新
+            self._done(state)
+
+        if state.message_id is None:
+            self.outbox.send_message(state.admin_id, text, reply_markup=keyboard, on_sent=sent, on_failed=failed)
+        else:
+            self.outbox.enqueue('edit_message_text', state.admin_id, message_id=state.message_id, text=text,
+                                reply_markup=keyboard, on_sent=sent, on_failed=failed)
+
+    def _done(self, state: AdminInboxState):
+        """一次刷新完成；期间有新变化时在间隔后再次刷新"""
+        state.in_flight = False
+        if state.dirty:
+            state.dirty = False
+            self._touch(state)
+
+    def render(self, state: AdminInboxState) -> Tuple[str, Optional[InlineKeyboardMarkup]]:
+        """收件箱内容：有未读的会话在前，按最后消息时间倒序"""
+        entries = sorted(state.entries.values(), key=lambda e: (not e.unread, -e.last_at))
+        unread = sum(len(e.unread) for e in entries)
+        header = f"📥 收件箱：{len(entries)} 个会话，{unread} 条未读"
+        if not entries:
+            return f"{header}\n\n暂无活跃会话。", None
+
+        lines = [header, ""]
+        shown = 0
+        for entry in entries:
+            mark = f"🔴 {len(entry.unread)} 条未读" if entry.unread else "⚪ 无未读"
+            line = f"#{entry.conv_id} {entry.label} · {mark} · {time.strftime('%H:%M', time.localtime(entry.last_at))}"
+            if entry.unread:
+                preview = entry.unread[-1].text
+                if len(preview) > PREVIEW_LENGTH:
+                    preview = preview[:PREVIEW_LENGTH - 1] + '…'
+                line += f"\n    “{preview}”"
+            # 为“还有 N 个会话”留出余量
+            if sum(len(l) + 1 for l in lines) + len(line) + 30 > MAX_MESSAGE_LENGTH:
+                break
+            lines.append(line)
+            shown += 1
+        if shown < len(entries):
+            lines.append(f"…还有 {len(entries) - shown} 个会话")
+
+        buttons = [
+            InlineKeyboardButton(
+                f"💬 #{entry.conv_id}" + (f" ({len(entry.unread)})" if entry.unread else ""),
+                callback_data=f"reply_{entry.conv_id}"
+            )
+            for entry in entries[:min(shown, self.max_buttons)]
+        ]
+        keyboard = InlineKeyboardMarkup([buttons[i:i + 2] for i in range(0, len(buttons), 2)])
+        return '\n'.join(lines), keyboard
+
+
+class InboxRelay:
+    """分片模式下工作进程使用的收件箱：接口与 AdminInbox 相同，事件经队列交给主进程中的 AdminInbox"""
+
+    def __init__(self, events):
+        self.events = events
+
+    def _post(self, name: str, *args):
+        # 队列不限长度，put_nowait 不会阻塞事件循环
+        self.events.put_nowait((name, args))
+
+    def track(self, admin_id: int, conv_id: int, label: str, now: Optional[float] = None):
+        self._post('track', admin_id, conv_id, label, now)
+
+    def user_message(self, admin_id: int, conv_id: int, label: str, text: str,
+                     source: Optional[Tuple[int, int]] = None, now: Optional[float] = None):
+        self._post('user_message', admin_id, conv_id, label, text, source, now)
+
+    def show_unread(self, chat_id: int, conv_id: int, prompt: str):
+        self._post('show_unread', chat_id, conv_id, prompt)
+
+    def mark_read(self, conv_id: int):
+        self._post('mark_read', conv_id)
+
+    def remove(self, conv_id: int):
+        self._post('remove', conv_id)
+
+    def close(self):
+        """收件箱由主进程关闭"""
+
+
+def apply_event(inbox: AdminInbox, event: Tuple[str, tuple]):
+    """在主进程的收件箱上执行工作进程发来的事件"""
+    name, args = event
+    if name not in RELAYED_EVENTS:
+        logger.warning(f"忽略未知的收件箱事件: {name}")
+        return
+    getattr(inbox, name)(*args)
@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+出站调用日志
+平滑停机时，出站队列在期限内没有发完的调用写入日志文件（每行一个 JSON，每次整体替换为当时的快照），
+下次启动时重新入队，全部发送成功或记为死信后才删除；重放完成前再次平滑停机时，
+剩余的调用（包括尚未发出的重放调用）重新写入日志，滚动重启不丢消息。
+日志只在停机时写入：进程崩溃或被强制结束时，内存中的出站队列不会保存。
+回调（如记录通知与会话的对应关系）不写入日志，重放的通知仍可通过按钮回复
+"""
+
+import json
+import logging
+import os
+from typing import Any, Dict, Iterable, List, Optional
+
+from telegram import InlineKeyboardMarkup
+
+from outbox import OutboundJob
+
+logger = logging.getLogger(__name__)
+
+
+def encode_job(job: OutboundJob) -> Optional[Dict[str, Any]]:
+    """调用的 JSON 表示；含有无法序列化的参数（如待上传的文件）时返回 None"""
+    kwargs = {}
+    for key, value in job.kwargs.items():
+        if isinstance(value, InlineKeyboardMarkup):
+            value = value.to_dict()
+        elif not isinstance(value, (str, int, float, bool, type(None))):
+            return None
+        kwargs[key] = value
+    return {'method': job.method, 'chat_id': job.chat_id, 'kwargs': kwargs}
+
+
+def decode_kwargs(kwargs: Dict[str, Any], bot=None) -> Dict[str, Any]:
+    """恢复调用参数中的按钮"""
+    markup = kwargs.get('reply_markup')
+    if isinstance(markup, dict):
+        kwargs = dict(kwargs, reply_markup=InlineKeyboardMarkup.de_json(markup, bot))
+    return kwargs
+
+
+class Journal:
+    """停机时未发送调用的快照文件"""
+
+    def __init__(self, path: str):
+        self.path = path
+
+    def write(self, jobs: Iterable[OutboundJob]) -> List[OutboundJob]:
+        """以这些调用替换日志内容（先写临时文件并落盘再改名），返回无法写入日志的调用；没有调用时删除日志"""
+        skipped = []
+        lines = []
+        for job in jobs:
+            record = encode_job(job)
+            if record is None:
+                skipped.append(job)
+                continue
+            lines.append(json.dumps(record, ensure_ascii=False) + '\n')
+        if not lines:
+            self.clear()
+            return skipped
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.writelines(lines)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+        logger.info(f"{len(lines)} 条未发送的出站调用已写入日志 {self.path}")
+        return skipped
+
+    def read(self) -> List[Dict[str, Any]]:
+        """读取全部记录；写到一半的最后一行（进程被强制结束）跳过"""
+        try:
+            with open(self.path, encoding='utf-8') as f:
+                lines = f.readlines()
+        except FileNotFoundError:
+            return []
+        records = []
+        for number, line in enumerate(lines, 1):
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                logger.error(f"出站调用日志第 {number} 行无法解析，已跳过")
+        return records
+
+    def clear(self):
+        """重放的调用全部完成后删除日志"""
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
@@ -0,0 +1,55 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+按键加锁
+并发处理更新时，同一用户（或同一会话）的处理按到达顺序依次执行，不同用户之间互不影响。
+锁只在有协程持有或等待时存在，不会随用户数增长
+"""
+
+import asyncio
+from collections import Counter
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Dict, Hashable
+
+
+class KeyedLock:
+    """每个键一把 asyncio.Lock（仅在事件循环线程中使用）"""
+
+    def __init__(self):
+        self._locks: Dict[Hashable, asyncio.Lock] = {}
+        # 持有或等待各个锁的协程数，归零时回收
+        self._users: Counter = Counter()
+
+    def __len__(self) -> int:
+        return len(self._locks)
+
+    def locked(self, key: Hashable) -> bool:
+        """该键当前是否被持有"""
+        lock = self._locks.get(key)
+        return lock is not None and lock.locked()
+
+    @asynccontextmanager
+    async def hold(self, *keys: Hashable) -> AsyncIterator[None]:
+        """持有若干键的锁；多个键按排序后的顺序获取，避免互相等待形成死锁
+
+        asyncio.Lock 按等待顺序唤醒，同一键的协程按调用 hold 的先后执行
+        """
+        ordered = sorted(set(keys))
+        for key in ordered:
+            self._users[key] += 1
+            if key not in self._locks:
+                self._locks[key] = asyncio.Lock()
+        acquired = []
+        try:
+            for key in ordered:
+                await self._locks[key].acquire()
+                acquired.append(key)
+            yield
+        finally:
+            for key in reversed(acquired):
+                self._locks[key].release()
+            for key in ordered:
+                self._users[key] -= 1
+                if not self._users[key]:
+                    del self._users[key]
+                    del self._locks[key]
@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+媒体消息
+图片、文件、语音等通过 copy_message 按 file_id 在用户和管理员之间转发，机器人不下载也不重新上传。
+消息表只保存简短的媒体描述（类型、file_unique_id、说明文字），
+同一文件的 file_id 只在第一次出现时写入 media_files 表
+"""
+
+from collections import OrderedDict
+from typing import NamedTuple, Optional
+
+from write_behind import WriteBehindQueue
+
+# 媒体类型及显示名称
+MEDIA_LABELS = {
+    'photo': '图片',
+    'video': '视频',
+    'animation': '动图',
+    'document': '文件',
+    'audio': '音频',
+    'voice': '语音',
+    'video_note': '视频消息',
+    'sticker': '贴纸',
+}
+
+# 不能附带说明文字的类型
+CAPTIONLESS_TYPES = ('video_note', 'sticker')
+
+# Telegram 说明文字的最大长度
+MAX_CAPTION_LENGTH = 1024
+
+
+class MediaDescriptor(NamedTuple):
+    """媒体描述"""
+    media_type: str
+    file_unique_id: str
+    file_id: str
+    caption: str
+
+
+def describe(message) -> Optional[MediaDescriptor]:
+    """提取消息中的媒体，不是媒体消息时返回 None"""
+    for media_type in MEDIA_LABELS:
+        media = getattr(message, media_type, None)
+        if not media:
+            continue
+        if media_type == 'photo':
+            # 同一图片的多个尺寸，取最大的
+            media = media[-1]
+        return MediaDescriptor(media_type, media.file_unique_id, media.file_id, message.caption or '')
+    return None
+
+
+def media_label(media_type: Optional[str], content: str) -> str:
+    """消息的文字表示，如 "[图片] 说明文字" """
+    if not media_type:
+        return content
+    label = f"[{MEDIA_LABELS.get(media_type, media_type)}]"
+    return f"{label} {content}" if content else label
+
+
+def fit_caption(caption: str) -> str:
+    """截断超长的说明文字"""
+    if len(caption) <= MAX_CAPTION_LENGTH:
+        return caption
+    return caption[:MAX_CAPTION_LENGTH - 1] + '…'
+
+
+class MediaCache:
+    """file_unique_id 去重缓存：已见过的文件不再写数据库"""
+
+    def __init__(self, write_behind: WriteBehindQueue, capacity: int = 10000):
+        self.write_behind = write_behind
+        self.capacity = capacity
+        self._cache: 'OrderedDict[str, str]' = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._cache)
+
+    def get(self, file_unique_id: str) -> Optional[str]:
+        """已缓存文件的 file_id"""
+        return self._cache.get(file_unique_id)
+
+    async def remember(self, media: MediaDescriptor) -> bool:
+        """记录文件，第一次见到时返回 True"""
+        if media.file_unique_id in self._cache:
+            self._cache.move_to_end(media.file_unique_id)
+            return False
+        self._cache[media.file_unique_id] = media.file_id
+        if len(self._cache) > self.capacity:
+            self._cache.popitem(last=False)
+        # 缓存淘汰后再次出现的文件会重复写入，数据库使用 INSERT OR IGNORE
+        await self.write_behind.put_media(media.file_unique_id, media.file_id, media.media_type)
+        return True
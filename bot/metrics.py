@@ -0,0 +1,327 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+运行指标
+计数器、延迟直方图和回调式仪表，以 Prometheus 文本格式通过本地 HTTP 接口导出。
+记录指标只做几次加法；格式化只在被抓取时进行，没人抓取时几乎没有开销
+"""
+
+import asyncio
+import bisect
+import functools
+import logging
+import time
+from typing import Callable, Dict, Iterable, List, Optional, Tuple, Union
+
+from http_server import HttpRequest, HttpResponse, HttpServer
+
+logger = logging.getLogger(__name__)
+
+# 默认延迟桶（秒）
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+GaugeValue = Union[float, Dict[Tuple[str, ...], float]]
+
+
+def _escape(value: str) -> str:
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(names: Iterable[str], values: Iterable[str], extra: str = '') -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _format_value(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    """带标签的指标：每组标签值对应一个子指标"""
+
+    kind = ''
+
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children: Dict[Tuple[str, ...], object] = {}
+        if not self.labelnames:
+            self._children[()] = self._new_child()
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def labels(self, *values, **kwargs):
+        """取得一组标签值对应的子指标（可预先取得以省去每次查找）"""
+        if kwargs:
+            values = tuple(str(kwargs[name]) for name in self.labelnames)
+        else:
+            values = tuple(str(value) for value in values)
+        if len(values) != len(self.labelnames):
+            raise ValueError(f"指标 {self.name} 需要标签 {self.labelnames}")
+        child = self._children.get(values)
+        if child is None:
+            child = self._children[values] = self._new_child()
+        return child
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        for values, child in sorted(self._children.items()):
+            lines.extend(self._render_child(values, child))
+        return lines
+
+    def _render_child(self, values: Tuple[str, ...], child) -> List[str]:
+        raise NotImplementedError
+
+
+class _CounterChild:
+    __slots__ = ('value',)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount: float = 1):
+        self.value += amount
+
+
+class Counter(_Metric):
+    """只增不减的计数器"""
+
+    kind = 'counter'
+
+    def _new_child(self):
+        return _CounterChild()
+
+    def inc(self, amount: float = 1):
+        self._children[()].inc(amount)
+
+    @property
+    def value(self) -> float:
+        return self._children[()].value
+
+    def _render_child(self, values, child) -> List[str]:
+        return [f"{self.name}{_format_labels(self.labelnames, values)} {_format_value(child.value)}"]
+
+
+class _HistogramChild:
+    __slots__ = ('bounds', 'counts', 'sum', 'count')
+
+    def __init__(self, bounds: Tuple[float, ...]):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def time(self) -> '_Timer':
+        """计时上下文管理器"""
+        return _Timer(self)
+
+
+class _Timer:
+    __slots__ = ('child', 'start')
+
+    def __init__(self, child: _HistogramChild):
+        self.child = child
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.child.observe(time.perf_counter() - self.start)
+        return False
+
+
+class Histogram(_Metric):
+    """延迟直方图（固定桶）"""
+
+    kind = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = (),
+                 buckets: Iterable[float] = DEFAULT_BUCKETS):
+        self.bounds = tuple(sorted(buckets))
+        super().__init__(name, documentation, labelnames)
+
+    def _new_child(self):
+        return _HistogramChild(self.bounds)
+
+    def observe(self, value: float):
+        self._children[()].observe(value)
+
+    def time(self) -> _Timer:
+        return self._children[()].time()
+
+    def _render_child(self, values, child: _HistogramChild) -> List[str]:
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.bounds + (float('inf'),), child.counts):
+            cumulative += count
+            labels = _format_labels(self.labelnames, values, f'le="{_format_value(float(bound))}"')
+            lines.append(f"{self.name}_bucket{labels} {cumulative}")
+        labels = _format_labels(self.labelnames, values)
+        lines.append(f"{self.name}_sum{labels} {_format_value(child.sum)}")
+        lines.append(f"{self.name}_count{labels} {child.count}")
+        return lines
+
+
+class Gauge:
+    """回调式仪表：抓取时调用 fn 取值
+
+    fn 返回一个数，或 {标签值元组: 数} 的字典
+    """
+
+    kind = 'gauge'
+
+    def __init__(self, name: str, documentation: str, fn: Callable[[], GaugeValue],
+                 labelnames: Tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.fn = fn
+        self.labelnames = tuple(labelnames)
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        try:
+            value = self.fn()
+        except Exception as e:
+            logger.error(f"读取指标 {self.name} 失败: {e}")
+            return lines
+        if isinstance(value, dict):
+            for values, item in sorted(value.items()):
+                if not isinstance(values, tuple):
+                    values = (values,)
+                lines.append(f"{self.name}{_format_labels(self.labelnames, values)} {_format_value(item)}")
+        else:
+            lines.append(f"{self.name} {_format_value(value)}")
+        return lines
+
+
+class Registry:
+    """指标注册表（同名指标后注册的覆盖先注册的）"""
+
+    def __init__(self):
+        self._metrics: Dict[str, Union[_Metric, Gauge]] = {}
+
+    def register(self, metric):
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, documentation: str, labelnames: Tuple[str, ...] = ()) -> Counter:
+        return self.register(Counter(name, documentation, labelnames))
+
+    def histogram(self, name: str, documentation: str, labelnames: Tuple[str, ...] = (),
+                  buckets: Iterable[float] = DEFAULT_BUCKETS) -> Histogram:
+        return self.register(Histogram(name, documentation, labelnames, buckets))
+
+    def gauge(self, name: str, documentation: str, fn: Callable[[], GaugeValue],
+              labelnames: Tuple[str, ...] = ()) -> Gauge:
+        return self.register(Gauge(name, documentation, fn, labelnames))
+
+    def get(self, name: str):
+        return self._metrics.get(name)
+
+    def render(self) -> str:
+        """Prometheus 文本格式"""
+        lines = []
+        for metric in self._metrics.values():
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+HANDLER_SECONDS = REGISTRY.histogram(
+    'bot_handler_seconds', '处理器耗时', ('handler',))
+HANDLER_ERRORS = REGISTRY.counter(
+    'bot_handler_errors_total', '处理器抛出的异常数', ('handler',))
+CALL_SECONDS = REGISTRY.histogram(
+    'bot_call_seconds', '会话和消息操作耗时', ('call',))
+STORAGE_SECONDS = REGISTRY.histogram(
+    'bot_storage_seconds', '存储操作耗时（含等待数据库线程的时间）', ('op',))
+STORAGE_ERRORS = REGISTRY.counter(
+    'bot_storage_errors_total', '存储操作失败数', ('op',))
+SEND_SECONDS = REGISTRY.histogram(
+    'bot_send_seconds', 'Bot API 调用耗时', ('method',))
+SEND_RESULTS = REGISTRY.counter(
+    'bot_send_total', 'Bot API 调用结果（ok / retry / failed）', ('method', 'result'))
+EXPIRY_SWEEP_SECONDS = REGISTRY.histogram(
+    'bot_expiry_sweep_seconds', '一次超时关闭的耗时')
+EXPIRED_CONVERSATIONS = REGISTRY.counter(
+    'bot_expired_conversations_total', '超时关闭的会话数')
+FAQ_REPLIES = REGISTRY.counter(
+    'bot_faq_replies_total', '自动回复的消息数')
+ADMISSION_RESULTS = REGISTRY.counter(
+    'bot_admission_total', '用户更新的准入结果（admitted / throttled / overloaded / blocked）', ('result',))
+DUPLICATE_UPDATES = REGISTRY.counter(
+    'bot_duplicate_updates_total', '丢弃的重复投递更新数')
+
+
+def timed(histogram: Histogram, errors: Optional[Counter] = None, **labels):
+    """装饰器：记录函数（同步或异步）的耗时和异常数"""
+    child = histogram.labels(**labels) if labels else histogram.labels()
+    error_child = (errors.labels(**labels) if labels else errors.labels()) if errors else None
+
+    def decorator(fn):
+        if asyncio.iscoroutinefunction(fn):
+            @functools.wraps(fn)
+            async def async_wrapper(*args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    return await fn(*args, **kwargs)
+                except Exception:
+                    if error_child:
+                        error_child.inc()
+                    raise
+                finally:
+                    child.observe(time.perf_counter() - start)
+            return async_wrapper
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            except Exception:
+                if error_child:
+                    error_child.inc()
+                raise
+            finally:
+                child.observe(time.perf_counter() - start)
+        return wrapper
+
+    return decorator
+
+
+class MetricsServer:
+    """在本地端口以 Prometheus 文本格式导出指标"""
+
+    def __init__(self, registry: Registry = REGISTRY, host: str = '127.0.0.1', port: int = 9100,
+                 path: str = '/metrics'):
+        self.registry = registry
+        self.path = path
+        self.http = HttpServer(self._handle, host, port)
+
+    async def start(self):
+        await self.http.start()
+
+    async def close(self):
+        await self.http.close()
+
+    async def _handle(self, request: HttpRequest) -> HttpResponse:
+        if request.path != self.path:
+            return HttpResponse(404)
+        if request.method != 'GET':
+            return HttpResponse(405)
+        return HttpResponse(200, self.registry.render().encode('utf-8'), CONTENT_TYPE)
@@ -0,0 +1,275 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+数据库结构迁移
+schema_version 表记录已执行的版本，启动时按顺序执行未执行的迁移步骤。
+修改表结构时在 MIGRATIONS 末尾追加新版本，不要修改已发布的步骤。
+"""
+
+import logging
+import sqlite3
+from typing import Callable, List, NamedTuple, Sequence, Union
+
+logger = logging.getLogger(__name__)
+
+
+class Migration(NamedTuple):
+    """一个迁移版本：SQL 语句列表或 fn(conn)"""
+    version: int
+    description: str
+    steps: Union[Sequence[str], Callable[[sqlite3.Connection], None]]
+
+
+def _create_message_search(conn: sqlite3.Connection):
+    """消息全文索引（FTS5 外部内容表，由触发器随消息表同步）
+
+    trigram 分词不依赖空格，适合中文；SQLite 3.34 以前没有 trigram 时退回 unicode61。
+    迁移前已有的消息由 search_backfill 记录范围，启动后在后台分批补建索引
+    """
+    try:
+        conn.execute('''
+            CREATE VIRTUAL TABLE messages_fts USING fts5(
+                content, content='messages', content_rowid='id', tokenize='trigram'
+            )
+        ''')
+    except sqlite3.OperationalError:
+        logger.warning("SQLite 不支持 trigram 分词，全文搜索使用 unicode61 分词")
+        conn.execute('''
+            CREATE VIRTUAL TABLE messages_fts USING fts5(
+                content, content='messages', content_rowid='id'
+            )
+        ''')
+    conn.execute('''
+        CREATE TRIGGER messages_fts_insert AFTER INSERT ON messages BEGIN
+            INSERT INTO messages_fts (rowid, content) VALUES (new.id, new.content);
+        END
+    ''')
+    conn.execute('''
+        CREATE TRIGGER messages_fts_delete AFTER DELETE ON messages BEGIN
+            INSERT INTO messages_fts (messages_fts, rowid, content) VALUES ('delete', old.id, old.content);
+        END
+    ''')
+    conn.execute('''
+        CREATE TABLE search_backfill (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            next_id INTEGER NOT NULL,
+            end_id INTEGER NOT NULL
+        )
+    ''')
+    conn.execute('INSERT INTO search_backfill (id, next_id, end_id) SELECT 1, 0, COALESCE(MAX(id), 0) FROM messages')
+
+
+def _create_admin_stats(conn: sqlite3.Connection):
+    """管理员统计汇总表，迁移前已有的会话和消息在此一次性汇总
+
+    旧数据没有消息类别，按内容区分新会话通知和自动回复；已归档会话的消息不在数据库中，只计入会话数
+    """
+    conn.execute('ALTER TABLE conversations ADD COLUMN first_response_at TIMESTAMP')
+    conn.execute('''
+        CREATE TABLE admin_stats_hourly (
+            admin_id INTEGER NOT NULL,
+            hour TEXT NOT NULL,
+            opened INTEGER NOT NULL DEFAULT 0,
+            closed INTEGER NOT NULL DEFAULT 0,
+            user_messages INTEGER NOT NULL DEFAULT 0,
+            admin_messages INTEGER NOT NULL DEFAULT 0,
+            auto_replies INTEGER NOT NULL DEFAULT 0,
+            first_responses INTEGER NOT NULL DEFAULT 0,
+            first_response_seconds REAL NOT NULL DEFAULT 0,
+            resolution_seconds REAL NOT NULL DEFAULT 0,
+            PRIMARY KEY (admin_id, hour)
+        ) WITHOUT ROWID
+    ''')
+    reply = "m.sender_id = c.admin_id AND m.content NOT LIKE '🔔 新用户咨询%' AND m.content NOT LIKE '[自动回复]%'"
+    conn.execute(f'''
+        UPDATE conversations SET first_response_at = (
+            SELECT MIN(m.timestamp) FROM messages m, conversations c
+            WHERE c.id = conversations.id AND m.conv_id = c.id AND {reply}
+        )
+    ''')
+    hour = "strftime('%Y-%m-%d %H:00:00', {})"
+    conn.execute(f'''
+        INSERT INTO admin_stats_hourly (admin_id, hour, opened)
+        SELECT admin_id, {hour.format('created_at')}, COUNT(*) FROM conversations
+        WHERE 1 GROUP BY 1, 2
+    ''')
+    conn.execute(f'''
+        INSERT INTO admin_stats_hourly (admin_id, hour, closed, resolution_seconds)
+        SELECT admin_id, {hour.format('last_active')}, COUNT(*),
+               SUM(MAX(0, strftime('%s', last_active) - strftime('%s', created_at)))
+        FROM conversations
+        WHERE status != 'active' GROUP BY 1, 2
+        ON CONFLICT (admin_id, hour) DO UPDATE SET
+            closed = closed + excluded.closed, resolution_seconds = resolution_seconds + excluded.resolution_seconds
+    ''')
+    conn.execute(f'''
+        INSERT INTO admin_stats_hourly (admin_id, hour, user_messages, admin_messages, auto_replies)
+        SELECT c.admin_id, {hour.format('m.timestamp')}, SUM(m.sender_id = c.user_id), SUM({reply}),
+               SUM(m.sender_id = c.admin_id AND m.content LIKE '[自动回复]%')
+        FROM messages m JOIN conversations c ON c.id = m.conv_id
+        WHERE 1 GROUP BY 1, 2
+        ON CONFLICT (admin_id, hour) DO UPDATE SET
+            user_messages = user_messages + excluded.user_messages,
+            admin_messages = admin_messages + excluded.admin_messages,
+            auto_replies = auto_replies + excluded.auto_replies
+    ''')
+    conn.execute(f'''
+        INSERT INTO admin_stats_hourly (admin_id, hour, first_responses, first_response_seconds)
+        SELECT admin_id, {hour.format('first_response_at')}, COUNT(*),
+               SUM(MAX(0, strftime('%s', first_response_at) - strftime('%s', created_at)))
+        FROM conversations
+        WHERE first_response_at IS NOT NULL GROUP BY 1, 2
+        ON CONFLICT (admin_id, hour) DO UPDATE SET
+            first_responses = first_responses + excluded.first_responses,
+            first_response_seconds = first_response_seconds + excluded.first_response_seconds
+    ''')
+
+
+MIGRATIONS: List[Migration] = [
+    # 旧版本数据库已有这两张表，因此使用 IF NOT EXISTS
+    Migration(1, '创建会话表和消息表', [
+        '''
+        CREATE TABLE IF NOT EXISTS conversations (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            admin_id INTEGER NOT NULL,
+            status TEXT DEFAULT 'active',
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            last_active TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS messages (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            conv_id INTEGER NOT NULL,
+            sender_id INTEGER NOT NULL,
+            content TEXT NOT NULL,
+            timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (conv_id) REFERENCES conversations (id)
+        )
+        ''',
+    ]),
+    Migration(2, '创建管理员通知映射表', [
+        '''
+        CREATE TABLE IF NOT EXISTS admin_notifications (
+            chat_id INTEGER NOT NULL,
+            message_id INTEGER NOT NULL,
+            conv_id INTEGER NOT NULL,
+            PRIMARY KEY (chat_id, message_id)
+        ) WITHOUT ROWID
+        ''',
+    ]),
+    Migration(3, '会话和消息的复合索引', [
+        # 按用户查找活跃会话
+        'CREATE INDEX IF NOT EXISTS idx_conversations_user_status ON conversations (user_id, status, last_active)',
+        # 超时扫描 / 启动时加载活跃会话
+        'CREATE INDEX IF NOT EXISTS idx_conversations_status_active ON conversations (status, last_active)',
+        # 按管理员统计会话
+        'CREATE INDEX IF NOT EXISTS idx_conversations_admin_status ON conversations (admin_id, status)',
+        # 会话历史
+        'CREATE INDEX IF NOT EXISTS idx_messages_conv_time ON messages (conv_id, timestamp)',
+    ]),
+    Migration(4, '出站消息死信表', [
+        '''
+        CREATE TABLE IF NOT EXISTS dead_letters (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            chat_id INTEGER NOT NULL,
+            method TEXT NOT NULL,
+            payload TEXT NOT NULL,
+            error TEXT,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        ''',
+    ]),
+    Migration(5, '消息全文索引', _create_message_search),
+    Migration(6, '导出用的消息键集索引', [
+        # 按 (conv_id, id) 键集分页导出
+        'CREATE INDEX IF NOT EXISTS idx_messages_conv_id ON messages (conv_id, id)',
+    ]),
+    Migration(7, '消息归档索引', [
+        '''
+        CREATE TABLE IF NOT EXISTS archive_index (
+            conv_id INTEGER NOT NULL,
+            month TEXT NOT NULL,
+            offset INTEGER NOT NULL,
+            length INTEGER NOT NULL,
+            count INTEGER NOT NULL,
+            PRIMARY KEY (conv_id, month, offset)
+        ) WITHOUT ROWID
+        ''',
+    ]),
+    Migration(8, '媒体消息', [
+        # 媒体消息的 content 为说明文字
+        'ALTER TABLE messages ADD COLUMN media_type TEXT',
+        'ALTER TABLE messages ADD COLUMN file_unique_id TEXT',
+        '''
+        CREATE TABLE IF NOT EXISTS media_files (
+            file_unique_id TEXT PRIMARY KEY,
+            file_id TEXT NOT NULL,
+            media_type TEXT NOT NULL,
+            first_seen TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        ) WITHOUT ROWID
+        ''',
+    ]),
+    Migration(9, '管理员统计汇总', _create_admin_stats),
+    Migration(10, '幂等的更新处理', [
+        # 消息在 Telegram 中的位置，重复投递的更新不会重复保存
+        'ALTER TABLE messages ADD COLUMN chat_id INTEGER',
+        'ALTER TABLE messages ADD COLUMN telegram_message_id INTEGER',
+        '''
+        CREATE UNIQUE INDEX IF NOT EXISTS idx_messages_telegram ON messages (chat_id, telegram_message_id)
+        WHERE telegram_message_id IS NOT NULL
+        ''',
+        # 运行状态（已处理的 update_id 等）
+        '''
+        CREATE TABLE IF NOT EXISTS bot_state (
+            key TEXT PRIMARY KEY,
+            value TEXT NOT NULL
+        ) WITHOUT ROWID
+        ''',
+    ]),
+]
+
+
+def current_version(conn: sqlite3.Connection) -> int:
+    """当前数据库结构版本"""
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS schema_version (
+            version INTEGER PRIMARY KEY,
+            description TEXT NOT NULL,
+            applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    row = conn.execute('SELECT MAX(version) FROM schema_version').fetchone()
+    return row[0] or 0
+
+
+def migrate(conn: sqlite3.Connection, migrations: Sequence[Migration] = MIGRATIONS) -> List[int]:
+    """执行所有未执行的迁移，每个版本一个事务，返回本次执行的版本号"""
+    version = current_version(conn)
+    conn.commit()
+
+    applied = []
+    for migration in sorted(migrations, key=lambda m: m.version):
+        if migration.version <= version:
+            continue
+        try:
+            conn.execute('BEGIN')
+            if callable(migration.steps):
+                migration.steps(conn)
+            else:
+                for sql in migration.steps:
+                    conn.execute(sql)
+            conn.execute(
+                'INSERT INTO schema_version (version, description) VALUES (?, ?)',
+                (migration.version, migration.description)
+            )
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            logger.error(f"数据库迁移失败: v{migration.version} {migration.description}")
+            raise
+        logger.info(f"数据库迁移完成: v{migration.version} {migration.description}")
+        applied.append(migration.version)
+    return applied
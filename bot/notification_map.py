@@ -0,0 +1,46 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+管理员通知消息映射
+记录发给管理员的每条通知的 message_id 所属会话，管理员回复时直接按
+reply_to_message.message_id 定位会话
+"""
+
+from collections import OrderedDict
+from typing import Optional, Tuple
+
+from storage import Storage
+from write_behind import WriteBehindQueue
+
+
+class NotificationMap:
+    """(chat_id, message_id) -> conv_id，数据库持久化 + LRU 缓存"""
+
+    def __init__(self, storage: Storage, write_behind: WriteBehindQueue, capacity: int = 10000):
+        self.storage = storage
+        self.write_behind = write_behind
+        self.capacity = capacity
+        self._cache: 'OrderedDict[Tuple[int, int], int]' = OrderedDict()
+
+    def _remember(self, key: Tuple[int, int], conv_id: int):
+        self._cache[key] = conv_id
+        self._cache.move_to_end(key)
+        if len(self._cache) > self.capacity:
+            self._cache.popitem(last=False)
+
+    async def record(self, chat_id: int, message_id: int, conv_id: int):
+        """记录一条已发送的通知"""
+        self._remember((chat_id, message_id), conv_id)
+        await self.write_behind.put_notification(chat_id, message_id, conv_id)
+
+    async def resolve(self, chat_id: int, message_id: int) -> Optional[int]:
+        """查找通知所属的会话ID"""
+        key = (chat_id, message_id)
+        conv_id = self._cache.get(key)
+        if conv_id is not None:
+            self._cache.move_to_end(key)
+            return conv_id
+        conv_id = await self.storage.get_notification_conversation(chat_id, message_id)
+        if conv_id is not None:
+            self._remember(key, conv_id)
+        return conv_id
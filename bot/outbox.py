@@ -0,0 +1,287 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+出站消息调度
+处理器只负责入队，后台工作协程按 Telegram 的频率限制（全局 + 每个聊天的令牌桶）
+并发发送，遇到 429 / 网络错误按 retry_after 或指数退避重试，多次失败后写入死信表
+"""
+
+import asyncio
+import json
+import logging
+import time
+from collections import deque
+from typing import Any, Awaitable, Callable, Deque, Dict, List, Optional, Set
+
+from telegram.error import BadRequest, NetworkError, RetryAfter
+
+from metrics import SEND_RESULTS, SEND_SECONDS
+from storage import Storage
+
+logger = logging.getLogger(__name__)
+
+# 没有 chat_id 参数的调用（仍按所属聊天排队）
+CHATLESS_METHODS = frozenset({'answer_callback_query'})
+
+
+class TokenBucket:
+    """令牌桶"""
+
+    def __init__(self, rate: float, capacity: float, now: float = 0.0):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = now
+
+    def _refill(self, now: float):
+        if now > self.updated:
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+
+    def consume(self, now: float) -> float:
+        """取一个令牌；成功返回 0，否则返回需要等待的秒数"""
+        self._refill(now)
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def is_full(self, now: float) -> bool:
+        """令牌桶是否已满（长时间未使用）"""
+        self._refill(now)
+        return self.tokens >= self.capacity
+
+
+class OutboundJob:
+    """一次 Bot API 调用"""
+
+    __slots__ = ('method', 'chat_id', 'kwargs', 'on_sent', 'on_failed', 'attempts')
+
+    def __init__(self, method: str, chat_id: int, kwargs: Dict[str, Any],
+                 on_sent: Optional[Callable[[Any], Awaitable[None]]] = None,
+                 on_failed: Optional[Callable[[Exception], Awaitable[None]]] = None):
+        self.method = method
+        self.chat_id = chat_id
+        self.kwargs = kwargs
+        self.on_sent = on_sent
+        self.on_failed = on_failed
+        self.attempts = 0
+
+    def payload(self) -> str:
+        """调用参数的 JSON 表示（用于死信记录）"""
+        return json.dumps(
+            {key: value.to_dict() if hasattr(value, 'to_dict') else value
+             for key, value in self.kwargs.items()},
+            ensure_ascii=False, default=str
+        )
+
+
+class OutboundDispatcher:
+    """出站消息调度器
+
+    每个聊天一个 FIFO 队列，同一聊天同一时刻最多一个请求在发送，保证消息顺序；
+    不同聊天由多个工作协程并发发送。
+    """
+
+    def __init__(self, storage: Optional[Storage] = None, workers: int = 8,
+                 global_rate: float = 30.0, chat_rate: float = 1.0, group_rate: float = 20 / 60,
+                 max_retries: int = 5, base_backoff: float = 1.0, max_backoff: float = 60.0,
+                 shared_chat_rate: Optional[float] = None, is_shared_chat: Optional[Callable[[int], bool]] = None):
+        self.storage = storage
+        self.workers = workers
+        self.chat_rate = chat_rate
+        self.group_rate = group_rate
+        # 多个进程同时向其发送的聊天（分片模式下的管理员）只使用分到的一份速率，且不允许突发
+        self.shared_chat_rate = shared_chat_rate
+        self.is_shared_chat = is_shared_chat
+        self.max_retries = max_retries
+        self.base_backoff = base_backoff
+        self.max_backoff = max_backoff
+        self.bot = None
+        self._global = TokenBucket(global_rate, global_rate)
+        self._buckets: Dict[int, TokenBucket] = {}
+        self._chats: Dict[int, Deque[OutboundJob]] = {}
+        # 已在就绪队列、正在发送或等待重试的聊天
+        self._scheduled: Set[int] = set()
+        self._ready: Optional[asyncio.Queue] = None
+        self._tasks: List[asyncio.Task] = []
+        self._timers: Set[asyncio.TimerHandle] = set()
+        self._pending = 0
+        self._idle: Optional[asyncio.Event] = None
+
+    @property
+    def pending(self) -> int:
+        """尚未完成的调用数"""
+        return self._pending
+
+    async def start(self, bot):
+        """启动工作协程"""
+        if self._tasks:
+            return
+        self.bot = bot
+        self._ready = asyncio.Queue()
+        self._idle = asyncio.Event()
+        if self._pending == 0:
+            self._idle.set()
+        loop = asyncio.get_running_loop()
+        self._global.updated = loop.time()
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+        # 启动前入队的调用
+        for chat_id in self._chats:
+            self._scheduled.add(chat_id)
+            self._ready.put_nowait(chat_id)
+
+    async def stop(self, timeout: float = 10.0) -> List[OutboundJob]:
+        """等待队列发送完毕（最多 timeout 秒）并停止，返回未发送的调用"""
+        if self._tasks:
+            try:
+                await asyncio.wait_for(self._idle.wait(), timeout)
+            except asyncio.TimeoutError:
+                logger.warning(f"出站队列未能在 {timeout:.1f} 秒内发送完毕，剩余 {self._pending} 条")
+            for task in self._tasks:
+                task.cancel()
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+            self._tasks = []
+        for timer in self._timers:
+            timer.cancel()
+        self._timers.clear()
+
+        remaining = [job for jobs in self._chats.values() for job in jobs]
+        self._chats.clear()
+        self._scheduled.clear()
+        self._pending = 0
+        return remaining
+
+    def enqueue(self, method: str, chat_id: int,
+                on_sent: Optional[Callable[[Any], Awaitable[None]]] = None,
+                on_failed: Optional[Callable[[Exception], Awaitable[None]]] = None,
+                **kwargs) -> OutboundJob:
+        """加入一次 Bot API 调用（立即返回）"""
+        job = OutboundJob(method, chat_id, kwargs, on_sent, on_failed)
+        self._chats.setdefault(chat_id, deque()).append(job)
+        self._pending += 1
+        if self._idle:
+            self._idle.clear()
+        if self._ready is not None and chat_id not in self._scheduled:
+            self._scheduled.add(chat_id)
+            self._ready.put_nowait(chat_id)
+        return job
+
+    def send_message(self, chat_id: int, text: str, **kwargs) -> OutboundJob:
+        """加入一条文本消息"""
+        return self.enqueue('send_message', chat_id, text=text, **kwargs)
+
+    def _chat_bucket(self, chat_id: int, now: float) -> TokenBucket:
+        bucket = self._buckets.get(chat_id)
+        if bucket is None:
+            if self.shared_chat_rate and self.is_shared_chat and self.is_shared_chat(chat_id):
+                bucket = self._buckets[chat_id] = TokenBucket(self.shared_chat_rate, 1, now)
+                return bucket
+            # 负数 chat_id 为群组，限制更严格
+            rate = self.group_rate if chat_id < 0 else self.chat_rate
+            bucket = self._buckets[chat_id] = TokenBucket(rate, 1 if chat_id < 0 else 3, now)
+        return bucket
+
+    def _schedule_later(self, chat_id: int, delay: float):
+        """delay 秒后重新放入就绪队列"""
+        loop = asyncio.get_running_loop()
+
+        def ready():
+            self._timers.discard(timer)
+            self._ready.put_nowait(chat_id)
+
+        timer = loop.call_later(delay, ready)
+        self._timers.add(timer)
+
+    def _finish(self, chat_id: int):
+        """队首调用已完成（成功或放弃）"""
+        jobs = self._chats[chat_id]
+        jobs.popleft()
+        self._pending -= 1
+        if jobs:
+            self._ready.put_nowait(chat_id)
+            return
+        del self._chats[chat_id]
+        self._scheduled.discard(chat_id)
+        bucket = self._buckets.get(chat_id)
+        if bucket and bucket.is_full(asyncio.get_running_loop().time()):
+            del self._buckets[chat_id]
+        if self._pending == 0:
+            self._idle.set()
+
+    async def _worker(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            chat_id = await self._ready.get()
+            jobs = self._chats.get(chat_id)
+            if not jobs:
+                self._scheduled.discard(chat_id)
+                continue
+
+            delay = self._chat_bucket(chat_id, loop.time()).consume(loop.time())
+            if delay > 0:
+                self._schedule_later(chat_id, delay)
+                continue
+            while True:
+                delay = self._global.consume(loop.time())
+                if delay <= 0:
+                    break
+                await asyncio.sleep(delay)
+
+            await self._send(chat_id, jobs[0])
+
+    async def _call(self, chat_id: int, job: OutboundJob) -> Any:
+        """调用 Bot API 并记录耗时"""
+        start = time.perf_counter()
+        try:
+            if job.method in CHATLESS_METHODS:
+                return await getattr(self.bot, job.method)(**job.kwargs)
+            return await getattr(self.bot, job.method)(chat_id=chat_id, **job.kwargs)
+        finally:
+            SEND_SECONDS.labels(job.method).observe(time.perf_counter() - start)
+
+    async def _send(self, chat_id: int, job: OutboundJob):
+        try:
+            result = await self._call(chat_id, job)
+        except RetryAfter as e:
+            await self._retry(chat_id, job, e, float(e.retry_after))
+        except BadRequest as e:
+            await self._give_up(chat_id, job, e)
+        except NetworkError as e:
+            # 包括 TimedOut
+            await self._retry(chat_id, job, e, min(self.max_backoff, self.base_backoff * 2 ** job.attempts))
+        except Exception as e:
+            await self._give_up(chat_id, job, e)
+        else:
+            SEND_RESULTS.labels(job.method, 'ok').inc()
+            self._finish(chat_id)
+            if job.on_sent:
+                try:
+                    await job.on_sent(result)
+                except Exception as e:
+                    logger.error(f"发送回调失败: {e}")
+
+    async def _retry(self, chat_id: int, job: OutboundJob, error: Exception, delay: float):
+        job.attempts += 1
+        if job.attempts > self.max_retries:
+            await self._give_up(chat_id, job, error)
+            return
+        SEND_RESULTS.labels(job.method, 'retry').inc()
+        logger.warning(f"发送到 {chat_id} 失败，{delay:.1f} 秒后重试（第{job.attempts}次）: {error}")
+        self._schedule_later(chat_id, delay)
+
+    async def _give_up(self, chat_id: int, job: OutboundJob, error: Exception):
+        """放弃发送：写入死信表并通知调用方"""
+        logger.error(f"发送到 {chat_id} 失败，已放弃: {error}")
+        SEND_RESULTS.labels(job.method, 'failed').inc()
+        self._finish(chat_id)
+        if self.storage:
+            try:
+                await self.storage.add_dead_letter(job.chat_id, job.method, job.payload(), str(error), job.attempts)
+            except Exception as e:
+                logger.error(f"写入死信记录失败: {e}")
+        if job.on_failed:
+            try:
+                await job.on_failed(error)
+            except Exception as e:
+                logger.error(f"失败回调出错: {e}")
@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+管理员自动分配
+根据内存中的活跃会话数（按权重折算）或最近响应时间选择管理员
+"""
+
+from typing import Dict, Iterable, Optional
+
+ROUTING_MODES = ('manual', 'least_loaded', 'fastest')
+
+
+class AdminRouter:
+    """管理员分配策略"""
+
+    def __init__(self, admin_ids: Iterable[int], weights: Optional[Dict[int, float]] = None,
+                 mode: str = 'manual', smoothing: float = 0.3):
+        self.smoothing = smoothing
+        self.reconfigure(admin_ids, weights, mode)
+        # 最近响应时间（秒，指数滑动平均）
+        self.response_times: Dict[int, float] = {}
+        # 会话中最早一条未回复用户消息的时间
+        self._waiting_since: Dict[int, float] = {}
+
+    def reconfigure(self, admin_ids: Iterable[int], weights: Optional[Dict[int, float]] = None,
+                    mode: str = 'manual'):
+        """更新管理员列表、权重和分配模式（配置重新加载时），保留已统计的响应时间"""
+        if mode not in ROUTING_MODES:
+            raise ValueError(f"未知的分配模式: {mode}")
+        weights = weights or {}
+        # 权重为 0 的管理员不参与自动分配
+        self.weights: Dict[int, float] = {
+            admin_id: weights.get(admin_id, 1.0) for admin_id in admin_ids
+            if weights.get(admin_id, 1.0) > 0
+        }
+        self.mode = mode
+
+    @property
+    def automatic(self) -> bool:
+        """是否启用自动分配"""
+        return self.mode != 'manual'
+
+    def pick(self, active_counts: Dict[int, int]) -> Optional[int]:
+        """选择一个管理员；active_counts 为各管理员当前活跃会话数"""
+        if not self.weights:
+            return None
+
+        def load(admin_id: int) -> float:
+            return active_counts.get(admin_id, 0) / self.weights[admin_id]
+
+        def response_time(admin_id: int) -> float:
+            # 尚无记录的管理员视为最快，让其尽快积累数据
+            return self.response_times.get(admin_id, 0.0)
+
+        if self.mode == 'fastest':
+            return min(self.weights, key=lambda a: (response_time(a), load(a)))
+        return min(self.weights, key=lambda a: (load(a), response_time(a)))
+
+    def user_message(self, conv_id: int, now: float):
+        """记录用户消息（开始计算响应时间）"""
+        self._waiting_since.setdefault(conv_id, now)
+
+    def admin_reply(self, conv_id: int, admin_id: int, now: float):
+        """记录管理员回复并更新其响应时间"""
+        since = self._waiting_since.pop(conv_id, None)
+        if since is None:
+            return
+        elapsed = now - since
+        previous = self.response_times.get(admin_id)
+        if previous is None:
+            self.response_times[admin_id] = elapsed
+        else:
+            self.response_times[admin_id] = previous + self.smoothing * (elapsed - previous)
+
+    def forget(self, conv_id: int):
+        """会话结束"""
+        self._waiting_since.pop(conv_id, None)
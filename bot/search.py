@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+会话历史搜索
+把管理员输入的关键词转换为 FTS5 查询，并生成结果摘要。
+trigram 索引只能匹配 3 个字符及以上的关键词，更短的关键词改用 LIKE 在命中结果（或最近的消息）中过滤。
+翻页使用键集分页：每页记住各数据库最后一条结果的排序键，下一页从其后继续，不使用 OFFSET
+"""
+
+import heapq
+from typing import Dict, Iterable, List, NamedTuple, Optional, Tuple
+
+# trigram 分词能匹配的最短关键词
+MIN_INDEXED_LENGTH = 3
+
+
+class SearchHit(NamedTuple):
+    """一条搜索结果"""
+    message_id: int
+    conv_id: int
+    user_id: int
+    sender_id: int
+    content: str
+    timestamp: str
+    # 全文检索的相关度（越小越相关），LIKE 扫描时为 None
+    rank: Optional[float] = None
+
+    @property
+    def key(self) -> Tuple[Optional[float], int]:
+        """排序键，作为下一页的起点"""
+        return self.rank, self.message_id
+
+
+class SearchSession:
+    """管理员当前的搜索：关键词和每一页在各数据库（分片）中的起点"""
+
+    def __init__(self, terms: List[str]):
+        self.terms = terms
+        # 第 n 页的起点: db_path -> 上一页在该数据库中最后一条结果的排序键
+        self.cursors: List[Dict[str, Tuple[Optional[float], int]]] = [{}]
+
+    def cursor(self, page: int) -> Optional[Dict[str, Tuple[Optional[float], int]]]:
+        """第 page 页的起点；尚未翻到的页返回 None"""
+        return self.cursors[page] if 0 <= page < len(self.cursors) else None
+
+    def set_next(self, page: int, cursor: Dict[str, Tuple[Optional[float], int]]):
+        """记录第 page 页之后一页的起点"""
+        del self.cursors[page + 1:]
+        self.cursors.append(cursor)
+
+
+def split_terms(terms: List[str]) -> Tuple[Optional[str], List[str]]:
+    """拆分关键词，返回 (FTS5 MATCH 表达式, 需要用 LIKE 过滤的短关键词)
+
+    所有关键词都必须出现（AND）；每个关键词作为短语加引号，避免被解析为 FTS5 语法
+    """
+    indexed = []
+    short = []
+    for term in terms:
+        term = term.strip()
+        if not term:
+            continue
+        if len(term) >= MIN_INDEXED_LENGTH:
+            indexed.append('"' + term.replace('"', '""') + '"')
+        else:
+            short.append(term)
+    return (' '.join(indexed) or None), short
+
+
+def merge_hits(results: Iterable[Tuple[str, List[SearchHit]]], ranked: bool) -> List[Tuple[str, SearchHit]]:
+    """合并多个数据库（分片）的结果，返回 (db_path, 结果)：全文检索按相关度（各分片分别计算，近似可比），
+    否则按时间从新到旧。每个数据库内部保持原有顺序，与其键集分页的起点一致"""
+    tagged = [[(db_path, hit) for hit in hits] for db_path, hits in results]
+    if ranked:
+        return list(heapq.merge(*tagged, key=lambda item: item[1].key))
+    return list(heapq.merge(*tagged, key=lambda item: (item[1].timestamp, item[1].message_id), reverse=True))
+
+
+def like_pattern(term: str) -> str:
+    """LIKE 子串匹配模式（配合 ESCAPE '\\'）"""
+    escaped = term.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+    return f'%{escaped}%'
+
+
+def snippet(content: str, terms: List[str], width: int = 60) -> str:
+    """截取第一个命中关键词附近的内容，关键词用【】标出"""
+    content = ' '.join(content.split())
+    lowered = content.lower()
+    positions = [(lowered.find(term.lower()), term) for term in terms]
+    positions = [(pos, term) for pos, term in positions if pos >= 0]
+    if positions:
+        pos, term = min(positions)
+        start = max(0, pos - width // 3)
+    else:
+        start = 0
+    end = min(len(content), start + width)
+    text = content[start:end]
+    for term in sorted({term for _, term in positions}, key=len, reverse=True):
+        text = _highlight(text, term)
+    return ('…' if start > 0 else '') + text + ('…' if end < len(content) else '')
+
+
+def _highlight(text: str, term: str) -> str:
+    lowered = text.lower()
+    term_lower = term.lower()
+    parts = []
+    index = 0
+    while True:
+        pos = lowered.find(term_lower, index)
+        if pos < 0:
+            break
+        parts.append(text[index:pos])
+        parts.append(f'【{text[pos:pos + len(term)]}】')
+        index = pos + len(term)
+    parts.append(text[index:])
+    return ''.join(parts)
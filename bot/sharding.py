@@ -0,0 +1,171 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+按用户分片
+多进程模式下更新按 user_id 分配到 N 个工作进程（分片），同一用户的会话、消息和顺序都在同一分片内。
+每个分片使用自己的数据库文件、归档目录和出站调用日志，分片 0 沿用原路径（单进程部署可直接切换）。
+分片 k 的会话编号从 k * SHARD_STRIDE 开始，由会话编号即可知道所在分片。
+管理员的更新按目标会话分配：点击“回复用户”或回复通知时发往会话所在分片，
+其余管理员命令发往管理员自己所在的分片，由该分片汇总所有分片的数据（/search、/stats、/export）
+"""
+
+import configparser
+import os
+from typing import Any, Dict, FrozenSet, Iterable, List, NamedTuple, Optional, Tuple
+
+# 每个分片的会话编号区间大小
+SHARD_STRIDE = 10 ** 12
+
+
+class Shard(NamedTuple):
+    """当前进程负责的分片"""
+    index: int
+    count: int
+
+
+def shard_of_user(user_id: int, count: int) -> int:
+    """用户所在的分片"""
+    return user_id % count
+
+
+def shard_of_conversation(conv_id: int) -> int:
+    """会话所在的分片"""
+    return conv_id // SHARD_STRIDE
+
+
+def shard_path(path: str, index: int) -> str:
+    """分片使用的文件或目录：database.db -> database.shard1.db（分片 0 不变）"""
+    if index == 0:
+        return path
+    root, ext = os.path.splitext(path)
+    return f"{root}.shard{index}{ext}"
+
+
+def shard_db_paths(db_path: str, count: int) -> List[str]:
+    """所有分片的数据库文件"""
+    return [shard_path(db_path, index) for index in range(max(1, count))]
+
+
+def configured_db_paths(config: configparser.ConfigParser) -> List[str]:
+    """按配置（[SHARDING] workers）列出所有分片的数据库文件，供命令行工具使用；
+    尚未创建的分片跳过（分片 0 总是列出，不存在时由调用方报错）"""
+    paths = shard_db_paths(
+        config.get('SETTINGS', 'db_path', fallback='database.db'),
+        config.getint('SHARDING', 'workers', fallback=1)
+    )
+    return paths[:1] + [path for path in paths[1:] if os.path.exists(path)]
+
+
+def sender_count(config: configparser.ConfigParser, count: int) -> int:
+    """调用 Bot API 发送消息的进程数：各分片，摘要模式下还有维护收件箱的主进程"""
+    return count + (1 if config.getboolean('SETTINGS', 'admin_inbox', fallback=False) else 0)
+
+
+def apply_shard(config: configparser.ConfigParser, shard: Shard):
+    """把配置改写为分片使用的值：各自的日志、归档目录和指标端口，
+    全局发送速率和发往管理员的速率由所有发送进程均分，限流速率按分片数均分"""
+    for section in ('SETTINGS', 'RATE_LIMIT', 'METRICS'):
+        if not config.has_section(section):
+            config.add_section(section)
+    settings = config['SETTINGS']
+    db_path = settings.get('db_path', 'database.db')
+    journal_path = settings.get('journal_path', '') or os.path.join(
+        os.path.dirname(os.path.abspath(db_path)), 'outbox.journal'
+    )
+    settings['journal_path'] = shard_path(journal_path, shard.index)
+    settings['archive_dir'] = shard_path(settings.get('archive_dir', 'archive'), shard.index)
+    # Telegram 的发送限制按机器人（每个聊天）计算：全局限制由所有发送进程分担，
+    # 管理员的更新分布在各个分片，每个分片都会向管理员发送，每个聊天的限制同样要分担
+    senders = sender_count(config, shard.count)
+    settings['send_global_rate'] = str(config.getfloat('SETTINGS', 'send_global_rate', fallback=30) / senders)
+    settings['send_admin_chat_rate'] = str(config.getfloat('SETTINGS', 'send_chat_rate', fallback=1) / senders)
+    rate_limit = config['RATE_LIMIT']
+    for key, default in (('global_rate', 100), ('global_burst', 200)):
+        rate_limit[key] = str(config.getfloat('RATE_LIMIT', key, fallback=default) / shard.count)
+    config['METRICS']['port'] = str(config.getint('METRICS', 'port', fallback=9100) + shard.index)
+
+
+def _command(text: Optional[str]) -> Tuple[Optional[str], List[str]]:
+    """解析命令：'/history@bot 12' -> ('history', ['12'])"""
+    if not text or not text.startswith('/'):
+        return None, []
+    parts = text.split()
+    return parts[0][1:].split('@', 1)[0], parts[1:]
+
+
+def _reply_conversation(data: Any) -> Optional[int]:
+    """“回复用户”按钮对应的会话"""
+    if isinstance(data, str) and data.startswith('reply_') and data[6:].isdigit():
+        return int(data[6:])
+    return None
+
+
+def _markup_conversation(markup: Optional[Dict[str, Any]]) -> Optional[int]:
+    """通知消息上“回复用户”按钮对应的会话"""
+    for row in (markup or {}).get('inline_keyboard', []):
+        for button in row:
+            conv_id = _reply_conversation(button.get('callback_data'))
+            if conv_id is not None:
+                return conv_id
+    return None
+
+
+def sender_of(data: Dict[str, Any]) -> Optional[int]:
+    """更新的发送者（message、callback_query 等中的 from）"""
+    for value in data.values():
+        if isinstance(value, dict) and isinstance(value.get('from'), dict):
+            return value['from'].get('id')
+    return None
+
+
+class UpdateRouter:
+    """把原始更新（JSON）分配到分片（仅在主进程的事件循环中访问）"""
+
+    def __init__(self, count: int, admin_ids: Iterable[int]):
+        self.count = count
+        self.admin_ids: FrozenSet[int] = frozenset(admin_ids)
+        # 管理员最近通过“回复用户”按钮选定的会话所在分片: admin_id -> 分片
+        self._admin_targets: Dict[int, int] = {}
+
+    def set_admins(self, admin_ids: Iterable[int]):
+        """配置重新加载后更新管理员"""
+        self.admin_ids = frozenset(admin_ids)
+        for admin_id in set(self._admin_targets) - self.admin_ids:
+            del self._admin_targets[admin_id]
+
+    def _conversation_shard(self, conv_id: int, default: int) -> int:
+        shard = shard_of_conversation(conv_id)
+        # 分片数减少后，已不存在的分片中的会话无法处理
+        return shard if shard < self.count else default
+
+    def route(self, data: Dict[str, Any]) -> int:
+        """更新应由哪个分片处理"""
+        sender = sender_of(data)
+        if sender is None:
+            return 0
+        home = shard_of_user(sender, self.count)
+        if sender not in self.admin_ids:
+            return home
+
+        query = data.get('callback_query')
+        if query:
+            conv_id = _reply_conversation(query.get('data'))
+            if conv_id is None:
+                return home
+            shard = self._admin_targets[sender] = self._conversation_shard(conv_id, home)
+            return shard
+
+        message = data.get('message') or data.get('edited_message') or {}
+        command, args = _command(message.get('text'))
+        if command == 'history' and len(args) == 1 and args[0].lstrip('#').isdigit():
+            return self._conversation_shard(int(args[0].lstrip('#')), home)
+        if command == 'unblock' and len(args) == 1 and args[0].isdigit():
+            return shard_of_user(int(args[0]), self.count)
+        if command:
+            return home
+
+        # 回复通知消息时按通知上的按钮找到会话，否则发往最近选定的会话所在分片
+        conv_id = _markup_conversation((message.get('reply_to_message') or {}).get('reply_markup'))
+        if conv_id is not None:
+            return self._conversation_shard(conv_id, home)
+        return self._admin_targets.get(sender, home)
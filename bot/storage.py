@@ -0,0 +1,458 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+数据库存储层
+长连接（WAL 模式，单写连接 + 读连接池），所有查询在后台线程中执行，
+对外提供 awaitable 方法，避免阻塞事件循环
+"""
+
+import asyncio
+import logging
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from analytics import AdminStats, query_stats, record_closed, record_messages, record_opened
+from metrics import STORAGE_ERRORS, STORAGE_SECONDS
+from migrations import migrate
+
+logger = logging.getLogger(__name__)
+
+
+def utc_timestamp() -> str:
+    """当前 UTC 时间，格式与 SQLite 的 CURRENT_TIMESTAMP 一致"""
+    return datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')
+
+
+class Storage:
+    """SQLite 存储子系统"""
+
+    def __init__(self, db_path: str, readers: int = 2, read_only: bool = False):
+        self.db_path = db_path
+        # 只读打开（其他分片的数据库）：文件不存在时报错而不是创建空库，也不修改日志模式
+        self.read_only = read_only
+        # 写操作全部串行到同一个线程、同一个连接上
+        self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix='db-writer')
+        # 读操作使用小型线程池，每个线程持有自己的长连接
+        self._readers = ThreadPoolExecutor(max_workers=max(1, readers), thread_name_prefix='db-reader')
+        self._local = threading.local()
+        self._connections: List[sqlite3.Connection] = []
+        self._conn_lock = threading.Lock()
+
+    def _connect(self) -> sqlite3.Connection:
+        """创建长连接并设置 WAL 模式"""
+        if self.read_only:
+            conn = sqlite3.connect(f'file:{self.db_path}?mode=ro', uri=True, timeout=30, check_same_thread=False)
+        else:
+            conn = sqlite3.connect(self.db_path, timeout=30, check_same_thread=False)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+        conn.execute('PRAGMA busy_timeout=5000')
+        with self._conn_lock:
+            self._connections.append(conn)
+        return conn
+
+    def _get_connection(self) -> sqlite3.Connection:
+        """获取当前线程的连接"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self._connect()
+            self._local.conn = conn
+        return conn
+
+    def _call(self, fn: Callable, args: tuple, commit: bool) -> Any:
+        """在工作线程中执行查询"""
+        conn = self._get_connection()
+        if not commit:
+            return fn(conn, *args)
+        try:
+            result = fn(conn, *args)
+            conn.commit()
+            return result
+        except Exception:
+            conn.rollback()
+            raise
+
+    async def _run(self, executor: ThreadPoolExecutor, fn: Callable, args: tuple, commit: bool) -> Any:
+        """在线程池中执行并记录耗时（按查询函数名统计）"""
+        op = fn.__name__.lstrip('_')
+        start = time.perf_counter()
+        try:
+            return await asyncio.get_running_loop().run_in_executor(executor, self._call, fn, args, commit)
+        except Exception:
+            STORAGE_ERRORS.labels(op).inc()
+            raise
+        finally:
+            STORAGE_SECONDS.labels(op).observe(time.perf_counter() - start)
+
+    async def read(self, fn: Callable, *args) -> Any:
+        """在读连接池中执行 fn(conn, *args)"""
+        return await self._run(self._readers, fn, args, False)
+
+    async def write(self, fn: Callable, *args) -> Any:
+        """在写线程中执行 fn(conn, *args) 并提交事务"""
+        return await self._run(self._writer, fn, args, True)
+
+    def read_sync(self, fn: Callable, *args) -> Any:
+        """同步读（用于启动阶段）"""
+        return self._readers.submit(self._call, fn, args, False).result()
+
+    def write_sync(self, fn: Callable, *args) -> Any:
+        """同步写（用于启动阶段）"""
+        return self._writer.submit(self._call, fn, args, True).result()
+
+    def close(self):
+        """等待队列中的查询完成并关闭所有连接"""
+        self._writer.shutdown(wait=True)
+        self._readers.shutdown(wait=True)
+        with self._conn_lock:
+            for conn in self._connections:
+                try:
+                    conn.close()
+                except sqlite3.Error as e:
+                    logger.error(f"关闭数据库连接失败: {e}")
+            self._connections.clear()
+        logger.info("数据库连接已关闭")
+
+    # ---- 表结构 ----
+
+    def init_schema(self) -> List[int]:
+        """执行数据库迁移，返回本次执行的版本号"""
+        return self.write_sync(migrate)
+
+    # ---- 会话 ----
+
+    def load_active_conversations(self) -> List[Tuple[int, int, int, str]]:
+        """读取全部活跃会话 (id, user_id, admin_id, last_active)，用于启动时重建索引"""
+        return self.read_sync(self._load_active_conversations)
+
+    @staticmethod
+    def _load_active_conversations(conn: sqlite3.Connection) -> List[Tuple[int, int, int, str]]:
+        cursor = conn.execute('''
+            SELECT id, user_id, admin_id, last_active FROM conversations
+            WHERE status = 'active'
+        ''')
+        return cursor.fetchall()
+
+    def reserve_conversation_ids(self, start: int):
+        """新会话的编号不小于 start（分片模式下各分片使用不同的编号区间）"""
+        self.write_sync(self._reserve_conversation_ids, start)
+
+    @staticmethod
+    def _reserve_conversation_ids(conn: sqlite3.Connection, start: int):
+        row = conn.execute("SELECT seq FROM sqlite_sequence WHERE name = 'conversations'").fetchone()
+        if row is None:
+            conn.execute("INSERT INTO sqlite_sequence (name, seq) VALUES ('conversations', ?)", (start - 1,))
+        elif row[0] < start - 1:
+            conn.execute("UPDATE sqlite_sequence SET seq = ? WHERE name = 'conversations'", (start - 1,))
+
+    async def create_conversation(self, user_id: int, admin_id: int) -> int:
+        """创建新会话（幂等）：用户已有与该管理员的活跃会话时返回原会话，
+        与其他管理员的活跃会话在同一事务中关闭，保证每个用户最多一个活跃会话"""
+        return await self.write(self._create_conversation, user_id, admin_id)
+
+    @staticmethod
+    def _create_conversation(conn: sqlite3.Connection, user_id: int, admin_id: int) -> int:
+        row = conn.execute('''
+            SELECT id FROM conversations
+            WHERE user_id = ? AND status = 'active' AND admin_id = ?
+            ORDER BY last_active DESC
+            LIMIT 1
+        ''', (user_id, admin_id)).fetchone()
+        if row:
+            return row[0]
+        now = utc_timestamp()
+        others = [row[0] for row in conn.execute('''
+            SELECT id FROM conversations
+            WHERE user_id = ? AND status = 'active'
+        ''', (user_id,))]
+        record_closed(conn, others, now)
+        conn.execute('''
+            UPDATE conversations
+            SET status = 'closed'
+            WHERE user_id = ? AND status = 'active'
+        ''', (user_id,))
+        cursor = conn.execute('''
+            INSERT INTO conversations (user_id, admin_id, status, created_at, last_active)
+            VALUES (?, ?, 'active', ?, ?)
+        ''', (user_id, admin_id, now, now))
+        record_opened(conn, admin_id, now)
+        return cursor.lastrowid
+
+    async def close_conversation(self, conv_id: int):
+        """关闭会话"""
+        await self.write(self._close_conversation, conv_id)
+
+    @staticmethod
+    def _close_conversation(conn: sqlite3.Connection, conv_id: int):
+        record_closed(conn, [conv_id], utc_timestamp())
+        conn.execute('''
+            UPDATE conversations
+            SET status = 'closed'
+            WHERE id = ?
+        ''', (conv_id,))
+
+    async def close_conversations(self, conv_ids: List[int]):
+        """在一个事务中批量关闭会话"""
+        await self.write(self._close_conversations, conv_ids)
+
+    @staticmethod
+    def _close_conversations(conn: sqlite3.Connection, conv_ids: List[int]):
+        record_closed(conn, conv_ids, utc_timestamp())
+        conn.executemany('''
+            UPDATE conversations
+            SET status = 'closed'
+            WHERE id = ?
+        ''', [(conv_id,) for conv_id in conv_ids])
+
+    # ---- 通知映射 ----
+
+    async def get_notification_conversation(self, chat_id: int, message_id: int) -> Optional[int]:
+        """根据管理员聊天中的通知消息查找会话ID"""
+        return await self.read(self._get_notification_conversation, chat_id, message_id)
+
+    @staticmethod
+    def _get_notification_conversation(conn: sqlite3.Connection, chat_id: int, message_id: int) -> Optional[int]:
+        cursor = conn.execute('''
+            SELECT conv_id FROM admin_notifications
+            WHERE chat_id = ? AND message_id = ?
+        ''', (chat_id, message_id))
+        row = cursor.fetchone()
+        return row[0] if row else None
+
+    # ---- 死信 ----
+
+    async def add_dead_letter(self, chat_id: int, method: str, payload: str, error: str, attempts: int):
+        """记录最终发送失败的出站调用"""
+        await self.write(self._add_dead_letter, chat_id, method, payload, error, attempts)
+
+    @staticmethod
+    def _add_dead_letter(conn: sqlite3.Connection, chat_id: int, method: str, payload: str,
+                         error: str, attempts: int):
+        conn.execute('''
+            INSERT INTO dead_letters (chat_id, method, payload, error, attempts)
+            VALUES (?, ?, ?, ?, ?)
+        ''', (chat_id, method, payload, error, attempts))
+
+    # ---- 消息 ----
+
+    async def write_batch(self, messages: List[tuple], bumps: Dict[int, str], notifications: List[tuple] = (),
+                          media: List[tuple] = (), states: List[tuple] = ()):
+        """在一个事务中批量写入消息、会话最后活跃时间、通知映射 (chat_id, message_id, conv_id)、
+        媒体文件 (file_unique_id, file_id, media_type) 和运行状态 (key, value)
+
+        消息为 (conv_id, sender_id, content, timestamp[, media_type, file_unique_id[, admin_id, kind
+        [, chat_id, telegram_message_id]]])：指定 kind 时计入统计；同一 (chat_id, telegram_message_id) 只保存一次
+        """
+        await self.write(self._write_batch, messages, bumps, notifications, media, states)
+
+    @staticmethod
+    def _write_batch(conn: sqlite3.Connection, messages: List[tuple], bumps: Dict[int, str],
+                     notifications: List[tuple], media: List[tuple], states: List[tuple]):
+        # 后面的字段可以省略；重复投递的消息不插入，也不计入统计
+        stats = []
+        for message in messages:
+            (conv_id, sender_id, content, timestamp, media_type, file_unique_id,
+             admin_id, kind, chat_id, telegram_message_id) = tuple(message) + (None,) * (10 - len(message))
+            cursor = conn.execute('''
+                INSERT INTO messages (conv_id, sender_id, content, timestamp, media_type, file_unique_id,
+                                      chat_id, telegram_message_id)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT DO NOTHING
+            ''', (conv_id, sender_id, content, timestamp, media_type, file_unique_id, chat_id, telegram_message_id))
+            if cursor.rowcount and kind and admin_id is not None:
+                stats.append((conv_id, admin_id, kind, timestamp))
+
+        # 更新会话最后活跃时间
+        conn.executemany('''
+            UPDATE conversations
+            SET last_active = ?
+            WHERE id = ?
+        ''', [(timestamp, conv_id) for conv_id, timestamp in bumps.items()])
+
+        conn.executemany('''
+            INSERT OR REPLACE INTO admin_notifications (chat_id, message_id, conv_id)
+            VALUES (?, ?, ?)
+        ''', notifications)
+
+        conn.executemany('''
+            INSERT OR IGNORE INTO media_files (file_unique_id, file_id, media_type)
+            VALUES (?, ?, ?)
+        ''', media)
+
+        conn.executemany('''
+            INSERT OR REPLACE INTO bot_state (key, value)
+            VALUES (?, ?)
+        ''', states)
+
+        record_messages(conn, stats)
+
+    # ---- 运行状态 ----
+
+    def get_state(self, key: str) -> Optional[str]:
+        """读取运行状态（用于启动阶段）"""
+        return self.read_sync(self._get_state, key)
+
+    @staticmethod
+    def _get_state(conn: sqlite3.Connection, key: str) -> Optional[str]:
+        row = conn.execute('SELECT value FROM bot_state WHERE key = ?', (key,)).fetchone()
+        return row[0] if row else None
+
+    # ---- 统计 ----
+
+    async def get_admin_stats(self, since: Optional[str], until: Optional[str],
+                              admin_id: Optional[int] = None) -> List[AdminStats]:
+        """按管理员汇总 [since, until) 内的统计（只读取汇总表）"""
+        return await self.read(self._get_admin_stats, since, until, admin_id)
+
+    @staticmethod
+    def _get_admin_stats(conn: sqlite3.Connection, since: Optional[str], until: Optional[str],
+                         admin_id: Optional[int]) -> List[AdminStats]:
+        return query_stats(conn, since, until, admin_id)
+
+    # ---- 搜索 ----
+
+    async def search_messages(self, match: Optional[str], like_patterns: List[str], limit: int,
+                              after: Optional[Tuple[Optional[float], int]] = None,
+                              scan_limit: int = 100000) -> List[tuple]:
+        """搜索消息，返回 (message_id, conv_id, user_id, sender_id, content, timestamp, rank)
+
+        有 match 时使用全文索引按相关度排序（rank 越小越相关）；否则按 LIKE 从新到旧扫描最近 scan_limit 条消息（rank 为 NULL）。
+        after 为上一页最后一条结果的 (rank, message_id)，从其后继续（键集分页）
+        """
+        return await self.read(self._search_messages, match, like_patterns, limit, after, scan_limit)
+
+    @staticmethod
+    def _search_messages(conn: sqlite3.Connection, match: Optional[str], like_patterns: List[str], limit: int,
+                         after: Optional[Tuple[Optional[float], int]], scan_limit: int) -> List[tuple]:
+        filters = ''.join(" AND m.content LIKE ? ESCAPE '\\'" for _ in like_patterns)
+        if match:
+            # 相关度相同时按消息编号排序，使翻页的起点唯一
+            sql = f'''
+                SELECT m.id, m.conv_id, c.user_id, m.sender_id, m.content, m.timestamp, messages_fts.rank
+                FROM messages_fts
+                JOIN messages m ON m.id = messages_fts.rowid
+                JOIN conversations c ON c.id = m.conv_id
+                WHERE messages_fts MATCH ?{filters}{' AND (messages_fts.rank, m.id) > (?, ?)' if after else ''}
+                ORDER BY messages_fts.rank, m.id
+                LIMIT ?
+            '''
+            params = [match, *like_patterns, *(after or ()), limit]
+        else:
+            # 没有可用索引的关键词：只按主键范围扫描最近的消息，耗时有上限
+            sql = f'''
+                SELECT m.id, m.conv_id, c.user_id, m.sender_id, m.content, m.timestamp, NULL
+                FROM messages m
+                JOIN conversations c ON c.id = m.conv_id
+                WHERE m.id > (SELECT COALESCE(MAX(id), 0) FROM messages) - ?{' AND m.id < ?' if after else ''}{filters}
+                ORDER BY m.id DESC
+                LIMIT ?
+            '''
+            params = [scan_limit, *((after[1],) if after else ()), *like_patterns, limit]
+        return conn.execute(sql, params).fetchall()
+
+    async def backfill_search_index(self, batch_size: int = 5000) -> int:
+        """为建立全文索引前已有的消息补建索引（一批），返回本批条数，0 表示已完成"""
+        return await self.write(self._backfill_search_index, batch_size)
+
+    @staticmethod
+    def _backfill_search_index(conn: sqlite3.Connection, batch_size: int) -> int:
+        row = conn.execute('SELECT next_id, end_id FROM search_backfill WHERE id = 1').fetchone()
+        if not row:
+            return 0
+        next_id, end_id = row
+        upper = conn.execute('''
+            SELECT MAX(id), COUNT(*) FROM (
+                SELECT id FROM messages WHERE id > ? AND id <= ? ORDER BY id LIMIT ?
+            )
+        ''', (next_id, end_id, batch_size)).fetchone()
+        if not upper[1]:
+            conn.execute('DELETE FROM search_backfill')
+            return 0
+        conn.execute('''
+            INSERT INTO messages_fts (rowid, content)
+            SELECT id, content FROM messages WHERE id > ? AND id <= ?
+        ''', (next_id, upper[0]))
+        conn.execute('UPDATE search_backfill SET next_id = ? WHERE id = 1', (upper[0],))
+        return upper[1]
+
+    # ---- 归档 ----
+
+    async def get_archive_candidates(self, cutoff: str, limit: int) -> List[Tuple[int, str]]:
+        """最后活跃早于 cutoff 的已关闭会话 (id, created_at)；全文索引尚在补建时返回空列表"""
+        return await self.read(self._get_archive_candidates, cutoff, limit)
+
+    @staticmethod
+    def _get_archive_candidates(conn: sqlite3.Connection, cutoff: str, limit: int) -> List[Tuple[int, str]]:
+        # 外部内容 FTS 表删除未建索引的行会损坏索引，补建完成前不归档
+        if conn.execute('SELECT 1 FROM search_backfill WHERE next_id < end_id').fetchone():
+            return []
+        cursor = conn.execute('''
+            SELECT id, created_at FROM conversations
+            WHERE status = 'closed' AND last_active < ?
+            ORDER BY last_active
+            LIMIT ?
+        ''', (cutoff, limit))
+        return cursor.fetchall()
+
+    async def get_messages(self, conv_ids: List[int]) -> List[tuple]:
+        """数据库中这些会话的消息 (id, conv_id, sender_id, content, timestamp, media_type, file_unique_id)，
+        按会话和ID排序"""
+        return await self.read(self._get_messages, conv_ids)
+
+    @staticmethod
+    def _get_messages(conn: sqlite3.Connection, conv_ids: List[int]) -> List[tuple]:
+        rows = []
+        for conv_id in conv_ids:
+            rows.extend(conn.execute('''
+                SELECT id, conv_id, sender_id, content, timestamp, media_type, file_unique_id FROM messages
+                WHERE conv_id = ?
+                ORDER BY id
+            ''', (conv_id,)).fetchall())
+        return rows
+
+    async def finish_archive(self, conv_ids: List[int], entries: List[tuple]):
+        """记录归档位置 (conv_id, month, offset, length, count)，删除已归档的消息并标记会话"""
+        await self.write(self._finish_archive, conv_ids, entries)
+
+    @staticmethod
+    def _finish_archive(conn: sqlite3.Connection, conv_ids: List[int], entries: List[tuple]):
+        conn.executemany('''
+            INSERT OR REPLACE INTO archive_index (conv_id, month, offset, length, count)
+            VALUES (?, ?, ?, ?, ?)
+        ''', entries)
+        params = [(conv_id,) for conv_id in conv_ids]
+        conn.executemany('DELETE FROM messages WHERE conv_id = ?', params)
+        conn.executemany("UPDATE conversations SET status = 'archived' WHERE id = ?", params)
+
+    async def get_archive_entries(self, conv_id: int) -> List[tuple]:
+        """会话在归档文件中的位置 (conv_id, month, offset, length, count)"""
+        return await self.read(self._get_archive_entries, conv_id)
+
+    @staticmethod
+    def _get_archive_entries(conn: sqlite3.Connection, conv_id: int) -> List[tuple]:
+        cursor = conn.execute('''
+            SELECT conv_id, month, offset, length, count FROM archive_index
+            WHERE conv_id = ?
+            ORDER BY month, offset
+        ''', (conv_id,))
+        return cursor.fetchall()
+
+    async def release_free_pages(self):
+        """数据库为增量 auto_vacuum 模式时，把删除产生的空闲页还给文件系统"""
+        await self.write(self._release_free_pages)
+
+    @staticmethod
+    def _release_free_pages(conn: sqlite3.Connection):
+        if conn.execute('PRAGMA auto_vacuum').fetchone()[0] == 2:
+            conn.execute('PRAGMA incremental_vacuum').fetchall()
+
+    def vacuum(self):
+        """切换为增量 auto_vacuum 并整理数据库文件（耗时且锁库，用于停机维护）"""
+        def run(conn: sqlite3.Connection):
+            conn.execute('PRAGMA auto_vacuum = INCREMENTAL')
+            conn.execute('VACUUM')
+        self.write_sync(run)
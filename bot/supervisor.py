@@ -0,0 +1,306 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+多进程分片模式
+主进程只负责接收更新（长轮询或 webhook），按 user_id 分配给 N 个工作进程（见 sharding.py）；
+每个工作进程是一个完整的机器人实例，使用自己的数据库文件，同一用户的更新总是由同一进程依次处理。
+摘要模式下所有管理员的收件箱由主进程维护（各工作进程经队列发来事件），每个管理员只有一条收件箱消息。
+工作进程意外退出时自动重启；停机时先停止接收，再通知各工作进程处理完已分配的更新后退出
+
+用法：
+    python3 supervisor.py --workers 4
+"""
+
+import argparse
+import asyncio
+import configparser
+import logging
+import multiprocessing
+import os
+import queue
+import signal
+from multiprocessing.process import BaseProcess
+from typing import List, Optional
+
+from telegram import Bot, Update
+from telegram.error import TelegramError
+
+from admin_table import build_admin_table
+from bot import CustomerServiceBot
+from inbox import AdminInbox, apply_event
+from outbox import OutboundDispatcher
+from sharding import Shard, UpdateRouter, sender_count
+from webhook import WebhookServer
+
+logger = logging.getLogger(__name__)
+
+# 长轮询的等待时间（秒）
+POLL_TIMEOUT = 30
+
+
+def run_worker(config_file: str, shard: Shard, updates, inbox_events=None):
+    """工作进程入口"""
+    # 停止信号由主进程统一处理：先停止接收，再经队列通知工作进程
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    logging.basicConfig(
+        format=f'%(asctime)s - shard{shard.index} - %(name)s - %(levelname)s - %(message)s',
+        level=logging.INFO,
+        force=True
+    )
+    bot = CustomerServiceBot(config_file, shard=shard, inbox_events=inbox_events)
+    asyncio.run(bot.run_shard(updates))
+
+
+class Supervisor:
+    """接收更新并分配给各分片的工作进程"""
+
+    def __init__(self, config_file: str = 'config.ini', workers: Optional[int] = None):
+        self.config_file = config_file
+        self.config = self._load_config()
+        self.count = workers or self.config.getint('SHARDING', 'workers', fallback=1)
+        if self.count < 1:
+            raise ValueError("工作进程数至少为 1")
+        self.router = UpdateRouter(self.count, build_admin_table(self.config).ids)
+        self._context = multiprocessing.get_context('spawn')
+        # 每个分片一个有界队列：工作进程处理不过来时阻塞接收，更新暂存在 Telegram 一侧
+        queue_size = self.config.getint('SHARDING', 'queue_size', fallback=1000)
+        self.queues = [self._context.Queue(queue_size) for _ in range(self.count)]
+        self.processes: List[Optional[BaseProcess]] = [None] * self.count
+        # 摘要模式：工作进程发来的收件箱事件，由主进程中唯一的收件箱处理
+        self.inbox_events = (
+            self._context.Queue() if self.config.getboolean('SETTINGS', 'admin_inbox', fallback=False) else None
+        )
+        self.inbox: Optional[AdminInbox] = None
+        self.outbox: Optional[OutboundDispatcher] = None
+        self._relay: Optional[asyncio.Task] = None
+        self._config_mtime = self._stat_config()
+
+    def _load_config(self) -> configparser.ConfigParser:
+        config = configparser.ConfigParser()
+        config.read(self.config_file, encoding='utf-8')
+        return config
+
+    def _stat_config(self) -> Optional[float]:
+        try:
+            return os.path.getmtime(self.config_file)
+        except OSError:
+            return None
+
+    def _reload_admins(self):
+        """配置文件修改后更新路由使用的管理员（各工作进程自行重新加载其余配置）"""
+        mtime = self._stat_config()
+        if mtime is None or mtime == self._config_mtime:
+            return
+        self._config_mtime = mtime
+        try:
+            table = build_admin_table(self._load_config())
+        except (configparser.Error, ValueError) as e:
+            logger.error(f"重新加载管理员失败，继续使用原配置: {e}")
+            return
+        if table.ids:
+            self.router.set_admins(table.ids)
+
+    def _spawn(self, index: int):
+        process = self._context.Process(
+            target=run_worker,
+            args=(self.config_file, Shard(index, self.count), self.queues[index], self.inbox_events),
+            name=f'shard-{index}'
+        )
+        process.start()
+        self.processes[index] = process
+        logger.info(f"工作进程 shard-{index} 已启动（pid {process.pid}）")
+
+    async def dispatch(self, data: dict):
+        """把一个更新放入所属分片的队列"""
+        updates = self.queues[self.router.route(data)]
+        try:
+            updates.put_nowait(data)
+        except queue.Full:
+            await asyncio.to_thread(updates.put, data)
+
+    async def _watch_workers(self):
+        """重启意外退出的工作进程，检查配置文件是否修改"""
+        interval = self.config.getfloat('SETTINGS', 'config_reload_interval', fallback=5)
+        elapsed = 0.0
+        while True:
+            await asyncio.sleep(1)
+            for index, process in enumerate(self.processes):
+                if process is not None and not process.is_alive():
+                    logger.error(f"工作进程 shard-{index} 已退出（退出码 {process.exitcode}），正在重启")
+                    self._spawn(index)
+            elapsed += 1
+            if elapsed >= interval:
+                elapsed = 0.0
+                self._reload_admins()
+
+    def _forward_signal(self, sig: int):
+        """把 SIGHUP 转发给工作进程，立即重新加载配置"""
+        self._config_mtime = None
+        self._reload_admins()
+        for process in self.processes:
+            if process is not None and process.is_alive():
+                os.kill(process.pid, sig)
+
+    async def _poll(self, bot: Bot, stop: asyncio.Event):
+        """长轮询接收更新，直到收到停止信号"""
+        await bot.delete_webhook()
+        offset = None
+        waiter = asyncio.create_task(stop.wait())
+        try:
+            while not stop.is_set():
+                poll = asyncio.create_task(bot.get_updates(
+                    offset=offset, timeout=POLL_TIMEOUT, allowed_updates=Update.ALL_TYPES
+                ))
+                await asyncio.wait({poll, waiter}, return_when=asyncio.FIRST_COMPLETED)
+                if not poll.done():
+                    # 本次未确认的更新下次启动时重新投递
+                    poll.cancel()
+                    await asyncio.gather(poll, return_exceptions=True)
+                    break
+                try:
+                    updates = poll.result()
+                except TelegramError as e:
+                    logger.warning(f"获取更新失败: {e}")
+                    await asyncio.sleep(1)
+                    continue
+                for update in updates:
+                    await self.dispatch(update.to_dict())
+                    offset = update.update_id + 1
+        finally:
+            waiter.cancel()
+        if offset is not None:
+            # 确认已分配的更新，避免重启后重复投递
+            try:
+                await bot.get_updates(offset=offset, timeout=0, limit=1)
+            except TelegramError as e:
+                logger.warning(f"确认更新失败: {e}")
+
+    async def _serve_webhook(self, bot: Bot, stop: asyncio.Event):
+        """以 webhook 接收更新，直到收到停止信号"""
+        url = self.config.get('WEBHOOK', 'url')
+        secret_token = self.config.get('WEBHOOK', 'secret_token', fallback='') or None
+        server = WebhookServer(
+            self.dispatch,
+            host=self.config.get('WEBHOOK', 'listen', fallback='0.0.0.0'),
+            port=self.config.getint('WEBHOOK', 'port', fallback=8443),
+            path=self.config.get('WEBHOOK', 'path', fallback='/webhook'),
+            secret_token=secret_token,
+            max_concurrent=self.config.getint('WEBHOOK', 'max_concurrent_updates', fallback=64)
+        )
+        await server.start()
+        await bot.set_webhook(
+            url=url,
+            secret_token=secret_token,
+            max_connections=self.config.getint('WEBHOOK', 'max_connections', fallback=40),
+            allowed_updates=Update.ALL_TYPES
+        )
+        logger.info(f"Webhook 已设置: {url}")
+        await stop.wait()
+        await server.drain(self.config.getfloat('WEBHOOK', 'drain_timeout', fallback=30))
+
+    async def _start_inbox(self, bot: Bot):
+        """摘要模式下启动主进程中的收件箱；发送速率与各分片一样按发送进程数均分"""
+        if self.inbox_events is None:
+            return
+        senders = sender_count(self.config, self.count)
+        admin_chat_rate = self.config.getfloat('SETTINGS', 'send_chat_rate', fallback=1) / senders
+        # 只向管理员发送
+        self.outbox = OutboundDispatcher(
+            workers=2,
+            global_rate=self.config.getfloat('SETTINGS', 'send_global_rate', fallback=30) / senders,
+            chat_rate=admin_chat_rate,
+            max_retries=self.config.getint('SETTINGS', 'send_max_retries', fallback=5),
+            shared_chat_rate=admin_chat_rate,
+            is_shared_chat=lambda chat_id: True
+        )
+        self.inbox = AdminInbox(
+            self.outbox,
+            interval=self.config.getfloat('SETTINGS', 'inbox_refresh_seconds', fallback=3)
+        )
+        await self.outbox.start(bot)
+        self._relay = asyncio.create_task(self._relay_inbox())
+
+    async def _relay_inbox(self):
+        """依次执行工作进程发来的收件箱事件，直到收到结束标记"""
+        while True:
+            event = await asyncio.to_thread(self.inbox_events.get)
+            if event is None:
+                return
+            try:
+                apply_event(self.inbox, event)
+            except Exception as e:
+                logger.error(f"处理收件箱事件失败: {e}")
+
+    async def _stop_inbox(self):
+        """工作进程全部退出后停止收件箱，发出剩余的刷新"""
+        if self._relay is None:
+            return
+        await asyncio.to_thread(self.inbox_events.put, None)
+        await self._relay
+        self._relay = None
+        self.inbox.close()
+        await self.outbox.stop(self.config.getfloat('SETTINGS', 'shutdown_timeout', fallback=30))
+
+    async def _stop_workers(self):
+        """通知各工作进程处理完队列中的更新后退出，超时未退出的强制结束"""
+        for updates in self.queues:
+            await asyncio.to_thread(updates.put, None)
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.config.getfloat('SHARDING', 'stop_timeout', fallback=60)
+        for index, process in enumerate(self.processes):
+            if process is None:
+                continue
+            await asyncio.to_thread(process.join, max(0.0, deadline - loop.time()))
+            if process.is_alive():
+                logger.error(f"工作进程 shard-{index} 未在期限内退出，强制结束")
+                process.kill()
+                process.join()
+
+    async def run(self):
+        """启动工作进程并接收更新，直到收到停止信号"""
+        stop = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            try:
+                loop.add_signal_handler(sig, stop.set)
+            except NotImplementedError:
+                pass
+        if hasattr(signal, 'SIGHUP'):
+            try:
+                loop.add_signal_handler(signal.SIGHUP, self._forward_signal, signal.SIGHUP)
+            except NotImplementedError:
+                pass
+
+        mode = self.config.get('BOT', 'mode', fallback='polling')
+        async with Bot(self.config.get('BOT', 'token')) as bot:
+            await self._start_inbox(bot)
+            for index in range(self.count):
+                self._spawn(index)
+            watcher = asyncio.create_task(self._watch_workers())
+            logger.info(f"主进程启动中（{mode} 模式，{self.count} 个分片）...")
+            try:
+                if mode == 'webhook':
+                    await self._serve_webhook(bot, stop)
+                else:
+                    await self._poll(bot, stop)
+                logger.info("收到停止信号，等待工作进程处理完已分配的更新...")
+            finally:
+                watcher.cancel()
+                await asyncio.gather(watcher, return_exceptions=True)
+                await self._stop_workers()
+                # 工作进程退出前仍可能发来收件箱事件
+                await self._stop_inbox()
+
+
+def main():
+    """命令行入口"""
+    parser = argparse.ArgumentParser(description='多进程分片模式')
+    parser.add_argument('--config', default='config.ini', help='配置文件')
+    parser.add_argument('--workers', type=int, help='工作进程数（默认取配置文件中的 [SHARDING] workers）')
+    args = parser.parse_args()
+    asyncio.run(Supervisor(args.config, args.workers).run())
+
+
+if __name__ == '__main__':
+    main()
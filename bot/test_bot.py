@@ -5,9 +5,44 @@
 用于验证基本功能是否正常
 """
 
+import asyncio
+import json
+import os
+import queue
 import sqlite3
+import tempfile
+import time
+import types
 import configparser
+from pathlib import Path
 from bot import CustomerServiceBot
+from storage import Storage
+from write_behind import WriteBehindQueue
+from conversation_index import ConversationIndex
+from notification_map import NotificationMap
+from migrations import MIGRATIONS, current_version, migrate
+from expiry import ExpiryScheduler
+from outbox import OutboundDispatcher, TokenBucket
+from telegram import Update
+from telegram.error import BadRequest, RetryAfter
+from routing import AdminRouter
+from webhook import WebhookServer
+from benchmark import Benchmark
+from metrics import Registry, MetricsServer, timed
+from search import SearchHit, SearchSession, split_terms, like_pattern, snippet
+from export import ExportFilter, export, parse_command_args
+from archive import MessageArchive, archive_conversations, load_history
+from media import MediaCache, describe, media_label
+from burst import BurstCoalescer
+from locks import KeyedLock
+from faq import FaqResponder, load_rules
+from inbox import AdminInbox, InboxRelay, apply_event
+from dedup import UpdateDeduplicator
+from benchmark import FakeRequest
+from telegram.ext import Application
+from analytics import ADMIN, AUTO, SYSTEM, USER, AdminStats, merge_stats, query_stats
+from sharding import SHARD_STRIDE, Shard, UpdateRouter, apply_shard, configured_db_paths, shard_path
+from admission import ADMITTED, BLOCKED, OVERLOADED, THROTTLED, Admission, AdmissionController
 
 def test_config_loading():
     """测试配置文件加载"""
@@ -85,6 +120,1451 @@ def test_phone_masking():
         print(f"❌ 电话号码脱敏测试失败: {e}")
         return False
 
+def test_storage():
+    """测试异步存储层"""
+    print("\n💾 测试异步存储层...")
+    try:
+        with tempfile.TemporaryDirectory() as tmp:
+            storage = Storage(os.path.join(tmp, 'test.db'))
+            storage.init_schema()
+            
+            async def scenario():
+                conv_id = await storage.create_conversation(1001, 2002)
+                await storage.write_batch([(conv_id, 1001, '你好', '2024-01-01 00:00:00')],
+                                          {conv_id: '2024-01-01 00:00:00'})
+                return conv_id
+            
+            conv_id = asyncio.run(scenario())
+            active = [row[:3] for row in storage.load_active_conversations()]
+            journal_mode = storage.read_sync(lambda conn: conn.execute('PRAGMA journal_mode').fetchone()[0])
+            storage.close()
+            
+            if active != [(conv_id, 1001, 2002)]:
+                print(f"❌ 活跃会话查询错误: {active}")
+                return False
+            if journal_mode != 'wal':
+                print(f"❌ 未启用WAL模式: {journal_mode}")
+                return False
+        
+        print("✅ 异步存储层测试通过")
+        return True
+    except Exception as e:
+        print(f"❌ 异步存储层测试失败: {e}")
+        return False
+
+def test_write_behind():
+    """测试消息批量写回"""
+    print("\n📝 测试消息批量写回...")
+    try:
+        with tempfile.TemporaryDirectory() as tmp:
+            storage = Storage(os.path.join(tmp, 'test.db'))
+            storage.init_schema()
+            
+            async def scenario():
+                queue = WriteBehindQueue(storage, flush_interval=0.01, batch_size=50, max_pending=20)
+                await queue.start()
+                conv_ids = [await storage.create_conversation(uid, 2002) for uid in (1, 2, 3)]
+                for i in range(100):
+                    await queue.put_message(conv_ids[i % 3], 1, f"消息{i}")
+                await queue.close()
+                
+                # 数据库暂时不可写：重试直到成功，不丢弃整批
+                failures = []
+                write_batch = storage.write_batch
+                
+                async def flaky_write_batch(*args):
+                    if len(failures) < 5:
+                        failures.append(1)
+                        raise sqlite3.OperationalError('database is locked')
+                    return await write_batch(*args)
+                
+                storage.write_batch = flaky_write_batch
+                queue = WriteBehindQueue(storage, flush_interval=0.01, base_backoff=0.001, max_backoff=0.01)
+                await queue.start()
+                await queue.put_message(conv_ids[0], 1, "重试后保存的消息")
+                await queue.close()
+                del storage.write_batch
+                return len(failures)
+            
+            failures = asyncio.run(scenario())
+            count = storage.read_sync(lambda conn: conn.execute('SELECT COUNT(*) FROM messages').fetchone()[0])
+            storage.close()
+            
+            if count != 101 or failures != 5:
+                print(f"❌ 消息数量错误: {count}, {failures}")
+                return False
+        
+        print("✅ 消息批量写回测试通过")
+        return True
+    except Exception as e:
+        print(f"❌ 消息批量写回测试失败: {e}")
+        return False
+
+def test_conversation_index():
+    """测试活跃会话内存索引"""
+    print("\n🗂️  测试活跃会话索引...")
+    try:
+        index = ConversationIndex()
+        index.load([
+            (1, 1001, 2002, '2024-01-01 00:00:00'),
+            (2, 1001, 3003, '2024-01-01 00:05:00'),
+            (3, 1002, 2002, '2024-01-01 00:01:00')
+        ])
+        
+        if index.get(1001).conv_id != 2 or len(index) != 2:
+            print("❌ 启动重建未选择最近活跃的会话")
+            return False
+        
+        index.add(1003, 4, 2002, 0)
+        index.remove(2)
+        if index.admin_counts() != {2002: 2} or index.get(1001) is not None:
+            print(f"❌ 管理员会话计数错误: {index.admin_counts()}")
+            return False
+        
+        print("✅ 活跃会话索引测试通过")
+        return True
+    except Exception as e:
+        print(f"❌ 活跃会话索引测试失败: {e}")
+        return False
+
+def test_notification_map():
+    """测试通知消息到会话的映射"""
+    print("\n🔗 测试通知消息映射...")
+    try:
+        with tempfile.TemporaryDirectory() as tmp:
+            storage = Storage(os.path.join(tmp, 'test.db'))
+            storage.init_schema()
+            
+            async def scenario():
+                queue = WriteBehindQueue(storage, flush_interval=0.01)
+                await queue.start()
+                await NotificationMap(storage, queue).record(2002, 77, 5)
+                await queue.close()
+                # 新实例缓存为空，从数据库读取
+                fresh = NotificationMap(storage, queue)
+                return await fresh.resolve(2002, 77), await fresh.resolve(2002, 78)
+            
+            found, missing = asyncio.run(scenario())
+            storage.close()
+            
+            if found != 5 or missing is not None:
+                print(f"❌ 映射查询错误: {found}, {missing}")
+                return False
+        
+        print("✅ 通知消息映射测试通过")
+        return True
+    except Exception as e:
+        print(f"❌ 通知消息映射测试失败: {e}")
+        return False
+
+def test_migrations():
+    """测试数据库结构迁移"""
+    print("\n🧱 测试数据库迁移...")
+    try:
+        with tempfile.TemporaryDirectory() as tmp:
+            db_path = os.path.join(tmp, 'test.db')
+            
+            # 模拟没有 schema_version 的旧数据库
+            conn = sqlite3.connect(db_path)
+            conn.execute(MIGRATIONS[0].steps[0])
+            conn.execute("INSERT INTO conversations (user_id, admin_id) VALUES (1, 2)")
+            conn.commit()
+            conn.close()
+            
+            storage = Storage(db_path)
+            applied = storage.init_schema()
+            again = storage.init_schema()
+            version = storage.read_sync(current_version)
+            plan = storage.read_sync(lambda conn: conn.execute(
+                "EXPLAIN QUERY PLAN SELECT id FROM conversations WHERE status = 'active' AND last_active < ?",
+                ('2024-01-01 00:00:00',)
+            ).fetchall())
+            storage.close()
+            
+            if applied != [m.version for m in MIGRATIONS] or again or version != MIGRATIONS[-1].version:
+                print(f"❌ 迁移版本错误: {applied}, {again}, {version}")
+                return False
+            if 'idx_conversations_status_active' not in str(plan):
+                print(f"❌ 超时扫描未使用索引: {plan}")
+                return False
+        
+        print("✅ 数据库迁移测试通过")
+        return True
+    except Exception as e:
+        print(f"❌ 数据库迁移测试失败: {e}")
+        return False
+
+def test_search():
+    """测试全文搜索"""
+    print("\n🔍 测试全文搜索...")
+    try:
+        with tempfile.TemporaryDirectory() as tmp:
+            db_path = os.path.join(tmp, 'test.db')
+            
+            # 建立全文索引之前已有的消息
+            conn = sqlite3.connect(db_path)
+            conn.execute(MIGRATIONS[0].steps[0])
+            conn.execute(MIGRATIONS[0].steps[1])
+            conn.execute("INSERT INTO conversations (user_id, admin_id) VALUES (1001, 2)")
+            conn.executemany("INSERT INTO messages (conv_id, sender_id, content) VALUES (1, 1001, ?)",
+                             [('我的订单退款还没到账',), ('请问发票怎么开',), ('物流一直没有更新',)])
+            conn.commit()
+            conn.close()
+            
+            storage = Storage(db_path)
+            storage.init_schema()
+            
+            async def scenario():
+                batches = []
+                while True:
+                    count = await storage.backfill_search_index(batch_size=2)
+                    if not count:
+                        break
+                    batches.append(count)
+                await storage.write_batch([(1, 2, '退款已经处理，请查收', '2024-01-01 00:00:00')], {})
+                
+                async def search(*terms):
+                    match, short_terms = split_terms(list(terms))
+                    rows = await storage.search_messages(match, [like_pattern(t) for t in short_terms], 10)
+                    return sorted(row[4] for row in rows)
+                
+                hits = batches, await search('退款还没'), await search('退款'), await search('退款', '处理')
+                
+                # 键集分页：每页 2 条，从上一页最后一条之后继续
+                await storage.write_batch(
+                    [(1, 1001, f'第{n}次问退款还没到', '2024-01-02 00:00:00') for n in range(4)], {})
+                
+                async def pages(*terms, scan_limit=100000):
+                    match, short_terms = split_terms(list(terms))
+                    ids, after = [], None
+                    while True:
+                        rows = await storage.search_messages(
+                            match, [like_pattern(t) for t in short_terms], 2, after, scan_limit)
+                        if not rows:
+                            return ids
+                        ids.extend(row[0] for row in rows)
+                        after = SearchHit(*rows[-1]).key
+                
+                return hits + (await pages('退款还没'), await pages('退款'), await pages('退款', scan_limit=3))
+            
+            batches, long_hits, short_hits, both_hits, ranked_ids, recent_ids, bounded_ids = asyncio.run(scenario())
+            storage.close()
+        
+        if batches != [2, 1]:
+            print(f"❌ 分批补建索引错误: {batches}")
+            return False
+        if long_hits != ['我的订单退款还没到账']:
+            print(f"❌ 全文索引搜索错误: {long_hits}")
+            return False
+        if short_hits != ['我的订单退款还没到账', '退款已经处理，请查收'] or both_hits != ['退款已经处理，请查收']:
+            print(f"❌ 短关键词搜索错误: {short_hits}, {both_hits}")
+            return False
+        if sorted(ranked_ids) != [1, 5, 6, 7, 8] or recent_ids != [8, 7, 6, 5, 4, 1]:
+            print(f"❌ 翻页错误: {ranked_ids}, {recent_ids}")
+            return False
+        if bounded_ids != [8, 7, 6]:
+            print(f"❌ 短关键词扫描范围错误: {bounded_ids}")
+            return False
+        if snippet('我的订单退款还没到账', ['退款']) != '我的订单【退款】还没到账':
+            print(f"❌ 摘要错误: {snippet('我的订单退款还没到账', ['退款'])}")
+            return False
+        
+        print("✅ 全文搜索测试通过")
+        return True
+    except Exception as e:
+        print(f"❌ 全文搜索测试失败: {e}")
+        return False
+
+def test_export():
+    """测试会话记录导出"""
+    print("\n📦 测试会话记录导出...")
+    try:
+        import csv
+        import gzip
+        import json
+        
+        with tempfile.TemporaryDirectory() as tmp:
+            db_path = os.path.join(tmp, 'test.db')
+            storage = Storage(db_path)
+            storage.init_schema()
+            
+            async def fill():
+                first = await storage.create_conversation(1001, 2001)
+                second = await storage.create_conversation(1002, 2002)
+                await storage.write_batch([
+                    (second, 1002, '第二个会话', '2024-01-02 09:00:00'),
+                    (first, 1001, '你好', '2024-01-01 10:00:00'),
+                    (first, 2001, '您好，请问有什么可以帮您？', '2024-01-01 10:01:00'),
+                    (first, 1001, '订单, "加急"\n换行', '2024-01-03 08:00:00'),
+                ], {})
+            
+            asyncio.run(fill())
+            storage.close()
+            
+            jsonl_path = os.path.join(tmp, 'all.jsonl')
+            count = export(db_path, jsonl_path, 'jsonl', batch_size=2)
+            with open(jsonl_path, encoding='utf-8') as f:
+                records = [json.loads(line) for line in f]
+            
+            csv_path = os.path.join(tmp, 'jan01.csv.gz')
+            csv_count = export(db_path, csv_path, 'csv', compress=True, batch_size=1,
+                               filters=ExportFilter(since='2024-01-01 00:00:00', until='2024-01-02 00:00:00'))
+            with gzip.open(csv_path, 'rt', encoding='utf-8', newline='') as f:
+                rows = list(csv.DictReader(f))
+            
+            user_count = export(db_path, os.path.join(tmp, 'user.jsonl'), filters=ExportFilter(user_id=1002))
+        
+        order = [(r['conv_id'], r['message_id']) for r in records]
+        if count != 4 or order != sorted(order) or [r['sender'] for r in records[:2]] != ['user', 'admin']:
+            print(f"❌ JSONL 导出错误: {records}")
+            return False
+        if csv_count != 2 or [r['content'] for r in rows] != ['你好', '您好，请问有什么可以帮您？']:
+            print(f"❌ CSV 导出错误: {rows}")
+            return False
+        if records[2]['content'] != '订单, "加急"\n换行' or user_count != 1:
+            print(f"❌ 导出内容或过滤错误: {records[2]}, {user_count}")
+            return False
+        
+        fmt, export_filter = parse_command_args(['csv', '2024-01-01', '2024-01-31', 'admin=2001'])
+        if fmt != 'csv' or export_filter != ExportFilter('2024-01-01 00:00:00', '2024-02-01 00:00:00', 2001, None):
+            print(f"❌ /export 参数解析错误: {fmt}, {export_filter}")
+            return False
+        
+        print("✅ 会话记录导出测试通过")
+        return True
+    except Exception as e:
+        print(f"❌ 会话记录导出测试失败: {e}")
+        return False
+
+def test_archive():
+    """测试冷数据归档"""
+    print("\n🗄️  测试冷数据归档...")
+    try:
+        import gzip
+        
+        with tempfile.TemporaryDirectory() as tmp:
+            storage = Storage(os.path.join(tmp, 'test.db'))
+            storage.init_schema()
+            archive = MessageArchive(os.path.join(tmp, 'archive'))
+            
+            async def scenario():
+                old = [await storage.create_conversation(1000 + i, 2001) for i in range(3)]
+                active = await storage.create_conversation(1100, 2001)
+                await storage.write_batch(
+                    [(conv_id, 1000, f'旧消息 {conv_id}-{n}', '2024-01-01 00:00:00') for conv_id in old for n in range(2)]
+                    + [(active, 1100, '新消息', '2024-01-01 00:00:00')], {}
+                )
+                await storage.close_conversations(old)
+                result = await archive_conversations(storage, archive, '9999-01-01 00:00:00', batch_size=2, pause=0)
+                again = await archive_conversations(storage, archive, '9999-01-01 00:00:00', batch_size=2, pause=0)
+                history = await load_history(storage, archive, old[1])
+                hot = await storage.get_messages(old + [active])
+                statuses = await storage.read(lambda conn: conn.execute(
+                    'SELECT status, COUNT(*) FROM conversations GROUP BY status ORDER BY status').fetchall())
+                return old, result, again, history, hot, statuses
+            
+            old, result, again, history, hot, statuses = asyncio.run(scenario())
+            storage.close()
+            files = os.listdir(os.path.join(tmp, 'archive'))
+            with gzip.open(os.path.join(tmp, 'archive', files[0]), 'rt', encoding='utf-8') as f:
+                archived_lines = f.read().splitlines()
+        
+        if result != (3, 6) or again != (0, 0):
+            print(f"❌ 归档数量错误: {result}, {again}")
+            return False
+        if [m['content'] for m in history] != [f'旧消息 {old[1]}-0', f'旧消息 {old[1]}-1']:
+            print(f"❌ 读取归档记录错误: {history}")
+            return False
+        if [row[3] for row in hot] != ['新消息'] or statuses != [('active', 1), ('archived', 3)]:
+            print(f"❌ 归档后数据库状态错误: {hot}, {statuses}")
+            return False
+        if len(files) != 1 or len(archived_lines) != 6:
+            print(f"❌ 归档文件错误: {files}, {len(archived_lines)}")
+            return False
+        
+        print("✅ 冷数据归档测试通过")
+        return True
+    except Exception as e:
+        print(f"❌ 冷数据归档测试失败: {e}")
+        return False
+
+def test_media():
+    """测试媒体消息描述和去重缓存"""
+    print("\n🖼️  测试媒体消息...")
+    try:
+        from types import SimpleNamespace
+        
+        photo = SimpleNamespace(
+            photo=[SimpleNamespace(file_id='small', file_unique_id='U1s'), SimpleNamespace(file_id='big', file_unique_id='U1')],
+            caption='截图'
+        )
+        voice = SimpleNamespace(photo=[], voice=SimpleNamespace(file_id='v', file_unique_id='V1'), caption=None)
+        text = SimpleNamespace(photo=[], text='你好', caption=None)
+        
+        with tempfile.TemporaryDirectory() as tmp:
+            storage = Storage(os.path.join(tmp, 'test.db'))
+            storage.init_schema()
+            queue = WriteBehindQueue(storage, flush_interval=0.01)
+            cache = MediaCache(queue, capacity=1)
+            
+            async def scenario():
+                await queue.start()
+                conv_id = await storage.create_conversation(1001, 2001)
+                media = describe(photo)
+                first = await cache.remember(media)
+                repeat = await cache.remember(media)
+                await cache.remember(describe(voice))
+                # 被淘汰后再次出现
+                await cache.remember(media)
+                await queue.put_message(conv_id, 1001, media.caption, media.media_type, media.file_unique_id)
+                await queue.close()
+                return first, repeat
+            
+            first, repeat = asyncio.run(scenario())
+            files = storage.read_sync(lambda conn: conn.execute(
+                'SELECT file_unique_id, file_id FROM media_files ORDER BY file_unique_id').fetchall())
+            messages = storage.read_sync(lambda conn: conn.execute(
+                'SELECT content, media_type, file_unique_id FROM messages').fetchall())
+            storage.close()
+        
+        if describe(photo).file_id != 'big' or describe(voice).caption != '' or describe(text) is not None:
+            print(f"❌ 媒体描述错误: {describe(photo)}, {describe(voice)}")
+            return False
+        if (first, repeat) != (True, False) or files != [('U1', 'big'), ('V1', 'v')]:
+            print(f"❌ 去重缓存错误: {first}, {repeat}, {files}")
+            return False
+        if messages != [('截图', 'photo', 'U1')] or media_label('voice', '') != '[语音]':
+            print(f"❌ 媒体消息保存错误: {messages}")
+            return False
+        
+        print("✅ 媒体消息测试通过")
+        return True
+    except Exception as e:
+        print(f"❌ 媒体消息测试失败: {e}")
+        return False
+
+def test_burst_coalescer():
+    """测试连续消息合并"""
+    print("\n🧺 测试连续消息合并...")
+    try:
+        edits = []
+        
+        async def scenario():
+            coalescer = BurstCoalescer(1.0, lambda burst: edits.append(burst.render()), edit_delay=0.05,
+                                       max_length=60)
+            # 第一条通知发送失败：窗口内的消息不能并入失败的通知
+            failed = coalescer.start(1, 2001, '📨 用户消息', '第零行', 0.0)
+            before_sent = coalescer.merge(1, 2001, '第一行', 0.1)
+            coalescer.forget(1, failed)
+            after_failed = coalescer.merge(1, 2001, '第一行', 0.1)
+            
+            burst = coalescer.start(1, 2001, '📨 用户消息', '第一行', 0.1)
+            coalescer.sent(burst, 100)
+            # 已结束的窗口不影响当前窗口
+            coalescer.forget(1, failed)
+            merged = [coalescer.merge(1, 2001, '第二行', 0.5), coalescer.merge(1, 2001, '第三行', 1.2)]
+            await asyncio.sleep(0.1)
+            # 超出窗口或长度时不合并
+            late = coalescer.merge(1, 2001, '第四行', 5.0)
+            too_long = coalescer.merge(1, 2001, '很长' * 30, 1.5)
+            other_admin = coalescer.merge(1, 2002, '第五行', 1.5)
+            coalescer.merge(1, 2001, '第六行', 1.6)
+            coalescer.forget(1)
+            return merged, (before_sent, after_failed), late, too_long, other_admin
+        
+        merged, before_sent, late, too_long, other_admin = asyncio.run(scenario())
+        expected = [
+            '📨 用户消息\n\n💬 第一行\n💬 第二行\n💬 第三行',
+            '📨 用户消息\n\n💬 第一行\n💬 第二行\n💬 第三行\n💬 第六行',
+        ]
+        if merged != [True, True] or before_sent != (False, False) or (late, too_long, other_admin) != (False, False, False):
+            print(f"❌ 合并判断错误: {merged}, {before_sent}, {late}, {too_long}, {other_admin}")
+            return False
+        if edits != expected:
+            print(f"❌ 编辑内容错误: {edits}")
+            return False
+        
+        print("✅ 连续消息合并测试通过")
+        return True
+    except Exception as e:
+        print(f"❌ 连续消息合并测试失败: {e}")
+        return False
+
+def test_expiry_scheduler():
+    """测试会话到期调度"""
+    print("\n⏰ 测试会话到期调度...")
+    try:
+        last_active = {}
+        batches = []
+        
+        async def on_expire(conv_ids):
+            batches.append(sorted(conv_ids))
+            for conv_id in conv_ids:
+                last_active.pop(conv_id)
+        
+        async def scenario():
+            scheduler = ExpiryScheduler(0.2, last_active.get, on_expire, slack=0.05)
+            await scheduler.start()
+            now = time.time()
+            for conv_id in (1, 2, 3):
+                last_active[conv_id] = now
+                scheduler.schedule(conv_id, now)
+            await asyncio.sleep(0.1)
+            # 会话2有新消息，应顺延到期
+            last_active[2] = time.time()
+            await asyncio.sleep(0.2)
+            first = list(batches)
+            await asyncio.sleep(0.2)
+            await scheduler.stop()
+            return first
+        
+        first = asyncio.run(scenario())
+        if first != [[1, 3]] or batches != [[1, 3], [2]]:
+            print(f"❌ 到期批次错误: {batches}")
+            return False
+        
+        print("✅ 会话到期调度测试通过")
+        return True
+    except Exception as e:
+        print(f"❌ 会话到期调度测试失败: {e}")
+        return False
+
+def test_outbox():
+    """测试出站消息调度"""
+    print("\n📤 测试出站消息调度...")
+    try:
+        bucket = TokenBucket(rate=2, capacity=2)
+        if bucket.consume(0) or bucket.consume(0) or bucket.consume(0) != 0.5:
+            print("❌ 令牌桶计算错误")
+            return False
+        
+        class FlakyBot:
+            def __init__(self):
+                self.delivered = []
+                self.failed_once = False
+            
+            async def send_message(self, chat_id, text, **kwargs):
+                if text == 'bad':
+                    raise BadRequest('chat not found')
+                if chat_id == 1 and not self.failed_once:
+                    self.failed_once = True
+                    raise RetryAfter(0.05)
+                self.delivered.append((chat_id, text))
+                return text
+        
+        with tempfile.TemporaryDirectory() as tmp:
+            storage = Storage(os.path.join(tmp, 'test.db'))
+            storage.init_schema()
+            bot = FlakyBot()
+            failures = []
+            
+            async def on_failed(error):
+                failures.append(str(error))
+            
+            async def scenario():
+                outbox = OutboundDispatcher(storage, workers=4, global_rate=1000, chat_rate=1000, base_backoff=0.01)
+                await outbox.start(bot)
+                for i in range(5):
+                    outbox.send_message(1, f"a{i}")
+                    outbox.send_message(2, f"b{i}")
+                outbox.send_message(3, 'bad', on_failed=on_failed)
+                return await outbox.stop(timeout=5)
+            
+            remaining = asyncio.run(scenario())
+            dead = storage.read_sync(lambda conn: conn.execute('SELECT chat_id, method FROM dead_letters').fetchall())
+            storage.close()
+        
+        if remaining or [t for c, t in bot.delivered if c == 1] != [f"a{i}" for i in range(5)]:
+            print(f"❌ 消息顺序错误: {bot.delivered}")
+            return False
+        if dead != [(3, 'send_message')] or len(failures) != 1:
+            print(f"❌ 死信记录错误: {dead}")
+            return False
+        
+        print("✅ 出站消息调度测试通过")
+        return True
+    except Exception as e:
+        print(f"❌ 出站消息调度测试失败: {e}")
+        return False
+
+def test_admin_router():
+    """测试管理员自动分配"""
+    print("\n⚖️  测试管理员自动分配...")
+    try:
+        router = AdminRouter([1, 2, 3], weights={1: 2, 3: 0}, mode='least_loaded')
+        if router.pick({1: 3, 2: 2}) != 1 or router.pick({1: 4, 2: 1}) != 2:
+            print("❌ 按权重折算的负载选择错误")
+            return False
+        
+        router = AdminRouter([1, 2], mode='fastest')
+        router.user_message(10, 0)
+        router.admin_reply(10, 1, 30)
+        router.user_message(11, 0)
+        router.admin_reply(11, 2, 5)
+        if router.pick({}) != 2:
+            print(f"❌ 按响应时间选择错误: {router.response_times}")
+            return False
+        
+        print("✅ 管理员自动分配测试通过")
+        return True
+    except Exception as e:
+        print(f"❌ 管理员自动分配测试失败: {e}")
+        return False
+
+def test_webhook_server():
+    """测试 webhook 接收端"""
+    print("\n🌐 测试 webhook 接收端...")
+    try:
+        received = []
+        
+        async def process_update(data):
+            await asyncio.sleep(0.05)
+            if data['update_id'] == 3:
+                raise RuntimeError('处理失败')
+            received.append(data['update_id'])
+        
+        async def post(port, body, secret):
+            reader, writer = await asyncio.open_connection('127.0.0.1', port)
+            writer.write((
+                "POST /webhook HTTP/1.1\r\n"
+                f"X-Telegram-Bot-Api-Secret-Token: {secret}\r\n"
+                f"Content-Length: {len(body)}\r\n"
+                "Connection: close\r\n\r\n"
+            ).encode() + body)
+            status = (await reader.readline()).split()[1]
+            writer.close()
+            return int(status)
+        
+        async def scenario():
+            server = WebhookServer(process_update, host='127.0.0.1', port=0, secret_token='s3cret', max_concurrent=2)
+            await server.start()
+            port = server.http.address[1]
+            # 返回 200 时更新已处理完成；处理失败返回 500，由 Telegram 重发
+            statuses = [await post(port, b'{"update_id": 1}', 's3cret')]
+            statuses.append(list(received))
+            statuses += [
+                await post(port, b'{"update_id": 2}', 'wrong'),
+                await post(port, b'{"update_id": 2}', '密钥'),
+                await post(port, b'not json', 's3cret'),
+                await post(port, b'{"update_id": 3}', 's3cret')
+            ]
+            await server.drain(timeout=5)
+            return statuses
+        
+        statuses = asyncio.run(scenario())
+        if statuses != [200, [1], 403, 403, 400, 500] or received != [1]:
+            print(f"❌ webhook 响应错误: {statuses}, {received}")
+            return False
+        
+        print("✅ webhook 接收端测试通过")
+        return True
+    except Exception as e:
+        print(f"❌ webhook 接收端测试失败: {e}")
+        return False
+
+def test_metrics():
+    """测试运行指标"""
+    print("\n📈 测试运行指标...")
+    try:
+        registry = Registry()
+        calls = registry.counter('test_calls_total', '调用次数', ('result',))
+        latency = registry.histogram('test_seconds', '耗时', ('fn',), buckets=(0.01, 0.1))
+        errors = registry.counter('test_errors_total', '异常数', ('fn',))
+        registry.gauge('test_pending', '队列长度', lambda: 3)
+        
+        @timed(latency, errors, fn='work')
+        async def work(fail):
+            if fail:
+                raise ValueError('boom')
+        
+        async def scenario():
+            await work(False)
+            try:
+                await work(True)
+            except ValueError:
+                pass
+            calls.labels('ok').inc(2)
+            
+            server = MetricsServer(registry, port=0)
+            await server.start()
+            reader, writer = await asyncio.open_connection('127.0.0.1', server.http.address[1])
+            writer.write(b"GET /metrics HTTP/1.1\r\nConnection: close\r\n\r\n")
+            response = (await reader.read()).decode('utf-8')
+            writer.close()
+            await server.close()
+            return response
+        
+        response = asyncio.run(scenario())
+        expected = [
+            'HTTP/1.1 200 OK',
+            'test_calls_total{result="ok"} 2',
+            'test_seconds_bucket{fn="work",le="0.01"} 2',
+            'test_seconds_bucket{fn="work",le="+Inf"} 2',
+            'test_seconds_count{fn="work"} 2',
+            'test_errors_total{fn="work"} 1',
+            'test_pending 3',
+        ]
+        missing = [line for line in expected if line not in response]
+        if missing:
+            print(f"❌ 指标输出缺少: {missing}")
+            return False
+        
+        print("✅ 运行指标测试通过")
+        return True
+    except Exception as e:
+        print(f"❌ 运行指标测试失败: {e}")
+        return False
+
+def test_benchmark():
+    """测试性能测试工具"""
+    print("\n🏎️  测试性能测试工具...")
+    try:
+        with tempfile.TemporaryDirectory() as tmp:
+            benchmark = Benchmark('config.ini', tmp, users=5, messages=3, user_rate=0, admin_rate=0,
+                                  api_latency=0, telegram_limits=False)
+            report = asyncio.run(benchmark.run())
+        
+        handlers = report['handlers']
+        if handlers['handle_user_message']['count'] != 15 or any(h['errors'] for h in handlers.values()):
+            print(f"❌ 性能测试结果错误: {handlers}")
+            return False
+        
+        print(f"✅ 性能测试工具测试通过（{report['throughput']} 更新/秒）")
+        return True
+    except Exception as e:
+        print(f"❌ 性能测试工具测试失败: {e}")
+        return False
+
+def test_concurrent_updates():
+    """测试按用户串行、并发处理更新"""
+    print("\n🔀 测试并发处理更新...")
+    try:
+        locks = KeyedLock()
+        order = []
+        
+        async def work(key, name, delay):
+            async with locks.hold(key):
+                order.append(f"{name}+")
+                await asyncio.sleep(delay)
+                order.append(f"{name}-")
+        
+        async def lock_scenario():
+            # a1、a2 同一键依次执行，b 与 a1 并行
+            await asyncio.gather(work(1, 'a1', 0.02), work(1, 'a2', 0), work(2, 'b', 0))
+            return len(locks)
+        
+        remaining = asyncio.run(lock_scenario())
+        if order != ['a1+', 'b+', 'b-', 'a1-', 'a2+', 'a2-'] or remaining != 0:
+            print(f"❌ 按键加锁错误: {order}, 剩余 {remaining}")
+            return False
+        
+        with tempfile.TemporaryDirectory() as tmp:
+            benchmark = Benchmark('config.ini', tmp, users=1, messages=0, user_rate=0, admin_rate=0,
+                                  api_latency=0.01, telegram_limits=False)
+            bot, updates, context = benchmark.bot, benchmark.updates, benchmark.context
+            admin_ids = list(bot.admins.values())
+            
+            async def scenario():
+                await bot._post_init(types.SimpleNamespace(bot=benchmark.fake_bot))
+                # 同一用户快速点击两次
+                await asyncio.gather(*(
+                    bot.button_callback(updates.callback(1001, f"admin_{admin_ids[0]}"), context) for _ in range(2)
+                ))
+                # 改选其他管理员时关闭原会话
+                await bot.button_callback(updates.callback(1001, f"admin_{admin_ids[-1]}"), context)
+                rows = await bot.storage.read(lambda conn: conn.execute(
+                    'SELECT admin_id, status FROM conversations WHERE user_id = 1001 ORDER BY id').fetchall())
+                
+                # 超时关闭等待正在处理的转发；关闭提交前新建会话不能返回正在关闭的会话
+                closing, _ = await bot._create_conversation(1002, admin_ids[0])
+                touched, _ = await bot._create_conversation(1003, admin_ids[0])
+                async with bot.conversation_locks.hold(closing, touched):
+                    expiring = asyncio.create_task(bot._expire_conversations([closing, touched]))
+                    await asyncio.sleep(0.01)
+                    creating = asyncio.create_task(bot._create_conversation(1002, admin_ids[0]))
+                    await asyncio.sleep(0.01)
+                    # 等锁期间有新消息的会话不关闭
+                    bot.conversations.touch(touched, time.time() + 1)
+                await expiring
+                reopened, created = await creating
+                statuses = dict(await bot.storage.read(lambda conn: conn.execute(
+                    'SELECT id, status FROM conversations WHERE user_id IN (1002, 1003) ORDER BY id').fetchall()))
+                await bot._post_shutdown(None)
+                return len(benchmark.fake_bot.notifications[admin_ids[0]]), rows, (
+                    created, reopened != closing, statuses, bot._get_active_conversation(1003))
+            
+            first, rows, expired = asyncio.run(scenario())
+        
+        expected = [(admin_ids[0], 'closed'), (admin_ids[-1], 'active')] if len(admin_ids) > 1 else [(admin_ids[0], 'active')]
+        if first != 1 or rows != expected:
+            print(f"❌ 会话创建不幂等: 通知 {first} 条, {rows}")
+            return False
+        created, reopened, statuses, active = expired
+        if not created or not reopened or list(statuses.values()) != ['closed', 'active', 'active'] or \
+                active is None:
+            print(f"❌ 超时关闭与新建会话冲突: {expired}")
+            return False
+        
+        print("✅ 并发处理更新测试通过")
+        return True
+    except Exception as e:
+        print(f"❌ 并发处理更新测试失败: {e}")
+        return False
+
+def test_admission():
+    """测试入站限流和自动拉黑"""
+    print("\n🚦 测试入站限流...")
+    try:
+        overloaded = [False]
+        controller = AdmissionController(user_rate=1, user_burst=2, global_rate=0.01, global_burst=3,
+                                         strikes=3, strike_window=60, block_seconds=100, notice_interval=10,
+                                         is_overloaded=lambda: overloaded[0], sweep_interval=30)
+        # 突发 2 条后限速，只提示一次
+        burst = [controller.check(1, 0.0) for _ in range(4)]
+        if [a.result for a in burst] != [ADMITTED, ADMITTED, THROTTLED, THROTTLED] or \
+                [a.notify for a in burst[2:]] != [True, False]:
+            print(f"❌ 用户限速错误: {burst}")
+            return False
+        # 第 3 次超限被拉黑，拉黑时提示；令牌恢复后仍被拒绝
+        third = controller.check(1, 0.1)
+        if third.result != BLOCKED or not third.notify or controller.check(1, 50).result != BLOCKED:
+            print(f"❌ 自动拉黑错误: {third}")
+            return False
+        # 全局令牌桶与积压
+        others = [controller.check(uid, 1.0).result for uid in (2, 3)]
+        overloaded[0] = True
+        shed = controller.check(4, 1.0).result
+        overloaded[0] = False
+        if others != [ADMITTED, OVERLOADED] or shed != OVERLOADED:
+            print(f"❌ 全局准入错误: {others}, {shed}")
+            return False
+        # 到期自动解除，过期状态被清理
+        if controller.check(1, 200).result != ADMITTED or controller.blocked_count != 0:
+            print("❌ 拉黑未自动解除")
+            return False
+        controller.check(5, 1000)
+        if len(controller._buckets) != 1:
+            print(f"❌ 令牌桶未清理: {len(controller._buckets)}")
+            return False
+        
+        # 被拒绝的按钮回调也要应答，否则客户端一直显示加载中；不需要提示时应答不带文字
+        answered = []
+        
+        class AnswerBot:
+            async def answer_callback_query(self, callback_query_id, text=None):
+                answered.append((callback_query_id, text))
+                return True
+        
+        async def reject():
+            outbox = OutboundDispatcher()
+            host = types.SimpleNamespace(outbox=outbox)
+            for query_id, notify in (('q1', True), ('q2', False)):
+                update = Update.de_json({'update_id': 1, 'callback_query': {
+                    'id': query_id, 'from': {'id': 1001, 'is_bot': False, 'first_name': 'u'},
+                    'chat_instance': '1', 'data': 'admin_2001'}}, None)
+                CustomerServiceBot._reject_update(host, update, Admission(THROTTLED, notify))
+            await outbox.start(AnswerBot())
+            await outbox.stop(5)
+        
+        asyncio.run(reject())
+        if answered != [('q1', '⚠️ 消息发送过快，部分消息未能送达，请放慢速度。'), ('q2', None)]:
+            print(f"❌ 被拒绝的按钮回调未应答: {answered}")
+            return False
+        
+        print("✅ 入站限流测试通过")
+        return True
+    except Exception as e:
+        print(f"❌ 入站限流测试失败: {e}")
+        return False
+
+def test_faq():
+    """测试常见问题自动回复"""
+    print("\n🤖 测试常见问题自动回复...")
+    try:
+        admins = {'技术支持': 2001, '财务咨询': 2002}
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'faq.ini')
+            with open(path, 'w', encoding='utf-8') as f:
+                f.write(
+                    "[退款]\nkeywords = 退款, Refund\nregex = 订单.*取消\nadmins = 财务咨询\nanswer = 退款说明\n\n"
+                    "[发货]\nkeywords = 发货, 快递\nanswer = 发货说明\n\n"
+                    "[无效]\nkeywords = 坏规则\n\n"
+                    "[发货时间]\nkeywords = 什么时候发货\nforward = true\nanswer = 发货时间说明\n\n"
+                    "[单号]\nregex = \\A(单号|ORDER)\\s*\\d+\\Z\nanswer = 单号说明\n"
+                )
+            rules = load_rules(path, admins)
+            faq = FaqResponder(path, admins)
+            faq.load()
+            
+            cases = {
+                ('我要退款', 2002): '退款',
+                ('我要退款', 2001): None,           # 只对财务咨询的会话生效
+                ('ＲＥＦＵＮＤ please', 2002): '退款',  # 全角/大小写
+                ('订单可以取消吗', 2002): '退款',
+                ('退款后什么时候发货', 2001): '发货',   # 靠前的规则优先
+                ('什么时候发货', None): '发货',
+                ('你好', None): None,
+                ('单号 12345', None): '单号',          # 正则不做大小写转换：\d、\Z 保持原义
+                ('Order 42', None): '单号',
+                ('单号 abc', None): None,
+            }
+            results = {key: getattr(faq.match(*key), 'name', None) for key in cases}
+            
+            with open(path, 'w', encoding='utf-8') as f:
+                f.write("[问候]\nkeywords = 你好\nanswer = 您好\n")
+            os.utime(path, (time.time() + 10, time.time() + 10))
+            reloaded = asyncio.run(faq.reload_if_changed())
+            after = getattr(faq.match('你好'), 'name', None)
+        
+        if [r.name for r in rules] != ['退款', '发货', '发货时间', '单号'] or not rules[2].forward:
+            print(f"❌ 规则解析错误: {rules}")
+            return False
+        if results != cases:
+            print(f"❌ 规则匹配错误: {results}")
+            return False
+        if not reloaded or after != '问候' or faq.match('发货'):
+            print(f"❌ 规则重新加载错误: {reloaded}, {after}")
+            return False
+        
+        print("✅ 常见问题自动回复测试通过")
+        return True
+    except Exception as e:
+        print(f"❌ 常见问题自动回复测试失败: {e}")
+        return False
+
+def test_config_reload():
+    """测试配置热加载"""
+    print("\n♻️  测试配置热加载...")
+    try:
+        def write_config(path, admins, mode='manual'):
+            config = configparser.ConfigParser()
+            config['BOT'] = {'token': '1:TEST'}
+            config['ADMINS'] = admins
+            config['SETTINGS'] = {'db_path': os.path.join(os.path.dirname(path), 'test.db'),
+                                  'routing_mode': mode, 'config_reload_interval': '0.05'}
+            with open(path, 'w', encoding='utf-8') as f:
+                config.write(f)
+        
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'config.ini')
+            write_config(path, {'技术支持': '2001', '财务咨询': '2002'})
+            bot = CustomerServiceBot(path)
+            old_keyboard = bot._get_admin_keyboard()
+            bot.reply_targets[2002] = 1
+            
+            async def scenario():
+                watcher = asyncio.create_task(bot._watch_config())
+                write_config(path, {'技术支持': '2001', '客服主管': '2003', '产品经理': '2004'}, 'least_loaded')
+                os.utime(path, (time.time() + 10, time.time() + 10))
+                await asyncio.sleep(0.2)
+                # 新配置无效时保留原配置
+                write_config(path, {'无效': 'abc'})
+                invalid = await bot.reload_config()
+                watcher.cancel()
+                await asyncio.gather(watcher, return_exceptions=True)
+                return invalid
+            
+            invalid = asyncio.run(scenario())
+            bot.storage.close()
+        
+        keyboard = bot._get_admin_keyboard()
+        buttons = [button.callback_data for row in keyboard.inline_keyboard for button in row]
+        if dict(bot.admins) != {'技术支持': 2001, '客服主管': 2003, '产品经理': 2004} or invalid:
+            print(f"❌ 管理员未更新: {dict(bot.admins)}, {invalid}")
+            return False
+        if buttons != ['admin_2001', 'admin_2003', 'admin_2004', 'admin_auto'] or keyboard is old_keyboard:
+            print(f"❌ 管理员键盘未更新: {buttons}")
+            return False
+        if bot.admin_filter.user_ids != {2001, 2003, 2004} or set(bot.router.weights) != {2001, 2003, 2004} \
+                or not bot.router.automatic or bot.reply_targets or bot._get_admin_keyboard() is not keyboard:
+            print(f"❌ 路由表未更新: {bot.admin_filter.user_ids}, {bot.router.weights}")
+            return False
+        
+        print("✅ 配置热加载测试通过")
+        return True
+    except Exception as e:
+        print(f"❌ 配置热加载测试失败: {e}")
+        return False
+
+def test_admin_inbox():
+    """测试管理员收件箱"""
+    print("\n📥 测试管理员收件箱...")
+    try:
+        class RecordingOutbox:
+            def __init__(self):
+                self.calls = []
+            
+            def enqueue(self, method, chat_id, on_sent=None, on_failed=None, **kwargs):
+                self.calls.append((method, chat_id, kwargs))
+                if on_sent:
+                    asyncio.get_running_loop().create_task(on_sent(types.SimpleNamespace(message_id=500)))
+            
+            def send_message(self, chat_id, text, **kwargs):
+                self.enqueue('send_message', chat_id, text=text, **kwargs)
+        
+        outbox = RecordingOutbox()
+        
+        def methods():
+            return [method for method, _, _ in outbox.calls]
+        
+        async def scenario():
+            inbox = AdminInbox(outbox, interval=0.2)
+            inbox.track(2001, 1, '@alice')
+            for i in range(10):
+                inbox.user_message(2001, 1, '@alice', f"消息{i}")
+            await asyncio.sleep(0.05)
+            first = methods()
+            # 间隔内的变化合并为一次编辑
+            for i in range(10, 15):
+                inbox.user_message(2001, 1, '@alice', f"消息{i}", source=(1, 77) if i == 14 else None)
+            await asyncio.sleep(0.05)
+            throttled = methods()
+            await asyncio.sleep(0.25)
+            edited = methods()
+            # 内容没有变化时不编辑
+            inbox.track(2001, 1, '@alice')
+            await asyncio.sleep(0.3)
+            unchanged = methods()
+            items = inbox.open(1)
+            count = inbox.unread_count(1)
+            await asyncio.sleep(0.3)
+            inbox.remove(1)
+            await asyncio.sleep(0.3)
+            inbox.close()
+            return first, throttled, edited, unchanged, items, count
+        
+        first, throttled, edited, unchanged, items, count = asyncio.run(scenario())
+        if first != ['send_message', 'pin_chat_message'] or throttled != first:
+            print(f"❌ 收件箱未合并刷新: {first}, {throttled}")
+            return False
+        if edited != first + ['edit_message_text'] or unchanged != edited:
+            print(f"❌ 收件箱编辑次数错误: {edited}, {unchanged}")
+            return False
+        text = outbox.calls[2][2]['text']
+        buttons = outbox.calls[2][2]['reply_markup'].inline_keyboard
+        if '15 条未读' not in text or '消息14' not in text or buttons[0][0].callback_data != 'reply_1':
+            print(f"❌ 收件箱内容错误: {text}")
+            return False
+        if len(items) != 15 or items[-1].source != (1, 77) or count != 0:
+            print(f"❌ 未读消息错误: {len(items)}, {count}")
+            return False
+        if methods().count('edit_message_text') != 3 or '暂无活跃会话' not in outbox.calls[-1][2]['text']:
+            print(f"❌ 会话结束后未刷新: {outbox.calls[-1]}")
+            return False
+        
+        print("✅ 管理员收件箱测试通过")
+        return True
+    except Exception as e:
+        print(f"❌ 管理员收件箱测试失败: {e}")
+        return False
+
+def test_analytics():
+    """测试管理员服务统计"""
+    print("\n📊 测试管理员服务统计...")
+    try:
+        messages = [
+            (2001, '🔔 新用户咨询', '2024-01-01 10:00:00', SYSTEM),
+            (1001, '你好', '2024-01-01 10:05:00', USER),
+            (2001, '[自动回复] 请稍候', '2024-01-01 10:06:00', AUTO),
+            (2001, '您好', '2024-01-01 10:10:00', ADMIN),
+            (2001, '请问还有问题吗', '2024-01-01 10:20:00', ADMIN),
+            (1001, '谢谢', '2024-01-01 11:00:00', USER),
+        ]
+        expected = AdminStats(2001, opened=1, closed=1, user_messages=2, admin_messages=2, auto_replies=1,
+                              first_responses=1, first_response_seconds=600.0, resolution_seconds=3600.0)
+        
+        with tempfile.TemporaryDirectory() as tmp:
+            # 增量更新
+            storage = Storage(os.path.join(tmp, 'test.db'))
+            storage.init_schema()
+            
+            async def scenario():
+                conv_id = await storage.create_conversation(1001, 2001)
+                await storage.write(lambda conn: conn.execute(
+                    "UPDATE conversations SET created_at = '2024-01-01 10:00:00' WHERE id = ?", (conv_id,)))
+                await storage.write_batch(
+                    [(conv_id, sender, content, ts, None, None, 2001, kind) for sender, content, ts, kind in messages],
+                    {conv_id: '2024-01-01 11:00:00'},
+                )
+                await storage.close_conversations([conv_id])
+                # 重复关闭不重复计入
+                await storage.close_conversation(conv_id)
+                return (await storage.get_admin_stats(None, None),
+                        await storage.get_admin_stats('2024-01-01 11:00:00', '2024-01-02 00:00:00'))
+            
+            incremental, later = asyncio.run(scenario())
+            storage.close()
+            
+            # 命令行与 /stats 一样按 admin_table 解析管理员名称
+            import contextlib
+            import io
+            import sys
+            import analytics
+            config_path = os.path.join(tmp, 'stats.ini')
+            with open(config_path, 'w', encoding='utf-8') as f:
+                f.write(f"[ADMINS]\n技术支持 = +2001\n\n[SETTINGS]\ndb_path = {os.path.join(tmp, 'test.db')}\n")
+            output = io.StringIO()
+            argv = sys.argv
+            sys.argv = ['analytics.py', '--config', config_path]
+            try:
+                with contextlib.redirect_stdout(output):
+                    analytics.main()
+            finally:
+                sys.argv = argv
+            report = output.getvalue()
+            
+            # 升级前已有的数据由迁移补入汇总
+            conn = sqlite3.connect(os.path.join(tmp, 'old.db'))
+            migrate(conn, [m for m in MIGRATIONS if m.version < 9])
+            conn.execute("""INSERT INTO conversations (id, user_id, admin_id, status, created_at, last_active)
+                            VALUES (1, 1001, 2001, 'closed', '2024-01-01 10:00:00', '2024-01-01 11:00:00')""")
+            conn.executemany('INSERT INTO messages (conv_id, sender_id, content, timestamp) VALUES (1, ?, ?, ?)',
+                             [message[:3] for message in messages])
+            conn.commit()
+            migrate(conn)
+            backfilled = query_stats(conn)
+            conn.close()
+        
+        if incremental != [expected]:
+            print(f"❌ 增量统计错误: {incremental}")
+            return False
+        if later != [AdminStats(2001, user_messages=1)]:
+            print(f"❌ 按时间过滤错误: {later}")
+            return False
+        if backfilled != [expected]:
+            print(f"❌ 迁移补入统计错误: {backfilled}")
+            return False
+        if '👤 技术支持' not in report:
+            print(f"❌ 命令行统计的管理员名称错误: {report}")
+            return False
+        
+        print("✅ 管理员服务统计测试通过")
+        return True
+    except Exception as e:
+        print(f"❌ 管理员服务统计测试失败: {e}")
+        return False
+
+def test_update_dedup():
+    """测试重复投递的更新"""
+    print("\n🔁 测试重复投递的更新...")
+    try:
+        dedup = UpdateDeduplicator(capacity=3)
+        first = [dedup.begin(1), dedup.begin(1), dedup.begin(2)]
+        dedup.done(2)
+        # 更新1仍在处理中，低水位不能越过它
+        state = json.loads(dedup.dump())
+        dedup.done(1)
+        for update_id in (3, 4, 5):
+            dedup.begin(update_id)
+            dedup.done(update_id)
+        restored = UpdateDeduplicator(capacity=3)
+        restored.load(dedup.dump())
+        if first != [True, False, True] or state != {'low_water': 0, 'recent': [2]} or dedup.dump() is not None:
+            print(f"❌ 去重状态错误: {first}, {state}")
+            return False
+        if len(dedup) != 3 or restored.begin(5) or restored.begin(1) or not restored.begin(6):
+            print("❌ 去重状态恢复错误")
+            return False
+        # 处理失败的更新不记为已处理，低水位停在它之前，重新投递时再次处理
+        retry = UpdateDeduplicator()
+        retry.begin(7)
+        retry.failed(7)
+        retry.begin(8)
+        retry.done(8)
+        failed_state = json.loads(retry.dump())
+        if failed_state != {'low_water': 6, 'recent': [8]} or not retry.begin(7):
+            print(f"❌ 处理失败的更新被丢弃: {failed_state}")
+            return False
+        
+        with tempfile.TemporaryDirectory() as tmp:
+            benchmark = Benchmark('config.ini', tmp, users=1, messages=0, user_rate=0, admin_rate=0,
+                                  api_latency=0, telegram_limits=False)
+            bot = benchmark.bot
+            admin_id = next(iter(bot.admin_table.ids))
+            update = benchmark.updates.message(5001, '重复投递的消息')
+            
+            async def run(bot, *updates):
+                await bot._post_init(types.SimpleNamespace(bot=benchmark.fake_bot))
+                for handler, item in updates:
+                    await getattr(bot, handler)(item, benchmark.context)
+                await bot._post_shutdown(None)
+            
+            asyncio.run(run(bot, ('start_command', benchmark.updates.message(5001, '/start')),
+                            ('button_callback', benchmark.updates.callback(5001, f'admin_{admin_id}')),
+                            ('handle_user_message', update), ('handle_user_message', update)))
+            # 重启后再次投递：按保存的状态丢弃
+            restarted = CustomerServiceBot(os.path.join(tmp, 'config.ini'))
+            asyncio.run(run(restarted, ('handle_user_message', update)))
+            notifications = len(benchmark.fake_bot.notifications[admin_id])
+            # 状态未保存（崩溃）时，同一条消息也只保存一次
+            crashed = CustomerServiceBot(os.path.join(tmp, 'config.ini'))
+            crashed.dedup = UpdateDeduplicator()
+            asyncio.run(run(crashed, ('handle_user_message', update)))
+            conn = sqlite3.connect(os.path.join(tmp, 'benchmark.db'))
+            rows = conn.execute("SELECT COUNT(*) FROM messages WHERE content = '重复投递的消息'").fetchone()[0]
+            user_messages = conn.execute('SELECT SUM(user_messages) FROM admin_stats_hourly').fetchone()[0]
+            conn.close()
+        
+        if notifications != 2:
+            print(f"❌ 重复投递产生了重复通知: {notifications}")
+            return False
+        if rows != 1 or user_messages != 1:
+            print(f"❌ 重复投递的消息被重复保存: {rows}, {user_messages}")
+            return False
+        
+        print("✅ 重复投递测试通过")
+        return True
+    except Exception as e:
+        print(f"❌ 重复投递测试失败: {e}")
+        return False
+
+def test_graceful_shutdown():
+    """测试停机排空与出站调用日志"""
+    print("\n🛑 测试停机排空与出站调用日志...")
+    try:
+        closed = []
+        
+        async def on_expire(conv_ids):
+            await asyncio.sleep(0.2)
+            closed.extend(conv_ids)
+        
+        async def expiry_scenario():
+            scheduler = ExpiryScheduler(0, lambda conv_id: 0.0, on_expire, slack=0)
+            await scheduler.start()
+            scheduler.schedule(1, 0.0)
+            await asyncio.sleep(0.05)
+            # 正在关闭的一批会话在停止时完成
+            await scheduler.stop()
+        
+        asyncio.run(expiry_scenario())
+        if closed != [1]:
+            print(f"❌ 停止时打断了正在关闭的会话: {closed}")
+            return False
+        
+        with tempfile.TemporaryDirectory() as tmp:
+            benchmark = Benchmark('config.ini', tmp, users=1, messages=0, user_rate=0, admin_rate=0,
+                                  api_latency=0, telegram_limits=False)
+            benchmark.bot.storage.close()
+            config_file = os.path.join(tmp, 'config.ini')
+            
+            def run(request, shutdown_timeout, send):
+                """按真实的 Application 生命周期运行：initialize -> start -> stop -> shutdown"""
+                bot = CustomerServiceBot(config_file)
+                bot.shutdown_timeout = shutdown_timeout
+                application = (Application.builder().token(bot.bot_token)
+                               .request(request).get_updates_request(FakeRequest()).build())
+                
+                async def scenario():
+                    await application.initialize()
+                    await bot._post_init(application)
+                    await application.start()
+                    send(bot)
+                    await bot._stop_application(application)
+                
+                asyncio.run(scenario())
+                return bot
+            
+            def send_messages(bot):
+                keyboard = bot._reply_keyboard(7)
+                for i in range(3):
+                    bot.outbox.send_message(3001, f"消息{i}", reply_markup=keyboard)
+            
+            # 期限内发送完毕：排空发生在关闭 Bot API 连接之前
+            drained = FakeRequest(latency=0.05)
+            bot = run(drained, 5, send_messages)
+            drained_journal = os.path.exists(bot.journal.path)
+            
+            # 期限内未发出的写入日志，无法写入日志的记为死信
+            def send_slowly(bot):
+                send_messages(bot)
+                bot.outbox.enqueue('send_document', 3001, document=Path(tmp) / 'missing.gz')
+            
+            bot = run(FakeRequest(latency=1.0), 0.1, send_slowly)
+            journaled = bot.journal.read()
+            dead = sqlite3.connect(os.path.join(tmp, 'benchmark.db')).execute(
+                'SELECT method FROM dead_letters').fetchall()
+            
+            # 重放的调用发出前日志保留；再次停机时未发出的重放调用重新写入日志
+            kept = []
+            bot = run(FakeRequest(latency=1.0), 0.1, lambda bot: kept.append(os.path.exists(bot.journal.path)))
+            rejournaled = bot.journal.read()
+            
+            # 重启后重放
+            replayed = FakeRequest()
+            bot = run(replayed, 5, lambda bot: None)
+            left = os.path.exists(bot.journal.path)
+        
+        if drained.texts != ['消息0', '消息1', '消息2'] or drained_journal:
+            print(f"❌ 停机时未在关闭连接前发送出站队列: {drained.texts}")
+            return False
+        # 第一条调用在期限内没有返回，也写入日志（宁可重复也不丢失）
+        if [record['kwargs']['text'] for record in journaled] != ['消息0', '消息1', '消息2']:
+            print(f"❌ 日志内容错误: {journaled}")
+            return False
+        if journaled[0]['kwargs']['reply_markup']['inline_keyboard'][0][0]['callback_data'] != 'reply_7':
+            print(f"❌ 日志中的按钮错误: {journaled[0]}")
+            return False
+        if dead != [('send_document',)]:
+            print(f"❌ 无法写入日志的调用未记为死信: {dead}")
+            return False
+        if kept != [True] or rejournaled != journaled:
+            print(f"❌ 重放完成前日志丢失: {kept}, {rejournaled}")
+            return False
+        if replayed.texts != ['消息0', '消息1', '消息2'] or left:
+            print(f"❌ 日志重放错误: {replayed.texts}, {left}")
+            return False
+        
+        print("✅ 停机排空与出站调用日志测试通过")
+        return True
+    except Exception as e:
+        print(f"❌ 停机排空与出站调用日志测试失败: {e}")
+        return False
+
+def test_sharding():
+    """测试按用户分片"""
+    print("\n🧩 测试按用户分片...")
+    try:
+        router = UpdateRouter(4, [2001])
+        
+        def message(sender, text, **extra):
+            return {'update_id': 1, 'message': dict({'from': {'id': sender}, 'text': text}, **extra)}
+        
+        def callback(sender, data):
+            return {'update_id': 1, 'callback_query': {'from': {'id': sender}, 'data': data}}
+        
+        notification = {'reply_markup': {'inline_keyboard': [[{'text': '回复', 'callback_data': f'reply_{3 * SHARD_STRIDE + 5}'}]]}}
+        routes = [
+            router.route(message(1006, '你好')),                        # 用户按 user_id 分配
+            router.route(callback(1006, 'admin_2001')),
+            router.route(message(2001, '您好')),                        # 未选定会话：管理员自己的分片
+            router.route(callback(2001, f'reply_{2 * SHARD_STRIDE + 1}')),
+            router.route(message(2001, '您好')),                        # 发往选定的会话所在分片
+            router.route(message(2001, '您好', reply_to_message=notification)),
+            router.route(message(2001, f'/history {SHARD_STRIDE + 9}')),
+            router.route(message(2001, '/unblock 1007')),
+            router.route(message(2001, '/stats 7')),
+            router.route({'update_id': 1}),
+        ]
+        if routes != [2, 2, 1, 2, 2, 3, 1, 3, 1, 0]:
+            print(f"❌ 更新分配错误: {routes}")
+            return False
+        
+        config = configparser.ConfigParser()
+        config.read_dict({'SETTINGS': {'db_path': '/data/database.db', 'send_global_rate': '30'}})
+        apply_shard(config, Shard(1, 3))
+        if (shard_path('/data/database.db', 0) != '/data/database.db'
+                or config['SETTINGS']['journal_path'] != '/data/outbox.shard1.journal'
+                or config['SETTINGS']['archive_dir'] != 'archive.shard1'
+                or config.getfloat('SETTINGS', 'send_global_rate') != 10
+                or abs(config.getfloat('SETTINGS', 'send_admin_chat_rate') - 1 / 3) > 1e-9
+                or config.getint('METRICS', 'port') != 9101):
+            print(f"❌ 分片配置错误: {dict(config['SETTINGS'])}")
+            return False
+        # 摘要模式下主进程也向管理员发送，速率按 3 个分片 + 主进程均分
+        config = configparser.ConfigParser()
+        config.read_dict({'SETTINGS': {'send_global_rate': '30', 'send_chat_rate': '1', 'admin_inbox': 'true'}})
+        apply_shard(config, Shard(0, 3))
+        if (config.getfloat('SETTINGS', 'send_global_rate') != 7.5
+                or config.getfloat('SETTINGS', 'send_admin_chat_rate') != 0.25):
+            print(f"❌ 摘要模式下的分片配置错误: {dict(config['SETTINGS'])}")
+            return False
+        
+        # 发往管理员的速率只用分到的一份，且不允许突发；用户不受影响
+        outbox = OutboundDispatcher(chat_rate=1, shared_chat_rate=0.25, is_shared_chat=lambda chat_id: chat_id == 2001)
+        buckets = [outbox._chat_bucket(chat_id, 0.0) for chat_id in (2001, 1006)]
+        if [(bucket.rate, bucket.capacity) for bucket in buckets] != [(0.25, 1), (1, 3)]:
+            print(f"❌ 管理员聊天的发送速率错误: {[(b.rate, b.capacity) for b in buckets]}")
+            return False
+        
+        # 工作进程的收件箱事件在主进程唯一的收件箱上执行
+        events = queue.Queue()
+        relay = InboxRelay(events)
+        relay.track(2001, 5, '用户1006')
+        relay.user_message(2001, 5, '用户1006', '你好', (1006, 77))
+        relay.user_message(2001, 6, '用户1007', '在吗')
+        relay.remove(6)
+        relay.show_unread(2001, 5, '请回复')
+        
+        async def owner():
+            outbox = OutboundDispatcher()
+            inbox = AdminInbox(outbox, interval=60)
+            unread = None
+            while not events.empty():
+                event = events.get()
+                if event[0] == 'show_unread':
+                    unread = inbox.unread_count(5)
+                apply_event(inbox, event)
+            apply_event(inbox, ('open', (5,)))
+            inbox.close()
+            jobs = [(job.method, job.kwargs.get('text')) for jobs in outbox._chats.values() for job in jobs]
+            return unread, inbox.unread_count(5), sorted(inbox._admin_of), jobs
+        
+        unread, remaining, tracked, jobs = asyncio.run(owner())
+        if (unread != 1 or remaining != 0 or tracked != [5]
+                or [method for method, _ in jobs] != ['send_message', 'copy_message'] or '你好' not in jobs[0][1]):
+            print(f"❌ 收件箱事件转发错误: {unread}, {remaining}, {tracked}, {jobs}")
+            return False
+        
+        with tempfile.TemporaryDirectory() as tmp:
+            benchmark = Benchmark('config.ini', tmp, users=1, messages=0, user_rate=0, admin_rate=0,
+                                  api_latency=0, telegram_limits=False)
+            benchmark.bot.storage.close()
+            config_file = os.path.join(tmp, 'config.ini')
+            # 共 3 个分片，分片 2 尚未启动：其数据库应被跳过，且不能被其他分片创建出来
+            bots = [CustomerServiceBot(config_file, Shard(index, 3)) for index in range(2)]
+            
+            async def scenario():
+                conv_ids = []
+                for bot, user_id in zip(bots, (1002, 1003)):
+                    conv_id = await bot.storage.create_conversation(user_id, 2001)
+                    await bot.storage.write_batch(
+                        [(conv_id, user_id, f'用户{user_id}的退款还没到账', '2024-01-01 10:00:00')], {})
+                    conv_ids.append(conv_id)
+                # 由任一分片汇总所有分片的搜索和统计结果
+                text, _ = await bots[0]._search_page(SearchSession(['退款还没']), 0)
+                stats = await bots[0]._fan_out(lambda storage: storage.get_admin_stats(None, None))
+                # 每页 1 条：两页分别来自两个分片，返回上一页时结果不变
+                bots[0].search_page_size = 1
+                session = SearchSession(['退款'])
+                pages = [await bots[0]._search_page(session, page) for page in (0, 1, 0)]
+                return conv_ids, text, stats, pages, await bots[0]._search_page(session, 5)
+            
+            conv_ids, text, stats, pages, unknown = asyncio.run(scenario())
+            missing = bots[0].db_paths[2]
+            created = os.path.exists(missing)
+            shard_config = configparser.ConfigParser()
+            shard_config.read_dict({'SETTINGS': {'db_path': bots[0].db_path}, 'SHARDING': {'workers': '3'}})
+            count = export(configured_db_paths(shard_config), os.path.join(tmp, 'all.jsonl'))
+            for bot in bots:
+                bot.storage.close()
+                for peer in bot.peers:
+                    peer.close()
+        
+        if [conv_id // SHARD_STRIDE for conv_id in conv_ids] != [0, 1]:
+            print(f"❌ 会话编号区间错误: {conv_ids}")
+            return False
+        if created:
+            print(f"❌ 读取时创建了尚未启动的分片数据库: {missing}")
+            return False
+        if '用户1002' not in text or '用户1003' not in text:
+            print(f"❌ 跨分片搜索错误: {text}")
+            return False
+        users = [['用户1002' in page[0], '用户1003' in page[0]] for page in pages]
+        buttons = [[button.callback_data for button in page[1].inline_keyboard[0]] for page in pages]
+        if (sorted(users[:2]) != [[False, True], [True, False]] or users[2] != users[0] or unknown is not None
+                or buttons != [['search_1'], ['search_0'], ['search_1']]):
+            print(f"❌ 跨分片翻页错误: {users}, {buttons}")
+            return False
+        if [item.opened for item in merge_stats(stats)] != [2] or len(stats) != 2 or count != 2:
+            print(f"❌ 跨分片统计或导出错误: {stats}, {count}")
+            return False
+        
+        print("✅ 按用户分片测试通过")
+        return True
+    except Exception as e:
+        print(f"❌ 按用户分片测试失败: {e}")
+        return False
+
 def main():
     """主测试函数"""
     print("🧪 电报客服机器人功能测试")
@@ -94,7 +1574,32 @@ def main():
         test_config_loading,
         test_database,
         test_admin_keyboard,
-        test_phone_masking
+        test_phone_masking,
+        test_storage,
+        test_write_behind,
+        test_conversation_index,
+        test_notification_map,
+        test_migrations,
+        test_search,
+        test_export,
+        test_archive,
+        test_media,
+        test_burst_coalescer,
+        test_expiry_scheduler,
+        test_outbox,
+        test_admin_router,
+        test_webhook_server,
+        test_metrics,
+        test_benchmark,
+        test_concurrent_updates,
+        test_admission,
+        test_faq,
+        test_config_reload,
+        test_admin_inbox,
+        test_analytics,
+        test_update_dedup,
+        test_graceful_shutdown,
+        test_sharding
     ]
     
     passed = 0
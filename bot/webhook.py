@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Webhook 模式
+内嵌 HTTP 服务器接收 Telegram 推送的更新，校验 secret token，限制并发处理数。
+更新处理完成后才返回 200：确认后 Telegram 不再重发，处理完成前进程退出的更新会被重新推送。
+停止时先拒绝新请求再等待处理中的更新完成
+
+本地调试（无需 Telegram）：
+    python3 webhook.py replay updates.jsonl --url http://127.0.0.1:8443/webhook --secret <secret_token>
+"""
+
+import argparse
+import asyncio
+import hmac
+import json
+import logging
+import urllib.error
+import urllib.request
+from typing import Any, Awaitable, Callable, Dict, Optional, Set
+
+from http_server import HttpRequest, HttpResponse, HttpServer
+
+logger = logging.getLogger(__name__)
+
+SECRET_HEADER = 'x-telegram-bot-api-secret-token'
+
+
+class WebhookServer:
+    """Telegram webhook 接收端"""
+
+    def __init__(self, process_update: Callable[[Dict[str, Any]], Awaitable[None]],
+                 host: str = '0.0.0.0', port: int = 8443, path: str = '/webhook',
+                 secret_token: Optional[str] = None, max_concurrent: int = 64):
+        self.process_update = process_update
+        self.path = path
+        self.secret_token = secret_token
+        self.max_concurrent = max_concurrent
+        self.http = HttpServer(self._handle, host, port)
+        self._slots: Optional[asyncio.Semaphore] = None
+        self._tasks: Set[asyncio.Task] = set()
+        self._draining = False
+
+    @property
+    def in_flight(self) -> int:
+        """正在处理的更新数"""
+        return len(self._tasks)
+
+    async def start(self):
+        """开始接收更新"""
+        self._slots = asyncio.Semaphore(self.max_concurrent)
+        self._draining = False
+        await self.http.start()
+
+    async def drain(self, timeout: float = 30.0):
+        """停止接收新更新并等待处理中的更新完成（最多 timeout 秒）"""
+        self._draining = True
+        self.http.stop_accepting()
+        if self._tasks:
+            logger.info(f"等待 {len(self._tasks)} 个更新处理完成...")
+            done, pending = await asyncio.wait(set(self._tasks), timeout=timeout)
+            if pending:
+                logger.warning(f"{len(pending)} 个更新未能在 {timeout} 秒内处理完成")
+                for task in pending:
+                    task.cancel()
+        await self.http.close()
+
+    async def _handle(self, request: HttpRequest) -> HttpResponse:
+        if request.path != self.path:
+            return HttpResponse(404)
+        if request.method != 'POST':
+            return HttpResponse(405)
+        # 按字节比较：头部按 latin-1 解码，还原为原始字节；含非 ASCII 字符时 str 比较会抛出 TypeError
+        if self.secret_token is not None and not hmac.compare_digest(
+                request.headers.get(SECRET_HEADER, '').encode('latin-1'), self.secret_token.encode('utf-8')):
+            return HttpResponse(403)
+        if self._draining:
+            # Telegram 收到非 2xx 会稍后重发
+            return HttpResponse(503)
+        try:
+            data = json.loads(request.body)
+        except ValueError:
+            return HttpResponse(400)
+        if not isinstance(data, dict) or 'update_id' not in data:
+            return HttpResponse(400)
+
+        # 并发数已满时推迟响应，让 Telegram 放慢推送
+        await self._slots.acquire()
+        task = asyncio.create_task(self._process(data))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        # 处理完成后再确认；连接断开不中断处理
+        if not await asyncio.shield(task):
+            # Telegram 稍后重发
+            return HttpResponse(500)
+        return HttpResponse(200)
+
+    async def _process(self, data: Dict[str, Any]) -> bool:
+        """处理一个更新，返回是否成功"""
+        try:
+            await self.process_update(data)
+            return True
+        except Exception as e:
+            logger.error(f"处理更新 {data.get('update_id')} 失败: {e}")
+            return False
+        finally:
+            self._slots.release()
+
+
+def replay(path: str, url: str, secret_token: Optional[str] = None):
+    """把录制的更新（每行一个 JSON）逐条 POST 到 webhook"""
+    headers = {'Content-Type': 'application/json'}
+    if secret_token:
+        headers['X-Telegram-Bot-Api-Secret-Token'] = secret_token
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            request = urllib.request.Request(url, data=line.encode('utf-8'), headers=headers, method='POST')
+            try:
+                with urllib.request.urlopen(request) as response:
+                    status = response.status
+            except urllib.error.HTTPError as e:
+                status = e.code
+            print(f"{json.loads(line).get('update_id')}: {status}")
+
+
+def main():
+    """命令行入口"""
+    parser = argparse.ArgumentParser(description='Webhook 本地调试工具')
+    sub = parser.add_subparsers(dest='command', required=True)
+    replay_parser = sub.add_parser('replay', help='把录制的更新 POST 到 webhook')
+    replay_parser.add_argument('file', help='每行一个 Update JSON 的文件')
+    replay_parser.add_argument('--url', default='http://127.0.0.1:8443/webhook')
+    replay_parser.add_argument('--secret', default=None, help='secret_token')
+    args = parser.parse_args()
+
+    if args.command == 'replay':
+        replay(args.file, args.url, args.secret)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,199 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+消息写回队列
+把待保存的消息、会话活跃时间更新、通知映射、媒体文件记录和运行状态合并成批，每 N 毫秒或每 M 条提交一次事务。
+提交失败时按指数退避（有上限）一直重试，不丢弃已确认给用户的消息；重试期间队列写满后由背压让处理器等待
+"""
+
+import asyncio
+import logging
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+from storage import Storage, utc_timestamp
+
+logger = logging.getLogger(__name__)
+
+
+class PendingMessage(NamedTuple):
+    """待写入的消息（媒体消息的 content 为说明文字）；kind 为统计用的消息类别，admin_id 为会话的管理员，
+    (chat_id, telegram_message_id) 为消息在 Telegram 中的位置，用于丢弃重复投递"""
+    conv_id: int
+    sender_id: int
+    content: str
+    timestamp: str
+    media_type: Optional[str] = None
+    file_unique_id: Optional[str] = None
+    admin_id: Optional[int] = None
+    kind: Optional[str] = None
+    chat_id: Optional[int] = None
+    telegram_message_id: Optional[int] = None
+
+
+class PendingNotification(NamedTuple):
+    """待写入的管理员通知映射"""
+    chat_id: int
+    message_id: int
+    conv_id: int
+
+
+class PendingMedia(NamedTuple):
+    """待写入的媒体文件记录"""
+    file_unique_id: str
+    file_id: str
+    media_type: str
+
+
+class PendingState(NamedTuple):
+    """待写入的运行状态"""
+    key: str
+    value: str
+
+
+class _FlushMarker:
+    """flush() 放入队列的标记，批次提交后唤醒等待者"""
+
+    def __init__(self, future: asyncio.Future, stop: bool = False):
+        self.future = future
+        self.stop = stop
+
+
+class WriteBehindQueue:
+    """有界的消息写回队列（group commit）"""
+
+    def __init__(self, storage: Storage, flush_interval: float = 0.05,
+                 batch_size: int = 500, max_pending: int = 10000,
+                 base_backoff: float = 0.1, max_backoff: float = 30.0):
+        self.storage = storage
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.max_pending = max_pending
+        self.base_backoff = base_backoff
+        self.max_backoff = max_backoff
+        self._queue: Optional[asyncio.Queue] = None
+        self._task: Optional[asyncio.Task] = None
+
+    @property
+    def pending(self) -> int:
+        """队列中尚未提交的条目数"""
+        return self._queue.qsize() if self._queue else 0
+
+    async def start(self):
+        """启动后台提交任务"""
+        if self._task:
+            return
+        self._queue = asyncio.Queue(maxsize=self.max_pending)
+        self._task = asyncio.create_task(self._run())
+
+    async def put_message(self, conv_id: int, sender_id: int, content: str,
+                          media_type: Optional[str] = None, file_unique_id: Optional[str] = None,
+                          admin_id: Optional[int] = None, kind: Optional[str] = None,
+                          source: Optional[Tuple[int, int]] = None):
+        """加入一条消息（指定 kind 和 admin_id 时计入统计，source 为 Telegram 中的 (chat_id, message_id)）；
+        队列已满时等待（背压）"""
+        if not self._task:
+            raise RuntimeError("写回队列尚未启动")
+        chat_id, telegram_message_id = source or (None, None)
+        await self._queue.put(PendingMessage(conv_id, sender_id, content, utc_timestamp(), media_type, file_unique_id,
+                                             admin_id, kind, chat_id, telegram_message_id))
+
+    async def put_notification(self, chat_id: int, message_id: int, conv_id: int):
+        """加入一条通知映射；队列已满时等待（背压）"""
+        if not self._task:
+            raise RuntimeError("写回队列尚未启动")
+        await self._queue.put(PendingNotification(chat_id, message_id, conv_id))
+
+    async def put_media(self, file_unique_id: str, file_id: str, media_type: str):
+        """加入一条媒体文件记录；队列已满时等待（背压）"""
+        if not self._task:
+            raise RuntimeError("写回队列尚未启动")
+        await self._queue.put(PendingMedia(file_unique_id, file_id, media_type))
+
+    async def put_state(self, key: str, value: str):
+        """加入一条运行状态，与此前加入的消息在同一或之后的事务中提交"""
+        if not self._task:
+            raise RuntimeError("写回队列尚未启动")
+        await self._queue.put(PendingState(key, value))
+
+    async def flush(self):
+        """等待此前加入的所有消息提交完成"""
+        if not self._task:
+            return
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put(_FlushMarker(future))
+        await future
+
+    async def close(self):
+        """提交剩余消息并停止后台任务"""
+        if not self._task:
+            return
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put(_FlushMarker(future, stop=True))
+        await future
+        await self._task
+        self._task = None
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch: List[tuple] = []
+            markers: List[_FlushMarker] = []
+
+            item = await self._queue.get()
+            deadline = loop.time() + self.flush_interval
+            while True:
+                if isinstance(item, _FlushMarker):
+                    markers.append(item)
+                    break
+                batch.append(item)
+                if len(batch) >= self.batch_size:
+                    break
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    item = await asyncio.wait_for(self._queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+
+            if batch:
+                await self._commit(batch)
+            for marker in markers:
+                if not marker.future.done():
+                    marker.future.set_result(None)
+            if any(marker.stop for marker in markers):
+                return
+
+    async def _commit(self, batch: List[tuple]):
+        """在一个事务中写入整批数据"""
+        messages: List[PendingMessage] = []
+        states: Dict[str, str] = {}
+        notifications: List[PendingNotification] = []
+        media: List[PendingMedia] = []
+        # 同一会话的多次活跃时间更新合并为一次
+        bumps: Dict[int, str] = {}
+        for item in batch:
+            if isinstance(item, PendingNotification):
+                notifications.append(item)
+                continue
+            if isinstance(item, PendingMedia):
+                media.append(item)
+                continue
+            if isinstance(item, PendingState):
+                # 同一键只保留最后一次
+                states[item.key] = item.value
+                continue
+            messages.append(item)
+            if item.timestamp > bumps.get(item.conv_id, ''):
+                bumps[item.conv_id] = item.timestamp
+
+        attempt = 0
+        while True:
+            try:
+                await self.storage.write_batch(messages, bumps, notifications, media, list(states.items()))
+                return
+            except Exception as e:
+                attempt += 1
+                delay = min(self.max_backoff, self.base_backoff * 2 ** (attempt - 1))
+                logger.error(f"批量保存 {len(batch)} 条记录失败（第{attempt}次），{delay:.1f} 秒后重试: {e}")
+                await asyncio.sleep(delay)